@@ -0,0 +1,77 @@
+######################################################################
+# Benchmark: rows per second, single-row POST versus the bulk endpoint
+#
+# Boots the service against a temporary SQLite database and writes the
+# same rows once through POST /recommendations and once through
+# POST /recommendations/bulk, as a JSON array and as NDJSON.
+#
+# run with:
+#   python benchmarks/bench_bulk.py [single rows] [bulk rows]
+######################################################################
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(__location__, '..'))
+
+import server
+import storage
+
+
+def make_rows(count):
+    return [{'parent_product_id': random.randint(1, 10000),
+             'related_product_id': random.randint(1, 10000),
+             'type': random.choice(['x-sell', 'up-sell', 'accessory']),
+             'priority': random.randint(1, 10)}
+            for _ in range(count)]
+
+
+def reset():
+    server.engine.execute(storage.recommendations.delete())
+
+
+def single(client, rows):
+    for row in rows:
+        client.post('/recommendations', data=json.dumps(row),
+                    content_type='application/json')
+
+
+def bulk(client, rows):
+    client.post('/recommendations/bulk', data=json.dumps(rows),
+                content_type='application/json')
+
+
+def ndjson(client, rows):
+    client.post('/recommendations/bulk',
+                data='\n'.join(json.dumps(row) for row in rows),
+                content_type='application/x-ndjson')
+
+
+def rate(run, client, rows):
+    reset()
+    start = time.time()
+    run(client, rows)
+    return len(rows) / (time.time() - start)
+
+
+if __name__ == "__main__":
+    single_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    bulk_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    workdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    server.initialize_mysql()
+    client = server.app.test_client()
+    baseline = rate(single, client, make_rows(single_rows))
+    print("%-8s %10.0f rows/s" % ('single', baseline))
+    for name, run in [('bulk', bulk), ('ndjson', ndjson)]:
+        rows_per_second = rate(run, client, make_rows(bulk_rows))
+        print("%-8s %10.0f rows/s  %5.1fx" % (name, rows_per_second, rows_per_second / baseline))
+    server.engine.dispose()
+    shutil.rmtree(workdir)
@@ -0,0 +1,113 @@
+######################################################################
+# Benchmark: writes per second with the change log off and on
+#
+# Boots the service against a temporary SQLite database and drives a
+# mix of POST, PUT, PUT clicked and DELETE /recommendations from
+# several threads, first without CHANGE_LOG_DIR, then with the log
+# flushed to the OS only (CHANGE_LOG_FSYNC=False) and then fsynced on
+# every append. With the log on, a consumer then reads every change
+# back with GET /recommendations/changes?since=, a page at a time.
+#
+# run with:
+#   python benchmarks/bench_changes.py [writes] [threads] [rows]
+######################################################################
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+from threading import Thread
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(__location__, '..'))
+
+import server
+import storage
+
+MODES = [('off', None), ('on, no fsync', 'False'), ('on, fsync', 'True')]
+
+
+def seed(rows):
+    server.engine.execute(storage.recommendations.delete())
+    server.engine.execute(storage.recommendations.insert(),
+                          [{'id': i, 'parent_product_id': i % 100,
+                            'related_product_id': i, 'type': 'x-sell',
+                            'priority': 1000000}
+                           for i in range(1, rows + 1)])
+
+
+def drive(writes, threads, rows):
+    def worker(number, count):
+        client = server.app.test_client()
+        created = []
+        for n in range(count):
+            choice = n % 4
+            if choice == 0:
+                resp = client.post('/recommendations', content_type='application/json',
+                                   data=json.dumps({'parent_product_id': number + 1,
+                                                    'related_product_id': rows + number * count + n,
+                                                    'type': 'x-sell', 'priority': 5}))
+                created.append(json.loads(resp.data)['id'])
+            elif choice == 1:
+                id = random.randint(1, rows)
+                client.put('/recommendations/%d' % id, content_type='application/json',
+                           data=json.dumps({'parent_product_id': id % 100, 'related_product_id': id,
+                                            'type': 'x-sell', 'priority': random.randint(1, 10)}))
+            elif choice == 2:
+                client.put('/recommendations/%d/clicked' % random.randint(1, rows))
+            else:
+                client.delete('/recommendations/%d' % created.pop())
+    workers = [Thread(target=worker, args=(number, writes // threads))
+               for number in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (writes // threads) * threads / (time.time() - start)
+
+
+def consume():
+    """ Reads every change in pages, returns how many and changes/s """
+    client = server.app.test_client()
+    since = 0
+    count = 0
+    start = time.time()
+    while True:
+        resp = client.get('/recommendations/changes?since=%d&limit=1000' % since)
+        page = json.loads(resp.data)
+        if not page:
+            break
+        count += len(page)
+        since = int(resp.headers['X-Last-Seq'])
+    return count, count / (time.time() - start)
+
+
+if __name__ == "__main__":
+    writes = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    rows = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    workdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    print("%d writes from %d threads over %d rows" % (writes, threads, rows))
+    for name, fsync in MODES:
+        log_dir = os.path.join(workdir, 'changes-%s' % fsync)
+        if fsync is None:
+            os.environ.pop('CHANGE_LOG_DIR', None)
+        else:
+            os.environ.update(CHANGE_LOG_DIR=log_dir, CHANGE_LOG_FSYNC=fsync)
+        server.initialize_mysql()
+        seed(rows)
+        line = "%-13s %8.0f writes/s" % (name, drive(writes, threads, rows))
+        if fsync is not None:
+            line += "   read back %d changes at %.0f changes/s" % consume()
+        print(line)
+        server.engine.dispose()
+    # closes the last log
+    os.environ.pop('CHANGE_LOG_DIR')
+    server.initialize_changes()
+    shutil.rmtree(workdir)
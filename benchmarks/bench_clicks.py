@@ -0,0 +1,67 @@
+######################################################################
+# Benchmark: clicks per second, synchronous versus batched
+#
+# Boots the service against a temporary SQLite database and drives
+# PUT /recommendations/<id>/clicked from several threads, first with
+# CLICK_MODE=sync and then with CLICK_MODE=batched.
+#
+# run with:
+#   python benchmarks/bench_clicks.py [clicks] [threads] [rows]
+######################################################################
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from threading import Thread
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(__location__, '..'))
+
+import server
+import storage
+
+
+def seed(rows):
+    server.engine.execute(storage.recommendations.delete())
+    server.engine.execute(storage.recommendations.insert(),
+                          [{'id': i, 'parent_product_id': i % 100,
+                            'related_product_id': i, 'type': 'x-sell',
+                            'priority': 1000000}
+                           for i in range(1, rows + 1)])
+
+
+def drive(clicks, threads, rows):
+    def worker(count):
+        client = server.app.test_client()
+        for _ in range(count):
+            client.put('/recommendations/%d/clicked' % random.randint(1, rows))
+    workers = [Thread(target=worker, args=(clicks // threads,))
+               for _ in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    # queued clicks only count once they are written
+    server.stop_click_batcher()
+    return (clicks // threads) * threads / (time.time() - start)
+
+
+if __name__ == "__main__":
+    clicks = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    rows = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    workdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    print("%d clicks from %d threads over %d rows" % (clicks, threads, rows))
+    for mode in ['sync', 'batched']:
+        os.environ['CLICK_MODE'] = mode
+        server.initialize_mysql()
+        seed(rows)
+        print("%-8s %8.0f clicks/s" % (mode, drive(clicks, threads, rows)))
+        server.engine.dispose()
+    shutil.rmtree(workdir)
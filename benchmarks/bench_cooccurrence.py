@@ -0,0 +1,116 @@
+######################################################################
+# Benchmark: the co-click job at growing catalogue sizes
+#
+# Generates a synthetic catalogue into a temporary SQLite database:
+# products fall into clusters of CLUSTER related products, each one
+# recommends FAN_OUT others of its cluster, and sessions pick a cluster
+# with power-law popularity and click a few of its recommendations.
+# Then runs cooccurrence.run() in a fresh process per size, reporting
+# the time of each phase and the peak memory of the job.
+#
+# run with:
+#   python benchmarks/bench_cooccurrence.py [products ...]
+#   e.g. python benchmarks/bench_cooccurrence.py 10000 100000 1000000
+######################################################################
+
+import os
+import sys
+import time
+import random
+import shutil
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(__location__, '..'))
+
+CLUSTER = 20
+FAN_OUT = 5
+SESSIONS_PER_PRODUCT = 2
+CLICKS_PER_SESSION = (2, 6)
+CHUNK = 10000
+
+
+def generate(path, products, seed=42):
+    """ Seeds the catalogue and the click events, returns the event count """
+    import storage
+    import migrations
+    generator = random.Random(seed)
+    engine = storage.create_db_engine('sqlite:///' + path)
+    migrations.upgrade(engine)
+    rows = []
+    for product in range(products):
+        cluster = product - product % CLUSTER
+        for offset in generator.sample(range(1, CLUSTER), FAN_OUT):
+            rows.append({'id': len(rows) + 1, 'parent_product_id': product,
+                         'related_product_id': cluster + (product + offset) % CLUSTER,
+                         'type': 'x-sell', 'priority': offset})
+            if len(rows) % CHUNK == 0:
+                engine.execute(storage.recommendations.insert(), rows[-CHUNK:])
+    if len(rows) % CHUNK:
+        engine.execute(storage.recommendations.insert(), rows[len(rows) - len(rows) % CHUNK:])
+    clusters = products // CLUSTER
+    now = datetime.utcnow()
+    events = []
+    count = 0
+    for session in range(products * SESSIONS_PER_PRODUCT):
+        # power-law cluster popularity
+        cluster = min(int(generator.paretovariate(1.2)) - 1, clusters - 1)
+        cluster = (cluster * 7919) % clusters
+        for _ in range(generator.randint(*CLICKS_PER_SESSION)):
+            rec_id = (cluster * CLUSTER + generator.randrange(CLUSTER)) * FAN_OUT + generator.randrange(FAN_OUT) + 1
+            events.append({'recommendation_id': rec_id,
+                           'parent_product_id': rows[rec_id - 1]['parent_product_id'],
+                           'session': 's%d' % session, 'clicked_at': now})
+        if len(events) >= CHUNK:
+            engine.execute(storage.click_events.insert(), events)
+            count += len(events)
+            events = []
+    if events:
+        engine.execute(storage.click_events.insert(), events)
+        count += len(events)
+    engine.dispose()
+    return count
+
+
+def run(path):
+    """ Runs in a child process, prints each phase's seconds and peak RSS """
+    import storage
+    import cooccurrence
+    engine = storage.create_db_engine('sqlite:///' + path)
+    times = []
+    start = time.time()
+    baskets, products = cooccurrence.read_baskets(engine)
+    times.append(time.time() - start)
+    start = time.time()
+    matrix, product_ids = cooccurrence.incidence_matrix(baskets, products)
+    del baskets, products
+    times.append(time.time() - start)
+    start = time.time()
+    similar = cooccurrence.similar_products(matrix)
+    written = cooccurrence.write_recommendations(engine, product_ids, similar)
+    times.append(time.time() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("%f %f %f %d %d" % (times[0], times[1], times[2], written, peak))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        run(sys.argv[2])
+        sys.exit(0)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    workdir = tempfile.mkdtemp()
+    print("%10s %10s %8s %8s %10s %10s %10s" % ('products', 'events', 'read s', 'matrix s',
+                                                 'top-K+write s', 'co-clicks', 'peak MB'))
+    for products in sizes:
+        path = os.path.join(workdir, 'bench-%d.db' % products)
+        events = generate(path, products)
+        output = subprocess.check_output([sys.executable, __file__, '--run', path])
+        read, build, similar, written, peak = output.split()[-5:]
+        print("%10d %10d %8.1f %8.1f %10.1f %10d %10.1f" % (products, events, float(read), float(build),
+                                                            float(similar), int(written), int(peak) / 1024.0))
+        os.remove(path)
+    shutil.rmtree(workdir)
@@ -0,0 +1,68 @@
+######################################################################
+# Benchmark: peak memory of a full dump, list versus streaming export
+#
+# Seeds temporary SQLite databases of growing size from dataset.py, then serves
+# GET /recommendations (one in-memory list) and
+# GET /recommendations?export=ndjson (streamed from a server-side
+# cursor) from a fresh process each, reporting how far the process
+# grew past its size after start-up.
+#
+# run with:
+#   python benchmarks/bench_export.py [rows ...]
+######################################################################
+
+import os
+import sys
+import shutil
+import resource
+import tempfile
+import subprocess
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(__location__, '..'))
+
+MODES = {'list': '/recommendations',
+         'export': '/recommendations?export=ndjson'}
+
+
+def seed(path, rows):
+    import storage
+    import dataset
+    engine = storage.create_db_engine('sqlite:///' + path)
+    dataset.load(engine, dataset.generate(rows))
+    engine.dispose()
+
+
+def serve(path, mode):
+    """ Runs in a child process, prints the peak RSS growth in KB """
+    os.environ['DATABASE_URI'] = 'sqlite:///' + path
+    import server
+    server.initialize_mysql()
+    client = server.app.test_client()
+    client.get('/recommendations?limit=1')
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    resp = client.get(MODES[mode], buffered=False)
+    size = 0
+    for chunk in resp.response:
+        size += len(chunk)
+    resp.close()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("%d %d" % (peak - baseline, size))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        serve(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 500000]
+    workdir = tempfile.mkdtemp()
+    print("%10s %8s %12s %12s" % ('rows', 'mode', 'body MB', 'peak +MB'))
+    for rows in sizes:
+        path = os.path.join(workdir, 'bench-%d.db' % rows)
+        seed(path, rows)
+        for mode in sorted(MODES):
+            output = subprocess.check_output([sys.executable, __file__, '--serve', path, mode])
+            growth, size = output.split()[-2:]
+            print("%10d %8s %12.1f %12.1f" % (rows, mode, int(size) / 1e6, int(growth) / 1024.0))
+    shutil.rmtree(workdir)
@@ -0,0 +1,81 @@
+######################################################################
+# Benchmark: product list latency, SQL versus the in-memory graph
+#
+# Seeds a temporary SQLite database with a dataset.py set, then serves random
+# GET /recommendations?product-id= requests from a fresh process per
+# mode: READ_MODE=sql with the list cache disabled, READ_MODE=sql with
+# the default cache, and READ_MODE=graph. Reports the latency
+# percentiles of each and the memory the graph takes per edge.
+#
+# run with:
+#   python benchmarks/bench_graph.py [rows] [requests]
+######################################################################
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(__location__, '..'))
+
+MODES = {'sql': {'READ_MODE': 'sql', 'CACHE_SIZE': '0'},
+         'sql+cache': {'READ_MODE': 'sql'},
+         'graph': {'READ_MODE': 'graph', 'GRAPH_REFRESH_INTERVAL': '0'}}
+
+
+def seed(path, rows):
+    """ Loads the standard dataset, returns the number of products """
+    import storage
+    import dataset
+    engine = storage.create_db_engine('sqlite:///' + path)
+    count, products = dataset.load(engine, dataset.generate(rows))
+    engine.dispose()
+    return products
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def serve(path, mode, products, requests):
+    """ Runs in a child process, prints p50, p99 and the graph size """
+    os.environ['DATABASE_URI'] = 'sqlite:///' + path
+    os.environ.update(MODES[mode])
+    import server
+    server.initialize_mysql()
+    client = server.app.test_client()
+    generator = random.Random(42)
+    samples = []
+    for _ in range(requests):
+        url = '/recommendations?product-id=%d' % generator.randint(1, products)
+        start = time.time()
+        client.get(url)
+        samples.append(time.time() - start)
+    samples.sort()
+    per_edge = server.graph_loader.graph.stats()['bytes_per_edge'] if server.graph_loader else 0
+    print("%f %f %f" % (percentile(samples, 0.5), percentile(samples, 0.99), per_edge))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        serve(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+        sys.exit(0)
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'bench.db')
+    products = seed(path, rows)
+    print("%d rows, %d products, %d requests" % (rows, products, requests))
+    print("%10s %10s %10s %14s" % ('mode', 'p50 ms', 'p99 ms', 'bytes/edge'))
+    for mode in ('sql', 'sql+cache', 'graph'):
+        output = subprocess.check_output([sys.executable, __file__, '--serve', path, mode,
+                                          str(products), str(requests)])
+        p50, p99, per_edge = [float(value) for value in output.split()[-3:]]
+        print("%10s %10.3f %10.3f %14s" % (mode, p50 * 1000, p99 * 1000,
+                                           '%.1f' % per_edge if per_edge else '-'))
+    shutil.rmtree(workdir)
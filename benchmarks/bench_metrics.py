@@ -0,0 +1,77 @@
+######################################################################
+# Benchmark: the cost of the request metrics
+#
+# Seeds a temporary SQLite database from dataset.py, then serves the
+# same random GET /recommendations/<id> and ?product-id= requests with
+# METRICS=False and METRICS=True, switching between the two every
+# batch, in alternating order, so both see the same machine and
+# neither always follows the other. Reports the fastest batch of
+# each, which is the least disturbed by other load, and the overhead
+# of the metrics hooks and statement events.
+#
+# run with:
+#   python benchmarks/bench_metrics.py [rows] [requests per batch] [batches]
+######################################################################
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(__location__, '..'))
+
+MODES = ('False', 'True')
+
+
+def seed(path, rows):
+    import storage
+    import dataset
+    engine = storage.create_db_engine('sqlite:///' + path)
+    count, products = dataset.load(engine, dataset.generate(rows))
+    engine.dispose()
+    return products
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    batches = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'bench.db')
+    products = seed(path, rows)
+    os.environ['DATABASE_URI'] = 'sqlite:///' + path
+    # every list is read from the database, not the cache
+    os.environ['CACHE_SIZE'] = '0'
+    import server
+    server.initialize_mysql()
+    client = server.app.test_client()
+    generator = random.Random(42)
+    urls = []
+    for _ in range(requests):
+        if generator.random() < 0.5:
+            urls.append('/recommendations/%d' % generator.randint(1, rows))
+        else:
+            urls.append('/recommendations?product-id=%d' % generator.randint(1, products))
+    for url in urls:
+        client.get(url)
+    best = {}
+    for batch in range(batches):
+        for mode in MODES[::1 if batch % 2 else -1]:
+            os.environ['METRICS'] = mode
+            server.initialize_metrics()
+            start = time.time()
+            for url in urls:
+                client.get(url)
+            elapsed = (time.time() - start) / requests
+            best[mode] = min(best.get(mode, elapsed), elapsed)
+    print("%d rows, %d requests per batch, %d batches" % (rows, requests, batches))
+    print("%12s %12s" % ('METRICS', 'us/request'))
+    for mode in MODES:
+        print("%12s %12.1f" % (mode, best[mode] * 1e6))
+    print("overhead %.1f%%" % ((best['True'] / best['False'] - 1) * 100))
+    server.engine.dispose()
+    shutil.rmtree(workdir)
@@ -0,0 +1,75 @@
+######################################################################
+# Microbenchmark: per-request statement overhead
+#
+# Compares the three ways a handler can issue the same lookup:
+#   formatted  - the old "%"-formatted SQL string, unique per id
+#   construct  - a Core select() compiled on every execution
+#   compiled   - the statement precompiled once by queries.prepare()
+#
+# run with:
+#   python benchmarks/bench_queries.py [rows] [iterations]
+######################################################################
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(__location__, '..'))
+
+from sqlalchemy import select
+import storage
+import queries
+
+
+def seed(engine, rows):
+    engine.execute(storage.recommendations.insert(),
+                   [{'id': i, 'parent_product_id': i % 1000,
+                     'related_product_id': i, 'type': 'x-sell', 'priority': 5}
+                    for i in range(1, rows + 1)])
+
+
+def bench(name, conn, run, ids):
+    start = time.time()
+    for rec_id in ids:
+        list(run(conn, rec_id))
+    elapsed = time.time() - start
+    print("%-10s %8.1f us/request" % (name, elapsed / len(ids) * 1e6))
+
+
+def formatted(conn, rec_id):
+    return conn.execute("SELECT * FROM recommendations WHERE id=%d" % rec_id)
+
+
+def construct(conn, rec_id):
+    rec = storage.recommendations
+    return conn.execute(select([rec]).where(rec.c.id == rec_id))
+
+
+def compiled(conn, rec_id):
+    return queries.execute(conn, 'select_by_id', rec_id=rec_id)
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'bench.db')
+    engine = storage.create_db_engine('sqlite:///' + path)
+    storage.create_schema(engine)
+    seed(engine, rows)
+    queries.prepare(engine)
+    ids = [random.randint(1, rows) for _ in range(iterations)]
+    conn = engine.connect()
+    print("%d lookups by id over %d rows" % (iterations, rows))
+    for name, run in [('formatted', formatted),
+                      ('construct', construct),
+                      ('compiled', compiled)]:
+        bench(name, conn, run, ids)
+    conn.close()
+    engine.dispose()
+    shutil.rmtree(workdir)
@@ -0,0 +1,73 @@
+######################################################################
+# Benchmark: encoding a recommendation list body
+#
+# Encodes the same rows the way reply() used to (a dict per row, then
+# Flask's json.dumps), through the selected serializer backend from
+# dicts, and straight from the row tuples with serializer.encode_rows.
+#
+# run with:
+#   python benchmarks/bench_serializer.py [rows ...]
+######################################################################
+
+import os
+import sys
+import time
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(__location__, '..'))
+
+import serializer
+from flask import Flask, json
+
+app = Flask(__name__)
+
+
+def row_to_message(rec):
+    return {'id': rec[0],
+            'parent_product_id': rec[1],
+            'related_product_id': rec[2],
+            'type': rec[3],
+            'priority': rec[4]}
+
+
+def flask_dicts(rows):
+    with app.app_context():
+        return json.dumps([row_to_message(rec) for rec in rows])
+
+
+def backend_dicts(rows):
+    return serializer.dumps([row_to_message(rec) for rec in rows])
+
+
+def tuples(rows):
+    return serializer.encode_rows(rows)
+
+
+ENCODERS = [('flask dicts', flask_dicts),
+            ('%s dicts' % serializer.backend, backend_dicts),
+            ('tuples', tuples)]
+
+
+def best_of(encode, rows, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        encode(rows)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    print("backend: %s" % serializer.backend)
+    print("%10s %14s %10s %10s" % ('rows', 'encoder', 'ms', 'speedup'))
+    for size in sizes:
+        rows = [(i, i % 1000, i + 1, ('x-sell', 'up-sell', 'accessory')[i % 3], i % 10 or None)
+                for i in range(1, size + 1)]
+        baseline = None
+        for name, encode in ENCODERS:
+            elapsed = best_of(encode, rows)
+            baseline = baseline or elapsed
+            print("%10d %14s %10.1f %9.1fx" % (size, name, elapsed * 1000, baseline / elapsed))
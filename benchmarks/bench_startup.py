@@ -0,0 +1,90 @@
+######################################################################
+# Benchmark: import to first request
+#
+# Starts a fresh Python process per run that imports server, calls
+# create_app() and serves one GET /recommendations/<id> through the
+# test client, timing each step, then asks for /v1/spec once (built on
+# that request) and once more (served from memory). Runs alternate
+# between DB_LAZY_CONNECT=False, which opens the database and runs the
+# migrations in create_app(), and DB_LAZY_CONNECT=True, which leaves
+# that to the first request. Reports the fastest run of each, in ms.
+#
+# run with:
+#   python benchmarks/bench_startup.py [runs]
+######################################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+ROOT = os.path.join(__location__, '..')
+sys.path.insert(0, ROOT)
+
+MODES = ('False', 'True')
+STEPS = ('import', 'create_app', 'first request', 'import to served', 'spec (first)', 'spec (cached)')
+
+# run in the child, started is its first statement
+CHILD = """
+import time
+started = time.time()
+import json
+import server
+imported = time.time()
+app = server.create_app()
+created = time.time()
+client = app.test_client()
+assert client.get('/recommendations/1').status_code == 200
+served = time.time()
+client.get('/v1/spec')
+spec = time.time()
+client.get('/v1/spec')
+cached = time.time()
+print(json.dumps({'import': imported - started,
+                  'create_app': created - imported,
+                  'first request': served - created,
+                  'import to served': served - started,
+                  'spec (first)': spec - served,
+                  'spec (cached)': cached - spec}))
+"""
+
+
+def seed(path):
+    import storage
+    import dataset
+    engine = storage.create_db_engine('sqlite:///' + path)
+    dataset.load(engine, dataset.generate(1000))
+    engine.dispose()
+
+
+def run(mode, database_uri):
+    env = dict(os.environ, DB_LAZY_CONNECT=mode, DATABASE_URI=database_uri,
+               PYTHONDONTWRITEBYTECODE='1')
+    start = time.time()
+    output = subprocess.check_output([sys.executable, '-c', CHILD], cwd=ROOT, env=env)
+    timings = json.loads(output.splitlines()[-1])
+    # including the interpreter's own startup
+    timings['process'] = time.time() - start
+    return timings
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'bench.db')
+    seed(path)
+    best = dict((mode, {}) for mode in MODES)
+    for number in range(runs):
+        for mode in MODES[::1 if number % 2 else -1]:
+            for step, seconds in run(mode, 'sqlite:///' + path).items():
+                best[mode][step] = min(best[mode].get(step, seconds), seconds)
+    print("%d runs, fastest of each step in ms" % runs)
+    print("%16s %12s %12s" % ('DB_LAZY_CONNECT', 'False', 'True'))
+    for step in STEPS + ('process',):
+        print("%16s %12.1f %12.1f" % (step, best['False'][step] * 1000, best['True'][step] * 1000))
+    shutil.rmtree(workdir)
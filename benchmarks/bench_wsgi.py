@@ -0,0 +1,92 @@
+######################################################################
+# Benchmark: throughput of app.run versus gunicorn workers
+#
+# Seeds a temporary SQLite database from dataset.py, then serves it
+# with python server.py (the single-process development server) and
+# with gunicorn -c gunicorn.conf.py at a growing number of workers of
+# each worker class, threaded (gthread) and, when gevent is installed,
+# gevent. Drives each with the same read-only loadtest.py trace and
+# reports requests/s and latency, which should scale with the workers
+# up to the number of cores.
+#
+# run with:
+#   python benchmarks/bench_wsgi.py [workers ...] [--requests 5000] [--concurrency 64]
+#       [--worker-classes gthread,gevent]
+#   e.g. python benchmarks/bench_wsgi.py 1 2 4 8
+######################################################################
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(__location__, '..'))
+
+import dataset
+import loadtest
+
+ROOT = os.path.join(__location__, '..')
+ROWS = 100000
+ROUTES = ['get', 'list_product', 'list_product_type', 'list_top']
+
+
+def start(path, port, workers, worker_class):
+    """ Starts python server.py without workers, gunicorn with them """
+    env = dict(os.environ, DATABASE_URI='sqlite:///' + path, PORT=str(port))
+    if workers is None:
+        command = [sys.executable, 'server.py']
+    else:
+        env.update(WEB_CONCURRENCY=str(workers), WORKER_CLASS=worker_class)
+        command = [sys.executable, '-m', 'gunicorn.app.wsgiapp', '-c', 'gunicorn.conf.py',
+                   'server:create_app()']
+    return subprocess.Popen(command, cwd=ROOT, env=env,
+                            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    try:
+        import gevent
+        worker_classes = 'gthread,gevent'
+    except ImportError:
+        worker_classes = 'gthread'
+    options = {'--requests': '5000', '--concurrency': '64', '--worker-classes': worker_classes}
+    for name in list(options):
+        if name in args:
+            position = args.index(name)
+            options[name] = args[position + 1]
+            del args[position:position + 2]
+    cores = multiprocessing.cpu_count()
+    sizes = [int(arg) for arg in args] or sorted(set([1, 2, cores, cores * 2 + 1]))
+    concurrency = int(options['--concurrency'])
+    trace = loadtest.build_trace(ROWS, int(options['--requests']), dataset.SEED, ROUTES)
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'bench.db')
+    import storage
+    engine = storage.create_db_engine('sqlite:///' + path)
+    dataset.load(engine, dataset.generate(ROWS))
+    engine.dispose()
+    print("%d cores, %d requests over %d connections" % (cores, len(trace), concurrency))
+    print("%-20s %10s %10s %10s %8s" % ('server', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    runs = [(None, None)] + [(workers, worker_class)
+                             for worker_class in options['--worker-classes'].split(',')
+                             for workers in sizes]
+    for workers, worker_class in runs:
+        port = loadtest.free_port()
+        url = 'http://127.0.0.1:%d' % port
+        child = start(path, port, workers, worker_class)
+        try:
+            loadtest.wait_until_up(url)
+            loadtest.drive(url, trace[:500], concurrency)
+            total = loadtest.drive(url, trace, concurrency)['total']
+        finally:
+            child.terminate()
+            child.wait()
+        name = 'app.run' if workers is None else '%s x%d' % (worker_class, workers)
+        print("%-20s %10.1f %10.2f %10.2f %8d" % (name, total['throughput'], total['p50'],
+                                                   total['p99'], total['errors']))
+    shutil.rmtree(workdir)
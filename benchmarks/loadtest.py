@@ -0,0 +1,368 @@
+######################################################################
+# Load test: throughput and latency of every REST route
+#
+# Seeds a temporary SQLite database from dataset.py, boots the service
+# in a child process on a threaded server, and replays a seeded trace
+# of requests over CONCURRENCY client connections. Every route is
+# in the trace in proportion to its ROUTES weight: the index, the list
+# with each filter (paged when unfiltered or by type only), the batch
+# lookup, get, create, update, delete and clicked. The trace touches
+# disjoint rows for reads, updates and deletes, so every request has
+# one expected status however the workers interleave.
+#
+# Reports requests/s and p50/p95/p99 latency per route and overall,
+# writes them as JSON, and compares them with a baseline: a route
+# whose p50 or p99 grew, or a run whose throughput fell, by more than
+# the tolerance fails the run, as does any unexpected status.
+#
+# run with:
+#   python benchmarks/loadtest.py [--rows 10k] [--requests 5000] [--concurrency 8]
+#       [--routes get,list_product,...] [--seed 42] [--output results.json]
+#       [--baseline benchmarks/loadtest_baseline.json] [--tolerance 0.25]
+#       [--save-baseline] [--record trace.ndjson] [--trace trace.ndjson]
+#       [--url http://host:port]
+# --url drives a running service instead, which must already hold
+# python dataset.py load --rows <rows> --seed <seed>
+######################################################################
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import httplib
+import tempfile
+import threading
+import itertools
+import subprocess
+from bisect import bisect
+from urlparse import urlparse
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(__location__, '..'))
+
+import dataset
+
+BASELINE = os.path.join(__location__, 'loadtest_baseline.json')
+CONCURRENCY = 8
+REQUESTS = 5000
+WARMUP = 200
+TOLERANCE = 0.25
+# routes with fewer samples are too noisy to compare percentiles
+MIN_SAMPLES = 50
+PAGE = 100
+LOOKUP_PRODUCTS = 10
+TYPES = [name for name, weight in dataset.TYPE_MIX]
+
+# name: (weight, method, expected status)
+ROUTES = [('index', 1, 'GET', 200),
+          ('list', 1, 'GET', 200),
+          ('list_type', 1, 'GET', 200),
+          ('list_product', 10, 'GET', 200),
+          ('list_product_type', 3, 'GET', 200),
+          ('list_top', 3, 'GET', 200),
+          ('list_products', 2, 'GET', 200),
+          ('lookup', 1, 'POST', 200),
+          ('get', 10, 'GET', 200),
+          ('create', 2, 'POST', 201),
+          ('update', 2, 'PUT', 200),
+          ('delete', 1, 'DELETE', 204),
+          ('clicked', 3, 'PUT', 200)]
+EXPECTED = dict((name, status) for name, weight, method, status in ROUTES)
+
+
+def build_trace(rows, requests, seed, routes=None):
+    """
+    Returns requests (route, method, path, body) tuples drawn from the
+    ROUTES weights, over the dataset.generate(rows, seed) rows
+    """
+    generator = random.Random(seed)
+    mix = [(name, weight, method) for name, weight, method, status in ROUTES
+           if routes is None or name in routes]
+    cumulative = []
+    total = 0
+    for name, weight, method in mix:
+        total += weight
+        cumulative.append(total)
+    names = [mix[bisect(cumulative, generator.random() * total)] for _ in range(requests)]
+    deletes = sum(1 for name, weight, method in names if name == 'delete')
+    updates = sum(1 for name, weight, method in names if name == 'update')
+    # the last rows are deleted once each, updates rewrite rows of their
+    # own, and everything else reads the rest
+    readable = rows - deletes - updates
+    if readable < 1:
+        raise ValueError('%d rows are too few for %d requests' % (rows, requests))
+    delete_ids = range(readable + updates + 1, rows + 1)
+    update_rows = []
+    products = 0
+    for row in dataset.generate(rows, seed):
+        products = row['parent_product_id']
+        if readable < row['id'] <= readable + updates:
+            update_rows.append(row)
+    trace = []
+    for name, weight, method in names:
+        product = generator.randint(1, products)
+        rec_id = generator.randint(1, readable)
+        rec_type = generator.choice(TYPES)
+        body = None
+        if name == 'index':
+            path = '/'
+        elif name == 'list':
+            path = '/recommendations?limit=%d' % PAGE
+        elif name == 'list_type':
+            path = '/recommendations?type=%s&limit=%d' % (rec_type, PAGE)
+        elif name == 'list_product':
+            path = '/recommendations?product-id=%d' % product
+        elif name == 'list_product_type':
+            path = '/recommendations?product-id=%d&type=%s' % (product, rec_type)
+        elif name == 'list_top':
+            path = '/recommendations?product-id=%d&top=3' % product
+        elif name == 'list_products':
+            path = '/recommendations?product-ids=%s' % ','.join(
+                str(generator.randint(1, products)) for _ in range(LOOKUP_PRODUCTS))
+        elif name == 'lookup':
+            path = '/recommendations/lookup'
+            body = {'product-ids': [generator.randint(1, products) for _ in range(LOOKUP_PRODUCTS)]}
+        elif name == 'get':
+            path = '/recommendations/%d' % rec_id
+        elif name == 'create':
+            path = '/recommendations'
+            # related products past the catalogue never conflict
+            body = {'parent_product_id': product, 'related_product_id': rows + len(trace) + 1,
+                    'type': rec_type, 'priority': generator.randint(1, dataset.MAX_PRIORITY)}
+        elif name == 'update':
+            row = update_rows.pop()
+            path = '/recommendations/%d' % row['id']
+            body = dict((column, row[column]) for column in dataset.COLUMNS if column != 'id')
+            body['priority'] = generator.randint(1, dataset.MAX_PRIORITY)
+        elif name == 'delete':
+            path = '/recommendations/%d' % delete_ids.pop()
+        else:
+            path = '/recommendations/%d/clicked' % rec_id
+        trace.append((name, method, path, json.dumps(body) if body is not None else None))
+    return trace
+
+
+def write_trace(trace, out):
+    for name, method, path, body in trace:
+        out.write(json.dumps({'route': name, 'method': method, 'path': path, 'body': body}))
+        out.write('\n')
+
+
+def read_trace(lines):
+    return [(str(entry['route']), str(entry['method']), str(entry['path']), entry['body'])
+            for entry in dataset.read_ndjson(lines)]
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def summarize(samples, errors, elapsed):
+    samples = sorted(samples)
+    return {'requests': len(samples),
+            'errors': errors,
+            'throughput': len(samples) / elapsed,
+            'p50': percentile(samples, 0.50) * 1000,
+            'p95': percentile(samples, 0.95) * 1000,
+            'p99': percentile(samples, 0.99) * 1000}
+
+
+def drive(url, trace, concurrency):
+    """
+    Replays the trace over concurrency connections, returns the
+    per-route and overall summaries
+    """
+    target = urlparse(url)
+    headers = {'Content-Type': 'application/json'}
+    samples = dict((name, []) for name in EXPECTED)
+    errors = dict((name, 0) for name in EXPECTED)
+    position = itertools.count()
+    lock = threading.Lock()
+
+    def worker():
+        conn = httplib.HTTPConnection(target.hostname, target.port)
+        while True:
+            index = next(position)
+            if index >= len(trace):
+                break
+            name, method, path, body = trace[index]
+            start = time.time()
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                resp.read()
+                status = resp.status
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                status = None
+            # list.append is atomic, the samples need no lock
+            samples[name].append(time.time() - start)
+            if status != EXPECTED[name]:
+                with lock:
+                    errors[name] += 1
+        conn.close()
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    routes = dict((name, summarize(samples[name], errors[name], elapsed))
+                  for name in EXPECTED if samples[name])
+    total = summarize([sample for name in samples for sample in samples[name]],
+                      sum(errors.values()), elapsed)
+    return {'routes': routes, 'total': total}
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """ Returns a message for every regression from the baseline """
+    regressions = []
+    limit = 1 + tolerance
+    if results['total']['throughput'] * limit < baseline['total']['throughput']:
+        regressions.append('throughput %.0f req/s, baseline %.0f req/s' % (
+            results['total']['throughput'], baseline['total']['throughput']))
+    for name, current in sorted(results['routes'].items()):
+        before = baseline['routes'].get(name)
+        if before is None or min(current['requests'], before['requests']) < MIN_SAMPLES:
+            continue
+        for key in ('p50', 'p99'):
+            if current[key] > before[key] * limit:
+                regressions.append('%s %s %.2f ms, baseline %.2f ms' % (
+                    name, key, current[key], before[key]))
+    return regressions
+
+
+def report(results):
+    print("%-18s %8s %7s %9s %9s %9s %9s" % ('route', 'requests', 'errors', 'req/s',
+                                           'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, summary in sorted(results['routes'].items()) + [('total', results['total'])]:
+        print("%-18s %8d %7d %9.1f %9.2f %9.2f %9.2f" % (
+            name, summary['requests'], summary['errors'], summary['throughput'],
+            summary['p50'], summary['p95'], summary['p99']))
+
+
+def serve(path, port):
+    """ Runs in a child process: the service on a threaded server """
+    from werkzeug.serving import run_simple
+    os.environ['DATABASE_URI'] = 'sqlite:///' + path
+    import server
+    server.initialize_mysql()
+    run_simple('127.0.0.1', port, server.app, threaded=True)
+
+
+def wait_until_up(url, timeout=30):
+    target = urlparse(url)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            conn = httplib.HTTPConnection(target.hostname, target.port, timeout=1)
+            conn.request('GET', '/')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return
+        except (httplib.HTTPException, socket.error):
+            if time.time() > deadline:
+                raise
+        time.sleep(0.1)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        serve(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+    args = sys.argv[1:]
+    flags = {'--save-baseline': False}
+    for name in flags:
+        if name in args:
+            flags[name] = True
+            args.remove(name)
+    options = {'--rows': '10k', '--requests': str(REQUESTS), '--concurrency': str(CONCURRENCY),
+               '--routes': None, '--seed': str(dataset.SEED), '--output': None,
+               '--baseline': BASELINE, '--tolerance': str(TOLERANCE),
+               '--record': None, '--trace': None, '--url': None}
+    for name in list(options):
+        if name in args:
+            position = args.index(name)
+            options[name] = args[position + 1]
+            del args[position:position + 2]
+    if args:
+        print("unknown arguments: %s" % ' '.join(args))
+        sys.exit(2)
+    rows = dataset.parse_size(options['--rows'])
+    seed = int(options['--seed'])
+    concurrency = int(options['--concurrency'])
+    routes = options['--routes'].split(',') if options['--routes'] else None
+    if options['--trace']:
+        with open(options['--trace']) as lines:
+            trace = read_trace(lines)
+    else:
+        trace = build_trace(rows, int(options['--requests']), seed, routes)
+    if options['--record']:
+        with open(options['--record'], 'w') as out:
+            write_trace(trace, out)
+
+    workdir = None
+    child = None
+    url = options['--url']
+    try:
+        if url is None:
+            workdir = tempfile.mkdtemp()
+            path = os.path.join(workdir, 'loadtest.db')
+            import storage
+            engine = storage.create_db_engine('sqlite:///' + path)
+            dataset.load(engine, dataset.generate(rows, seed))
+            engine.dispose()
+            port = free_port()
+            url = 'http://127.0.0.1:%d' % port
+            child = subprocess.Popen([sys.executable, __file__, '--serve', path, str(port)],
+                                     stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        wait_until_up(url)
+        # fills the connection pool and the statement caches
+        warmup = [('index', 'GET', '/', None)] * WARMUP
+        drive(url, warmup, concurrency)
+        results = drive(url, trace, concurrency)
+    finally:
+        if child is not None:
+            child.terminate()
+            child.wait()
+        if workdir is not None:
+            shutil.rmtree(workdir)
+
+    results['config'] = {'rows': rows, 'seed': seed, 'requests': len(trace),
+                         'concurrency': concurrency, 'routes': routes, 'url': options['--url']}
+    print("%d requests over %d connections, %d rows" % (len(trace), concurrency, rows))
+    report(results)
+    if options['--output']:
+        with open(options['--output'], 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    failed = results['total']['errors'] > 0
+    if failed:
+        print("%d requests did not get their expected status" % results['total']['errors'])
+    if flags['--save-baseline']:
+        with open(options['--baseline'], 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+        print("saved the baseline to %s" % options['--baseline'])
+    elif os.path.exists(options['--baseline']):
+        with open(options['--baseline']) as lines:
+            regressions = compare(results, json.load(lines), float(options['--tolerance']))
+        for message in regressions:
+            print("REGRESSION %s" % message)
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,311 @@
+######################################################################
+# Read-through cache for product recommendation lists
+#
+# Entries are keyed by (product_id, variant) and hold the serialized
+# JSON body, so a hit skips both the database and json.dumps. The
+# variant names the other query parameters of the list (its type, a
+# top-K limit), None for every recommendation of the product. Writes
+# drop every entry of the parent product they touch.
+#
+# A reader takes a token from the cache before querying the database
+# and passes it back to set(); if an invalidation of that product ran
+# in between, the body may predate that write and is not stored.
+#
+# Every invalidation also bumps the product's version, which the HTTP
+# layer turns into ETags, so a client revalidating an unchanged list
+# is answered without touching the database or the cached body. The
+# versions of LRUCache are only seen by its own process, so they can
+# only be trusted when the service runs as a single process.
+#
+# Two backends implement the same interface: LRUCache lives in the
+# process, RedisCache is shared by every instance of the service.
+######################################################################
+
+import os
+import time
+import random
+from threading import Lock, Thread
+from collections import OrderedDict
+
+CACHE_SIZE = 1024
+CACHE_TTL = 60
+# Version counters of the in-process cache, products share them by hash
+VERSION_BUCKETS = 65536
+INVALIDATION_CHANNEL = 'recommendations:invalidate'
+
+
+class CacheBackend(object):
+    """ The interface every recommendation list cache implements """
+
+    # whether every process of the service sees the same versions
+    shared = False
+
+    def get(self, product_id, variant=None):
+        """ Returns the cached body or None """
+        raise NotImplementedError
+
+    def token(self, product_id):
+        """ Returns the token a reader must pass back to set() """
+        raise NotImplementedError
+
+    def set(self, product_id, variant, body, token=None):
+        """ Stores a body unless the product was invalidated since token """
+        raise NotImplementedError
+
+    def version(self, product_id):
+        """ Returns a string that changes whenever the product is invalidated """
+        raise NotImplementedError
+
+    def lookup(self, product_id, variant=None):
+        """
+        Returns the cached body or None, the version of the product and
+        a token for set(), the version and token read before the body
+        """
+        token = self.token(product_id)
+        version = self.version(product_id)
+        return self.get(product_id, variant), version, token
+
+    def invalidate(self, product_id):
+        """ Drops every cached list of the given parent product """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """ A bounded, thread-safe LRU cache whose entries expire after a TTL """
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        # product_id -> set of keys, so invalidation never scans the cache
+        self.products = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        # a product's version can collide with others in its bucket, which
+        # only costs a spurious change; the epoch keeps versions handed
+        # out before a restart from matching the reset counters
+        self.versions = [0] * VERSION_BUCKETS
+        self.epoch = '%08x' % random.getrandbits(32)
+
+    def get(self, product_id, variant=None):
+        key = (product_id, variant)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            body, expires = entry
+            if expires <= self.clock():
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+            # move to the most recently used end
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return body
+
+    def token(self, product_id):
+        return self.generation
+
+    def set(self, product_id, variant, body, token=None):
+        if self.maxsize <= 0:
+            return
+        key = (product_id, variant)
+        with self.lock:
+            if token is not None and token != self.generation:
+                return
+            if key in self.entries:
+                del self.entries[key]
+            self.entries[key] = (body, self.clock() + self.ttl)
+            self.products.setdefault(product_id, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def version(self, product_id):
+        return '%s.%d' % (self.epoch, self.versions[hash(product_id) % VERSION_BUCKETS])
+
+    def invalidate(self, product_id):
+        with self.lock:
+            self.generation += 1
+            self.versions[hash(product_id) % VERSION_BUCKETS] += 1
+            for key in list(self.products.get(product_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.products.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'backend': 'memory',
+                    'size': len(self.entries),
+                    'maxsize': self.maxsize,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        keys = self.products.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.products[key[0]]
+
+
+class RedisCache(CacheBackend):
+    """
+    A cache shared by every instance through a Redis server
+
+    Each product is one Redis hash with a field per type, so a hit is a
+    single HGET and invalidation a single DEL. Invalidations are also
+    published, letting every instance drop its optional in-process
+    near cache of hot products, whose entries keep the generation they
+    were read with.
+    """
+
+    shared = True
+
+    def __init__(self, client, ttl=CACHE_TTL, local=None,
+                 prefix='recommendations', channel=INVALIDATION_CHANNEL):
+        self.client = client
+        self.ttl = ttl
+        self.local = local
+        self.prefix = prefix
+        self.channel = channel
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, product_id, variant=None):
+        return self.lookup(product_id, variant)[0]
+
+    def lookup(self, product_id, variant=None):
+        if self.local is not None:
+            entry = self.local.get(product_id, variant)
+            if entry is not None:
+                body, generation = entry
+                return body, str(generation), generation
+            # an invalidation published during the read drops the entry
+            local_token = self.local.token(product_id)
+        # the generation and the body in one round trip, read together
+        pipe = self.client.pipeline()
+        pipe.get(self._generation(product_id))
+        pipe.hget(self._key(product_id), self._field(variant))
+        generation, body = pipe.execute()
+        generation = int(generation or 0)
+        with self.lock:
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if body is not None:
+            body = _text(body)
+            if self.local is not None:
+                self.local.set(product_id, variant, (body, generation), local_token)
+        return body, str(generation), generation
+
+    def token(self, product_id):
+        return int(self.client.get(self._generation(product_id)) or 0)
+
+    def version(self, product_id):
+        # the generation is shared, so every instance hands out the same one
+        return str(self.token(product_id))
+
+    def set(self, product_id, variant, body, token=None):
+        key = self._key(product_id)
+        self.client.hset(key, self._field(variant), body)
+        self.client.expire(key, int(self.ttl))
+        # checked after the write: an invalidation that bumps the
+        # generation later will also delete what was just stored
+        if token is not None and self.token(product_id) != token:
+            self.client.hdel(key, self._field(variant))
+
+    def invalidate(self, product_id):
+        self.client.incr(self._generation(product_id))
+        self.client.delete(self._key(product_id))
+        if self.local is not None:
+            self.local.invalidate(product_id)
+        self.client.publish(self.channel, str(product_id))
+
+    def clear(self):
+        for key in self.client.keys(self.prefix + ':list:*'):
+            self.client.delete(key)
+        if self.local is not None:
+            self.local.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = {'backend': 'redis',
+                     'ttl': self.ttl,
+                     'hits': self.hits,
+                     'misses': self.misses}
+        if self.local is not None:
+            stats['local'] = self.local.stats()
+        return stats
+
+    def handle_message(self, message):
+        """ Drops a product another instance invalidated from the near cache """
+        if message.get('type') == 'message' and self.local is not None:
+            self.local.invalidate(int(message['data']))
+
+    def listen(self):
+        """ Starts a daemon thread applying published invalidations """
+        pubsub = self.client.pubsub()
+        pubsub.subscribe(self.channel)
+
+        def run():
+            for message in pubsub.listen():
+                self.handle_message(message)
+        thread = Thread(target=run, name='cache-invalidations')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _key(self, product_id):
+        return '%s:list:%s' % (self.prefix, product_id)
+
+    def _generation(self, product_id):
+        return '%s:gen:%s' % (self.prefix, product_id)
+
+    def _field(self, variant):
+        return '*' if variant is None else variant
+
+
+def _text(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def create_cache():
+    """ Builds the cache backend selected by the environment """
+    ttl = float(os.getenv('CACHE_TTL', CACHE_TTL))
+    if os.getenv('CACHE_BACKEND', 'memory') == 'redis':
+        import redis
+        client = redis.StrictRedis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+        local = None
+        local_size = int(os.getenv('CACHE_LOCAL_SIZE', '0'))
+        if local_size > 0:
+            local = LRUCache(maxsize=local_size, ttl=ttl)
+        backend = RedisCache(client, ttl=ttl, local=local)
+        if local is not None:
+            backend.listen()
+        return backend
+    return LRUCache(maxsize=int(os.getenv('CACHE_SIZE', CACHE_SIZE)), ttl=ttl)
@@ -0,0 +1,486 @@
+######################################################################
+# Change log of the recommendation mutations
+#
+# Every create, update, delete and click the service commits is
+# appended to a log on disk, one JSON object per line, numbered by a
+# seq that grows by one with every change. Consumers read it from the
+# seq they last saw with GET /recommendations/changes?since=<seq>
+# rather than rereading every recommendation.
+#
+# The log is a directory of segment files named by the seq of their
+# first change. Appends go to the newest segment, and once it holds
+# segment_bytes a new one is started; only the newest
+# retain_segments segments are kept. Lines are only ever appended.
+#
+# The processes of one machine share the directory: an append takes
+# an exclusive flock on the lock file, first reads what the others
+# appended since, then writes at the end of the newest segment. Each
+# process keeps the last memory changes it wrote or read in memory,
+# older ones are read from the segments.
+#
+# A process that dies while writing leaves a torn last line behind.
+# It holds no seq, and the next append cuts it off before writing.
+#
+# A write and the append of its change are two steps, so two writes
+# of one id could be logged in the other order from their commits.
+# Writers hold serialized(ids) around both: ids are spread over lock
+# stripes, each a thread lock and a byte of the lock file, taken in
+# order so every process agrees.
+#
+# A process that dies between the commit and the append would lose the
+# change. Writers mark their ids pending first, in a journal of their
+# own process that it holds an flock on while it lives, and clear them
+# once the change is appended. recover() finds the journals of dead
+# processes and logs the current state of every id left pending in
+# them: an update with the row if it exists, a delete if it is gone. A
+# change may so be logged twice, never lost.
+######################################################################
+
+import os
+import re
+import time
+import fcntl
+import logging
+import tempfile
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice, count
+from threading import Lock, Condition
+from serializer import encode_row
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+CLICKED = 'clicked'
+OPS = (CREATE, UPDATE, DELETE, CLICKED)
+
+SEGMENT_BYTES = 16 * 1024 * 1024
+RETAIN_SEGMENTS = 8
+# changes kept in memory by each process
+MEMORY_CHANGES = 10000
+# seconds between looks for changes appended by other processes
+POLL_INTERVAL = 0.1
+# seconds a long-poll may wait, and an empty line is streamed after
+MAX_WAIT = 30
+HEARTBEAT_SECONDS = 10
+# changes read at a time by a stream
+STREAM_CHUNK = 1000
+# locks the ids of the writes are spread over
+LOCK_STRIPES = 1024
+
+SEGMENT_SUFFIX = '.log'
+JOURNAL_PREFIX = 'pending-'
+# seq first, so it can be read off a line without decoding it
+LINE_TEMPLATE = '{"seq": %d, "time": %.3f, "op": "%s", "id": %d, "parent_product_id": %d%s}'
+LINE_CHANGE = re.compile(r'"op": "(\w+)", "id": (\d+), "parent_product_id": (\d+)')
+
+logger = logging.getLogger(__name__)
+
+
+class ChangesGoneError(Exception):
+    """ The changes after a seq are not in the log (any more) """
+    pass
+
+
+def seq_of(line):
+    return int(line[8:line.index(',')])
+
+
+def pending_ids(journal):
+    """ The ids of the marks a journal has not cleared """
+    marks = {}
+    for line in journal.split('\n')[:-1]:
+        if line.startswith('+'):
+            token, ids = line[1:].split(' ', 1)
+            marks.setdefault(token, set()).update(int(id) for id in ids.split(','))
+        elif line.startswith('-'):
+            marks.pop(line[1:], None)
+    return sorted(set().union(*marks.values()))
+
+
+def segment_name(first_seq):
+    return '%020d%s' % (first_seq, SEGMENT_SUFFIX)
+
+
+class ChangeLog(object):
+    """ The segments of the log in a directory, appended to and read """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, retain_segments=RETAIN_SEGMENTS,
+                 fsync=True, memory=MEMORY_CHANGES, poll_interval=POLL_INTERVAL, clock=time.time):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retain_segments = retain_segments
+        self.fsync = fsync
+        self.poll_interval = poll_interval
+        self.clock = clock
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock_file = open(os.path.join(directory, 'lock'), 'a')
+        self.lock = Lock()
+        self.appended = Condition(self.lock)
+        self.stripes = [Lock() for _ in range(LOCK_STRIPES)]
+        # the journal of the ids this process marked pending, opened on
+        # the first mark, and the marks not cleared yet
+        self.journal = None
+        self.journal_path = None
+        self.journal_pid = None
+        self.journal_lock = Lock()
+        self.marks = count(1)
+        self.open_marks = 0
+        # the lines of the last changes up to last_seq, oldest first
+        self.recent = deque(maxlen=memory)
+        self.segment = None
+        self.last_seq = 0
+        self.position = 0
+        self._open_newest()
+
+    def segments(self):
+        """ The first seqs of the segments on disk, oldest first """
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def append(self, op, rows):
+        """
+        Appends one change per row and returns the seq of the last.
+        Rows are recommendation rows for creates and updates, and
+        (id, parent_product_id) pairs for deletes and clicks.
+        """
+        if op not in OPS:
+            raise ValueError('op must be one of %s' % ', '.join(OPS))
+        if not rows:
+            return None
+        now = self.clock()
+        with self.lock:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                self._follow()
+                if os.fstat(self.segment.fileno()).st_size > self.position:
+                    logger.warning('Dropping the torn last line of %s', self.segment.name)
+                    self.segment.truncate(self.position)
+                if self.position >= self.segment_bytes:
+                    self._rotate()
+                lines = []
+                for row in rows:
+                    rec = ', "recommendation": ' + encode_row(row) if op in (CREATE, UPDATE) else ''
+                    lines.append(LINE_TEMPLATE % (self.last_seq + len(lines) + 1, now, op,
+                                                  row[0], row[1], rec))
+                data = '\n'.join(lines) + '\n'
+                self.segment.seek(0, os.SEEK_END)
+                self.segment.write(data)
+                self.segment.flush()
+                if self.fsync:
+                    os.fsync(self.segment.fileno())
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.position += len(data)
+            self.last_seq += len(lines)
+            self.recent.extend(lines)
+            self.appended.notify_all()
+            return self.last_seq
+
+    @contextmanager
+    def serialized(self, ids=None):
+        """
+        Holds off the writes of ids, or of every id, in every thread and
+        process of the log, so the changes of an id are appended in the
+        order their writes committed in
+        """
+        if ids is None:
+            stripes = range(LOCK_STRIPES)
+        else:
+            stripes = sorted(set(id % LOCK_STRIPES for id in ids))
+        held = []
+        try:
+            for stripe in stripes:
+                self.stripes[stripe].acquire()
+                held.append(stripe)
+                # one byte of the lock file per stripe, apart from the
+                # flock the appends take on the whole file
+                fcntl.lockf(self.lock_file, fcntl.LOCK_EX, 1, stripe, os.SEEK_SET)
+            yield
+        finally:
+            for stripe in reversed(held):
+                try:
+                    fcntl.lockf(self.lock_file, fcntl.LOCK_UN, 1, stripe, os.SEEK_SET)
+                finally:
+                    self.stripes[stripe].release()
+
+    @contextmanager
+    def pending(self):
+        """
+        Yields a function that marks ids pending, to be called before
+        their write commits; the marks are cleared on leaving, once the
+        changes are appended
+        """
+        token = next(self.marks)
+        marked = []
+        def mark(ids):
+            ids = list(ids)
+            if ids:
+                self._journal_write('+%d %s\n' % (token, ','.join(str(id) for id in ids)),
+                                    opened=not marked)
+                marked.append(token)
+        try:
+            yield mark
+        finally:
+            if marked:
+                self._journal_clear(token)
+
+    def recover(self, current):
+        """
+        Logs the current state of the ids pending in the journals of
+        dead processes. current returns the rows of a list of ids that
+        exist.
+        """
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.startswith(JOURNAL_PREFIX) or \
+               (self.journal is not None and path == self.journal_path):
+                continue
+            try:
+                journal = open(path, 'rb')
+            except IOError:
+                # recovered by another process
+                continue
+            with journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # its process is alive
+                    continue
+                if not os.path.exists(path):
+                    continue
+                ids = pending_ids(journal.read())
+                if ids:
+                    logger.warning('Recovering the changes of %d ids pending in %s', len(ids), name)
+                    self._recover(ids, current)
+                os.remove(path)
+
+    def read(self, since, limit):
+        """
+        Returns the lines of at most limit changes after since, raises
+        ChangesGoneError when since is not a seq of the log
+        """
+        with self.lock:
+            self._follow()
+            last_seq = self.last_seq
+            oldest = last_seq - len(self.recent) + 1
+            if since > last_seq:
+                raise ChangesGoneError('the log has no change %d, the last is %d' % (since, last_seq))
+            if since + 1 >= oldest:
+                start = since + 1 - oldest
+                return list(islice(self.recent, start, start + limit))
+        return self._scan(since, limit, last_seq)
+
+    def wait(self, since, timeout):
+        """ Waits up to timeout seconds for a change after since """
+        deadline = time.time() + timeout
+        with self.lock:
+            while True:
+                self._follow()
+                if self.last_seq > since:
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                # woken by an append of this process, polls for the others
+                self.appended.wait(min(remaining, self.poll_interval))
+
+    def follow(self, since, seconds, heartbeat=HEARTBEAT_SECONDS):
+        """
+        Yields the changes after since as ndjson chunks while they are
+        appended, for seconds, and an empty line after heartbeat
+        seconds without any
+        """
+        end = time.time() + seconds
+        while True:
+            lines = self.read(since, STREAM_CHUNK)
+            if lines:
+                since = seq_of(lines[-1])
+                yield '\n'.join(lines) + '\n'
+            remaining = end - time.time()
+            if remaining <= 0:
+                return
+            if not lines and not self.wait(since, min(remaining, heartbeat)):
+                yield '\n'
+
+    def stats(self):
+        with self.lock:
+            self._follow()
+            last_seq = self.last_seq
+        segments = self.segments()
+        return {'last_seq': last_seq,
+                'first_seq': segments[0] if segments else last_seq + 1,
+                'segments': len(segments),
+                'in_memory': len(self.recent)}
+
+    def close(self):
+        with self.lock:
+            self.segment.close()
+            self.lock_file.close()
+        with self.journal_lock:
+            if self.journal is not None and self.journal_pid == os.getpid():
+                if not self.open_marks:
+                    os.remove(self.journal_path)
+                self.journal.close()
+            self.journal = None
+
+    def _journal_write(self, line, opened):
+        with self.journal_lock:
+            if self.journal is None or self.journal_pid != os.getpid():
+                # a forked process keeps a journal of its own
+                if self.journal is not None:
+                    self.journal.close()
+                fd, path = tempfile.mkstemp(prefix=JOURNAL_PREFIX, dir=self.directory)
+                self.journal = os.fdopen(fd, 'ab')
+                self.journal_path = path
+                self.journal_pid = os.getpid()
+                self.open_marks = 0
+                fcntl.flock(self.journal, fcntl.LOCK_EX)
+            self.journal.write(line)
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
+            if opened:
+                self.open_marks += 1
+
+    def _journal_clear(self, token):
+        with self.journal_lock:
+            if self.journal is None or self.journal_pid != os.getpid():
+                return
+            self.open_marks -= 1
+            # a lost clear only logs the ids again, so it is not fsynced
+            if self.open_marks:
+                self.journal.write('-%d\n' % token)
+                self.journal.flush()
+            else:
+                self.journal.truncate(0)
+
+    def _recover(self, ids, current):
+        """ Appends an update or a delete for each of ids, as they are now """
+        with self.serialized(ids):
+            rows = dict((row[0], row) for row in current(ids))
+            gone = self._last_changes([id for id in ids if id not in rows])
+            self.append(UPDATE, [rows[id] for id in sorted(rows)])
+            # an id never logged or already deleted needs nothing, one
+            # whose changes were dropped cannot be told from those
+            self.append(DELETE, [(id, parent_product_id)
+                                 for id, (op, parent_product_id) in sorted(gone.items())
+                                 if op != DELETE])
+
+    def _last_changes(self, ids):
+        """ Maps each of ids to the op and parent product of its last change on disk """
+        last = {}
+        wanted = set(ids)
+        if not wanted:
+            return last
+        for first_seq in self.segments():
+            try:
+                segment = open(self._path(first_seq), 'rb')
+            except IOError:
+                # dropped by a rotation in another process
+                continue
+            with segment:
+                for line in segment:
+                    match = LINE_CHANGE.search(line)
+                    if match and int(match.group(2)) in wanted:
+                        last[int(match.group(2))] = (match.group(1), int(match.group(3)))
+        return last
+
+    def _path(self, first_seq):
+        return os.path.join(self.directory, segment_name(first_seq))
+
+    def _open_newest(self):
+        """ Opens the newest segment and finds the last seq in it """
+        segments = self.segments()
+        if not segments:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                # another process may have created it in the meantime
+                segments = self.segments() or [1]
+                self._open(segments[-1])
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        else:
+            self._open(segments[-1])
+        # the last complete line is in the tail, lines are short
+        size = os.fstat(self.segment.fileno()).st_size
+        tail = 65536
+        while True:
+            start = max(0, size - tail)
+            self.segment.seek(start)
+            data = self.segment.read(size - start)
+            end = data.rfind('\n') + 1
+            lines = data[:end].splitlines()
+            if start == 0 or len(lines) > 1:
+                break
+            tail *= 4
+        if start > 0:
+            # the first line read may start in the middle
+            lines = lines[1:]
+        if lines:
+            self.last_seq = seq_of(lines[-1])
+        self.position = start + end
+
+    def _open(self, first_seq):
+        self.segment = open(self._path(first_seq), 'a+b')
+        self.first_seq = first_seq
+        self.last_seq = first_seq - 1
+        self.position = 0
+
+    def _follow(self):
+        """ Reads the changes appended by other processes """
+        while True:
+            self.segment.seek(self.position)
+            data = self.segment.read()
+            # a line without its newline is still being written
+            end = data.rfind('\n') + 1
+            if end:
+                lines = data[:end].splitlines()
+                self.recent.extend(lines)
+                self.last_seq += len(lines)
+                self.position += end
+            # another process started the next segment
+            if self.last_seq + 1 == self.first_seq or not os.path.exists(self._path(self.last_seq + 1)):
+                return
+            self.segment.close()
+            self._open(self.last_seq + 1)
+
+    def _rotate(self):
+        """ Starts a new segment and drops the oldest beyond retain_segments """
+        self.segment.close()
+        self._open(self.last_seq + 1)
+        if self.fsync:
+            # the new file is only durable once its directory entry is
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        for first_seq in self.segments()[:-self.retain_segments]:
+            os.remove(self._path(first_seq))
+
+    def _scan(self, since, limit, last_seq):
+        """ Reads the changes after since from the segments """
+        segments = self.segments()
+        if not segments or since + 1 < segments[0]:
+            raise ChangesGoneError('the changes after %d were dropped from the log' % since)
+        start = [first_seq for first_seq in segments if first_seq <= since + 1][-1]
+        lines = []
+        for first_seq in segments[segments.index(start):]:
+            try:
+                segment = open(self._path(first_seq), 'rb')
+            except IOError:
+                # dropped by a rotation in another process
+                raise ChangesGoneError('the changes after %d were dropped from the log' % since)
+            with segment:
+                for line in segment:
+                    if not line.endswith('\n'):
+                        break
+                    seq = seq_of(line)
+                    if seq <= since:
+                        continue
+                    if seq > last_seq or len(lines) == limit:
+                        return lines
+                    lines.append(line[:-1])
+        return lines
@@ -0,0 +1,179 @@
+######################################################################
+# Batched click-priority updates
+#
+# PUT /recommendations/<id>/clicked only appends to an in-memory queue
+# in batched mode. Clicks on the same recommendation are coalesced into
+# a count and a background worker writes them with one executemany of
+# the clicked_batch UPDATE, once the queue holds enough ids, once the
+# flush interval passes, and when the process shuts down.
+#
+# With CLICK_EVENTS=True every click is also kept as an event for the
+# co-click job, queued and appended the same way by ClickEventLog.
+######################################################################
+
+import logging
+from datetime import datetime
+from threading import Lock, Thread, Event
+import queries
+import storage
+
+FLUSH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class ClickBatcher(object):
+    """ Coalesces clicks per recommendation id and flushes them in bulk """
+
+    def __init__(self, engine, flush_size=FLUSH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, on_flush=None, serialize=None):
+        self.engine = engine
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        # called after the commit with an (id, parent product id) pair
+        # for every click written
+        self.on_flush = on_flush
+        # a context manager held around the write and on_flush, given
+        # the ids written
+        self.serialize = serialize
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.pending = {}
+        self.parents = {}
+        self.wakeup = Event()
+        self.stopped = Event()
+        self.worker = None
+
+    def start(self):
+        self.worker = Thread(target=self._run, name='click-batcher')
+        self.worker.daemon = True
+        self.worker.start()
+        return self
+
+    def stop(self):
+        """ Stops the worker after writing every queued click """
+        self.stopped.set()
+        self.wakeup.set()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+        self.flush()
+
+    def click(self, rec_id, parent_product_id):
+        with self.lock:
+            self.pending[rec_id] = self.pending.get(rec_id, 0) + 1
+            self.parents[rec_id] = parent_product_id
+            full = len(self.pending) >= self.flush_size
+        if full:
+            self.wakeup.set()
+
+    def flush(self):
+        """ Writes the queued clicks, returns the number of ids updated """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                parents, self.parents = self.parents, {}
+            if not pending:
+                return 0
+            if self.serialize is None:
+                return self._write(pending, parents)
+            with self.serialize(pending.keys()):
+                return self._write(pending, parents)
+
+    def _write(self, pending, parents):
+        """ Writes the clicks with one executemany and hands them to on_flush """
+        params = [{'rec_id': rec_id, 'clicks': clicks}
+                  for rec_id, clicks in pending.items()]
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(queries.compiled['clicked_batch'], params)
+        except Exception:
+            logger.exception('Click flush failed, requeueing %d ids', len(pending))
+            with self.lock:
+                for rec_id, clicks in pending.items():
+                    self.pending[rec_id] = self.pending.get(rec_id, 0) + clicks
+                    self.parents.setdefault(rec_id, parents[rec_id])
+            return 0
+        if self.on_flush is not None:
+            try:
+                self.on_flush([(rec_id, parents[rec_id])
+                               for rec_id, clicks in sorted(pending.items())
+                               for _ in range(clicks)])
+            except Exception:
+                # the clicks are written, so they are not requeued
+                logger.exception('Click flush callback failed for %d ids', len(pending))
+        return len(pending)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+
+class ClickEventLog(object):
+    """
+    Queues click events and appends them to the click_events table in
+    the background, so recording a click adds no round trip to it
+    """
+
+    def __init__(self, engine, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.engine = engine
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.pending = []
+        self.wakeup = Event()
+        self.stopped = Event()
+        self.worker = None
+
+    def start(self):
+        self.worker = Thread(target=self._run, name='click-events')
+        self.worker.daemon = True
+        self.worker.start()
+        return self
+
+    def stop(self):
+        """ Stops the worker after writing every queued event """
+        self.stopped.set()
+        self.wakeup.set()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+        self.flush()
+
+    def record(self, rec_id, parent_product_id, session=None):
+        event = {'recommendation_id': rec_id,
+                 'parent_product_id': parent_product_id,
+                 'session': session,
+                 'clicked_at': datetime.utcnow()}
+        with self.lock:
+            self.pending.append(event)
+            full = len(self.pending) >= self.flush_size
+        if full:
+            self.wakeup.set()
+
+    def flush(self):
+        """ Writes the queued events, returns how many were written """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return 0
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(storage.click_events.insert(), pending)
+            except Exception:
+                logger.exception('Click event flush failed, requeueing %d events', len(pending))
+                with self.lock:
+                    self.pending[:0] = pending
+                return 0
+            return len(pending)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
@@ -0,0 +1,253 @@
+######################################################################
+# Item-to-item co-click recommendations
+#
+# An offline job over the click_events table. Every session is a
+# basket of the products it interacted with: the parent product of
+# each clicked recommendation and the related product clicked. A click
+# without a session is a basket of just that pair. With B the sparse
+# basket x product incidence matrix, B.T * B counts how many baskets
+# every pair of products shares. The similarity of two products is
+# their cosine, the shared count over the geometric mean of their
+# basket counts, and each product keeps its top K most similar.
+#
+# B.T * B is computed a chunk of products at a time and pruned to the
+# top K before the next chunk, so memory is bounded by the chunk, not
+# by the square of the catalogue. The results are written back as
+# recommendations of type co-click, ranked 1 (most similar) to K,
+# replacing the previous run one chunk of parent products at a time.
+#
+# The job writes to the database directly, not through the service:
+# its rows are not in the change log, and it refuses to run against
+# sharded recommendations (SHARD_URIS), whose ids the service hands
+# out. The parents of every chunk are invalidated once it commits, as
+# a write of the service would: in the Redis cache with
+# CACHE_BACKEND=redis, otherwise through POST /admin/cache/invalidate
+# of the service at --service, which drops the in-process lists and
+# changes their ETags. Without either the job refuses to run, as a
+# single-process service would answer 304 to the previous lists.
+#
+# run with:
+#   python cooccurrence.py [database url] [--service URL] [--top K]
+#                          [--min-count N] [--chunk-size N] [--days N]
+# the url defaults to DATABASE_URI, the service to SERVICE_URL
+######################################################################
+
+import os
+import sys
+import time
+import json
+import urllib2
+import logging
+from array import array
+from datetime import datetime, timedelta
+from sqlalchemy import select, and_
+import storage
+import cache
+
+COCLICK_TYPE = 'co-click'
+TOP_K = 10
+# pairs seen in fewer baskets are noise, not similarity
+MIN_COUNT = 2
+CHUNK_SIZE = 10000
+# a session with more products than this is a crawler, not a shopper,
+# and would add MAX_BASKET ** 2 pairs
+MAX_BASKET = 100
+WRITE_CHUNK_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+rec = storage.recommendations
+events = storage.click_events
+
+
+def read_baskets(engine, since=None):
+    """
+    Streams the click events and returns two parallel arrays, the
+    basket and the product id of every (basket, product) incidence
+    """
+    query = select([events.c.session, events.c.parent_product_id, rec.c.related_product_id]) \
+        .select_from(events.join(rec, rec.c.id == events.c.recommendation_id))
+    if since is not None:
+        query = query.where(events.c.clicked_at >= since)
+    baskets = array('l')
+    products = array('l')
+    sessions = {}
+    next_basket = 0
+    conn = engine.connect()
+    try:
+        results = conn.execution_options(stream_results=True).execute(query)
+        for session, parent_product_id, related_product_id in results:
+            basket = sessions.get(session)
+            if basket is None:
+                basket = next_basket
+                next_basket += 1
+                if session is not None:
+                    sessions[session] = basket
+            baskets.extend((basket, basket))
+            products.extend((parent_product_id, related_product_id))
+    finally:
+        conn.close()
+    return baskets, products
+
+
+def incidence_matrix(baskets, products, max_basket=MAX_BASKET):
+    """
+    Returns the binary basket x product CSR matrix and the product id
+    of every column
+    """
+    import numpy as np
+    from scipy import sparse
+    basket_index = np.asarray(baskets, dtype=np.int64)
+    product_ids, product_index = np.unique(np.asarray(products, dtype=np.int64), return_inverse=True)
+    shape = (int(basket_index.max()) + 1 if len(basket_index) else 0, len(product_ids))
+    matrix = sparse.csr_matrix((np.ones(len(basket_index), dtype=np.float32),
+                                (basket_index, product_index)), shape=shape)
+    # repeated clicks of a product in one session count once
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    sizes = np.diff(matrix.indptr)
+    if max_basket and (sizes > max_basket).any():
+        keep = np.repeat(sizes <= max_basket, sizes)
+        matrix.data[~keep] = 0
+        matrix.eliminate_zeros()
+    return matrix, product_ids
+
+
+def similar_products(matrix, top_k=TOP_K, min_count=MIN_COUNT, chunk_size=CHUNK_SIZE):
+    """
+    Yields (product index, column indexes, similarities) with the top K
+    most similar products of every product that has any, best first
+    """
+    import numpy as np
+    by_product = matrix.T.tocsr()
+    counts = np.asarray(matrix.sum(axis=0)).ravel()
+    for start in range(0, matrix.shape[1], chunk_size):
+        shared = (by_product[start:start + chunk_size] * matrix).tocsr()
+        for row in range(shared.shape[0]):
+            product = start + row
+            begin, end = shared.indptr[row], shared.indptr[row + 1]
+            columns = shared.indices[begin:end]
+            together = shared.data[begin:end]
+            keep = (columns != product) & (together >= min_count)
+            if not keep.any():
+                continue
+            columns, together = columns[keep], together[keep]
+            scores = together / np.sqrt(counts[product] * counts[columns])
+            if len(scores) > top_k:
+                best = np.argpartition(-scores, top_k)[:top_k]
+                columns, scores = columns[best], scores[best]
+            # best first, ties broken by product for a stable ranking
+            order = np.lexsort((columns, -scores))
+            yield product, columns[order], scores[order]
+
+
+def write_recommendations(engine, product_ids, similar, chunk_size=WRITE_CHUNK_SIZE, invalidate=None):
+    """
+    Replaces the co-click recommendations with the similar products,
+    one transaction per chunk of parent products, and deletes those of
+    parents that have none any more. invalidate is called with the
+    parents of every chunk once it commits. Returns the number of rows
+    written.
+    """
+    written = 0
+    parents = set()
+    chunk = []
+    for product, columns, scores in similar:
+        parent_product_id = int(product_ids[product])
+        parents.add(parent_product_id)
+        chunk.append((parent_product_id, [int(product_ids[column]) for column in columns]))
+        if len(chunk) == chunk_size:
+            written += _replace(engine, chunk, invalidate)
+            chunk = []
+    if chunk:
+        written += _replace(engine, chunk, invalidate)
+    stale = [row[0] for row in engine.execute(
+        select([rec.c.parent_product_id]).where(rec.c.type == COCLICK_TYPE).distinct())
+        if row[0] not in parents]
+    for start in range(0, len(stale), chunk_size):
+        _replace(engine, [(parent_product_id, []) for parent_product_id in stale[start:start + chunk_size]],
+                 invalidate)
+    return written
+
+
+def _replace(engine, chunk, invalidate=None):
+    rows = [{'parent_product_id': parent_product_id, 'related_product_id': related_product_id,
+             'type': COCLICK_TYPE, 'priority': rank}
+            for parent_product_id, related in chunk
+            for rank, related_product_id in enumerate(related, 1)]
+    with engine.begin() as conn:
+        conn.execute(rec.delete().where(and_(
+            rec.c.type == COCLICK_TYPE,
+            rec.c.parent_product_id.in_([parent_product_id for parent_product_id, _ in chunk]))))
+        if rows:
+            conn.execute(rec.insert(), rows)
+    if invalidate is not None:
+        invalidate([parent_product_id for parent_product_id, _ in chunk])
+    return len(rows)
+
+
+def cache_invalidator(list_cache):
+    """ Invalidates products in a cache shared with the service """
+    def invalidate(product_ids):
+        for product_id in product_ids:
+            list_cache.invalidate(product_id)
+    return invalidate
+
+
+def service_invalidator(url, timeout=30):
+    """ Invalidates products through the admin endpoint of the service at url """
+    def invalidate(product_ids):
+        request = urllib2.Request(url.rstrip('/') + '/admin/cache/invalidate',
+                                  json.dumps({'product-ids': product_ids}),
+                                  {'Content-Type': 'application/json'})
+        urllib2.urlopen(request, timeout=timeout).read()
+    return invalidate
+
+
+def run(engine, top_k=TOP_K, min_count=MIN_COUNT, chunk_size=CHUNK_SIZE, days=None, invalidate=None):
+    """ Recomputes every co-click recommendation, returns rows written """
+    start = time.time()
+    since = datetime.utcnow() - timedelta(days=days) if days else None
+    baskets, products = read_baskets(engine, since)
+    matrix, product_ids = incidence_matrix(baskets, products)
+    logger.info('Read %d baskets of %d products in %.1fs',
+                matrix.shape[0], matrix.shape[1], time.time() - start)
+    similar = similar_products(matrix, top_k, min_count, chunk_size)
+    written = write_recommendations(engine, product_ids, similar, invalidate=invalidate)
+    logger.info('Wrote %d co-click recommendations in %.1fs', written, time.time() - start)
+    return written
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv[1:]
+    options = {}
+    for name, cast in (('--top', int), ('--min-count', int), ('--chunk-size', int), ('--days', float),
+                       ('--service', str)):
+        if name in args:
+            position = args.index(name)
+            options[name[2:].replace('-', '_')] = cast(args[position + 1])
+            del args[position:position + 2]
+    if 'top' in options:
+        options['top_k'] = options.pop('top')
+    service = options.pop('service', os.getenv('SERVICE_URL'))
+    url = args[0] if args else os.getenv('DATABASE_URI')
+    if not url:
+        print("usage: python cooccurrence.py [database url] [--service URL] [--top K] [--min-count N] "
+              "[--chunk-size N] [--days N]")
+        sys.exit(2)
+    if os.getenv('SHARD_URIS'):
+        print("cooccurrence.py does not support sharded recommendations (SHARD_URIS)")
+        sys.exit(2)
+    if os.getenv('CACHE_BACKEND', 'memory') == 'redis':
+        options['invalidate'] = cache_invalidator(cache.create_cache())
+    elif service:
+        options['invalidate'] = service_invalidator(service)
+    else:
+        print("the service caches lists in memory, give its URL with --service or SERVICE_URL "
+              "so they are invalidated")
+        sys.exit(2)
+    print("wrote %d co-click recommendations" % run(storage.create_db_engine(url), **options))
@@ -0,0 +1,170 @@
+######################################################################
+# Synthetic recommendation datasets for benchmarking
+#
+# generate() streams a reproducible set of recommendations: the same
+# seed and size always give the same rows. Fan-out per parent product
+# follows a power law (most products have a few recommendations, a few
+# have hundreds), related products are drawn with a popularity skew,
+# and types follow TYPE_MIX. Rows are produced one at a time in id
+# order, so any size can be written or loaded in constant memory.
+#
+# run with:
+#   python dataset.py generate [--rows 1m] [--seed 42] [--format ndjson|csv] [--output file]
+#   python dataset.py load [database url] [--rows 1m] [--seed 42] [--input file]
+# the url defaults to DATABASE_URI; the standard sizes are 10k, 1m and 10m
+######################################################################
+
+import os
+import sys
+import csv
+import json
+import time
+import random
+from bisect import bisect
+import storage
+import migrations
+
+COLUMNS = ('id', 'parent_product_id', 'related_product_id', 'type', 'priority')
+SIZES = {'10k': 10000, '1m': 1000000, '10m': 10000000}
+SEED = 42
+MEAN_FAN_OUT = 10
+MAX_FAN_OUT = 200
+# shape of the fan-out power law, lower is a heavier tail
+FAN_OUT_ALPHA = 1.5
+# related products are drawn from the catalogue as random() ** SKEW,
+# concentrating them on the most popular products
+POPULARITY_SKEW = 3
+TYPE_MIX = [('x-sell', 0.45), ('up-sell', 0.30), ('accessory', 0.15), ('bundle', 0.10)]
+MAX_PRIORITY = 10
+LOAD_CHUNK_SIZE = 10000
+
+
+def generate(rows, seed=SEED, mean_fan_out=MEAN_FAN_OUT, type_mix=TYPE_MIX):
+    """ Yields rows recommendations as dicts of the COLUMNS, in id order """
+    generator = random.Random(seed)
+    # the parents needed for rows recommendations, which are also the
+    # catalogue related products are drawn from
+    catalogue = max(2, rows // mean_fan_out)
+    # the Pareto scale giving mean_fan_out on average
+    scale = mean_fan_out * (FAN_OUT_ALPHA - 1) / FAN_OUT_ALPHA
+    types = [name for name, weight in type_mix]
+    cumulative = []
+    total = 0.0
+    for name, weight in type_mix:
+        total += weight
+        cumulative.append(total)
+    id = 0
+    parent_product_id = 0
+    while id < rows:
+        parent_product_id += 1
+        fan_out = min(MAX_FAN_OUT, catalogue - 1, rows - id,
+                      max(1, int(generator.paretovariate(FAN_OUT_ALPHA) * scale)))
+        related = set()
+        while len(related) < fan_out:
+            related_product_id = int(catalogue * generator.random() ** POPULARITY_SKEW) + 1
+            if related_product_id != parent_product_id:
+                related.add(related_product_id)
+        for related_product_id in sorted(related):
+            id += 1
+            yield {'id': id,
+                   'parent_product_id': parent_product_id,
+                   'related_product_id': related_product_id,
+                   'type': types[bisect(cumulative, generator.random() * total)],
+                   'priority': int(generator.random() * MAX_PRIORITY) + 1}
+
+
+def write_ndjson(rows, out):
+    for row in rows:
+        out.write(json.dumps(row, sort_keys=True))
+        out.write('\n')
+
+
+def write_csv(rows, out):
+    writer = csv.writer(out)
+    writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow([row[column] for column in COLUMNS])
+
+
+def read_ndjson(lines):
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_csv(lines):
+    for row in csv.DictReader(lines):
+        yield {'id': int(row['id']),
+               'parent_product_id': int(row['parent_product_id']),
+               'related_product_id': int(row['related_product_id']),
+               'type': row['type'],
+               'priority': int(row['priority'])}
+
+
+def load(engine, rows, chunk_size=LOAD_CHUNK_SIZE):
+    """
+    Inserts the rows with one executemany per chunk, each chunk in its
+    own transaction, into a migrated database. MySQLdb turns each
+    executemany into a single multi-row INSERT. Returns the number of
+    rows and of parent products loaded, counting the rows as grouped
+    by parent the way generate() produces them.
+    """
+    migrations.upgrade(engine)
+    insert = storage.recommendations.insert()
+    count = 0
+    parents = 0
+    last_parent = None
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if row['parent_product_id'] != last_parent:
+            parents += 1
+            last_parent = row['parent_product_id']
+        if len(chunk) == chunk_size:
+            engine.execute(insert, chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        engine.execute(insert, chunk)
+        count += len(chunk)
+    return count, parents
+
+
+def parse_size(value):
+    """ Reads a row count, either a number or one of SIZES """
+    return SIZES.get(value.lower()) or int(value)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {'--rows': '10k', '--seed': str(SEED), '--format': 'ndjson',
+               '--output': None, '--input': None}
+    for name in list(options):
+        if name in args:
+            position = args.index(name)
+            options[name] = args[position + 1]
+            del args[position:position + 2]
+    command = args.pop(0) if args else None
+    rows = parse_size(options['--rows'])
+    seed = int(options['--seed'])
+    if command == 'generate' and options['--format'] in ('ndjson', 'csv'):
+        out = open(options['--output'], 'w') if options['--output'] else sys.stdout
+        write = write_csv if options['--format'] == 'csv' else write_ndjson
+        write(generate(rows, seed), out)
+        out.close()
+    elif command == 'load' and (args or os.getenv('DATABASE_URI')):
+        engine = storage.create_db_engine(args[0] if args else os.getenv('DATABASE_URI'))
+        source = generate(rows, seed)
+        if options['--input']:
+            lines = open(options['--input'])
+            source = read_csv(lines) if options['--input'].endswith('.csv') else read_ndjson(lines)
+        start = time.time()
+        count, parents = load(engine, source)
+        print("loaded %d recommendations of %d products in %.1fs" % (count, parents, time.time() - start))
+    else:
+        print("usage: python dataset.py generate [--rows 1m] [--seed 42] [--format ndjson|csv] [--output file]\n"
+              "       python dataset.py load [database url] [--rows 1m] [--seed 42] [--input file]")
+        sys.exit(2)
@@ -37,16 +37,14 @@ if __name__ == "__main__":
     prod_dict, prod_count = productIDMapper(getProductList())
 
 
+    names = list(prod_dict.keys())
     for product in products:
         product["id"] = prod_dict[product["name"]]
-        tmp_prod_dict = dict(prod_dict)
-
-        def getRandomProd():
-            return random.choice(tmp_prod_dict.keys())
-        for recs in product["recommendations"]:
-            new_rec = getRandomProd()
+        # distinct products without copying the whole dict per product;
+        # dataset.py generates benchmark-sized sets
+        new_recs = random.sample(names, len(product["recommendations"]))
+        for recs, new_rec in zip(product["recommendations"], new_recs):
             recs["name"] = new_rec
-            tmp_prod_dict.pop(new_rec, None)
             recs["id"] = prod_dict[new_rec]
         result[product["id"]] = product
 
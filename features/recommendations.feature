@@ -43,7 +43,7 @@ Scenario: Click a recommendation
 	And I should not see "5"
 
 Scenario: Read recommendation with query parameter type
-	When I click "/recommendations" with type "'x-sell'"
+	When I click "/recommendations" with type "x-sell"
 	Then I should see "x-sell"
 	And I should not see "up-sell"
 
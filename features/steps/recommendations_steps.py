@@ -20,9 +20,10 @@ def step_impl(context, message):
 
 @given(u'the following products')
 def step_impl(context):
-    server.conn.execute("TRUNCATE TABLE `recommendations`")
+    server.engine.execute("DELETE FROM `recommendations`")
+    server.list_cache.clear()
     for row in context.table:
-        server.conn.execute("INSERT INTO `recommendations` VALUES (%d, %d, %d,\
+        server.engine.execute("INSERT INTO `recommendations` VALUES (%d, %d, %d,\
                 '%s\', %d)" % (int(row["id"]), int(row["parent_product_id"]),
                                int(row["related_product_id"]), row["type"],
                                int(row["priority"])))
@@ -0,0 +1,183 @@
+######################################################################
+# In-memory recommendation graph
+#
+# With READ_MODE=graph every product list is answered from a snapshot
+# of the whole recommendations table held in compressed sparse row
+# (CSR) form: the sorted parent product ids, the offset of each one's
+# edges, and one parallel array per column of the edges. A product's
+# list is a binary search and a slice, with no query and no per-row
+# Python object kept between requests.
+#
+# A snapshot is never modified. GraphLoader builds a new one in the
+# background, periodically and/or shortly after writes, and swaps it in
+# with a single assignment, so readers always see a whole snapshot.
+######################################################################
+
+import time
+import logging
+from array import array
+from bisect import bisect_left
+from threading import Event, Thread
+import queries
+
+REFRESH_INTERVAL = 60.0
+REFRESH_DELAY = 1.0
+# priority is nullable, the int array stores NULL as this sentinel
+NO_PRIORITY = -2 ** 31
+
+logger = logging.getLogger(__name__)
+
+
+class RecommendationGraph(object):
+    """ An immutable CSR snapshot of the recommendations table """
+
+    def __init__(self, rows, generation=0):
+        """ Builds the graph from rows sorted by parent product id """
+        self.generation = generation
+        self.loaded_at = time.time()
+        self.parents = array('l')
+        self.offsets = array('l', [0])
+        self.ids = array('l')
+        self.related = array('l')
+        # widened to 'i' in the unlikely case of more than 65536 types
+        self.type_codes = array('H')
+        self.priorities = array('i')
+        self.types = []
+        codes = {}
+        last_parent = None
+        for id, parent_product_id, related_product_id, rec_type, priority in rows:
+            if parent_product_id != last_parent:
+                if last_parent is not None:
+                    self.offsets.append(len(self.ids))
+                self.parents.append(parent_product_id)
+                last_parent = parent_product_id
+            code = codes.get(rec_type)
+            if code is None:
+                code = codes[rec_type] = len(self.types)
+                self.types.append(rec_type)
+                if code == 65536:
+                    self.type_codes = array('i', self.type_codes)
+            self.ids.append(id)
+            self.related.append(related_product_id)
+            self.type_codes.append(code)
+            self.priorities.append(NO_PRIORITY if priority is None else priority)
+        if last_parent is not None:
+            self.offsets.append(len(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def product(self, product_id, rec_type=None, top=None):
+        """
+        Returns the rows of a product as (id, parent, related, type,
+        priority) tuples, by id or, with top, the top highest priority
+        """
+        index = bisect_left(self.parents, product_id)
+        if index == len(self.parents) or self.parents[index] != product_id:
+            return []
+        edges = range(self.offsets[index], self.offsets[index + 1])
+        if rec_type is not None:
+            if rec_type not in self.types:
+                return []
+            code = self.types.index(rec_type)
+            edges = [edge for edge in edges if self.type_codes[edge] == code]
+        if top is not None:
+            # a NULL priority sorts first, as it does in MySQL and SQLite
+            edges = sorted(edges, key=lambda edge: (self.priorities[edge], self.ids[edge]))[:top]
+        return [self._row(product_id, edge) for edge in edges]
+
+    def memory(self):
+        """ Returns the bytes held by the arrays """
+        return sum(len(column) * column.itemsize
+                   for column in (self.parents, self.offsets, self.ids, self.related,
+                                  self.type_codes, self.priorities))
+
+    def stats(self):
+        return {'generation': self.generation,
+                'loaded_at': self.loaded_at,
+                'products': len(self.parents),
+                'edges': len(self.ids),
+                'types': len(self.types),
+                'bytes': self.memory(),
+                'bytes_per_edge': float(self.memory()) / len(self.ids) if self.ids else 0.0}
+
+    def _row(self, product_id, edge):
+        priority = self.priorities[edge]
+        return (self.ids[edge], product_id, self.related[edge],
+                self.types[self.type_codes[edge]],
+                None if priority == NO_PRIORITY else priority)
+
+
+def load_graph(engine, generation=0):
+    """ Reads the whole table from a streaming cursor into a new graph """
+    conn = engine.connect()
+    try:
+        results = queries.execute(conn.execution_options(stream_results=True), 'snapshot')
+        graph = RecommendationGraph(results, generation)
+        results.close()
+        return graph
+    finally:
+        conn.close()
+
+
+class GraphLoader(object):
+    """
+    Keeps the current graph and rebuilds it in the background, every
+    refresh_interval seconds (0 never) and refresh_delay seconds after
+    a write when on_write is set, coalescing the writes in between
+    """
+
+    def __init__(self, engine, refresh_interval=REFRESH_INTERVAL,
+                 refresh_delay=REFRESH_DELAY, on_write=True):
+        self.engine = engine
+        self.refresh_interval = refresh_interval
+        self.refresh_delay = refresh_delay
+        self.on_write = on_write
+        self.graph = None
+        self.dirty = Event()
+        self.stopped = Event()
+        self.worker = None
+
+    def start(self):
+        """ Loads the first graph, then starts the refresh thread """
+        self.refresh()
+        self.worker = Thread(target=self._run, name='graph-loader')
+        self.worker.daemon = True
+        self.worker.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.dirty.set()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    def refresh(self):
+        """ Builds a new graph and swaps it in, returns it """
+        generation = 0 if self.graph is None else self.graph.generation + 1
+        start = time.time()
+        graph = load_graph(self.engine, generation)
+        self.graph = graph
+        logger.info('Loaded recommendation graph %d: %d edges in %.2fs',
+                    generation, len(graph), time.time() - start)
+        return graph
+
+    def changed(self):
+        """ Called after every write """
+        if self.on_write:
+            self.dirty.set()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.dirty.wait(self.refresh_interval or None)
+            if self.stopped.is_set():
+                break
+            if self.dirty.is_set():
+                # let a burst of writes land before paying for a reload
+                self.stopped.wait(self.refresh_delay)
+            self.dirty.clear()
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Reloading the recommendation graph failed')
@@ -0,0 +1,70 @@
+######################################################################
+# gunicorn configuration for the Recommendations service
+#
+# Each worker imports server.py and calls create_app() after the fork,
+# so it opens its own connection pool and background threads; the
+# app is never preloaded into the master. Workers are threaded
+# (gthread) by default, which keeps a worker busy while another thread
+# waits on the database. WORKER_CLASS=gevent serves each request on a
+# greenlet instead, up to WORKER_CONNECTIONS at once per worker, and
+# switches MySQL to the PyMySQL driver, which yields while it waits.
+#
+# On SIGTERM a worker first drains: /ready answers 503 for
+# DRAIN_SECONDS while requests are still served, so load balancers
+# stop sending new ones. It then stops accepting connections, finishes
+# the requests in flight, writes queued clicks and closes its pool.
+# The master kills workers still running after GRACEFUL_TIMEOUT, which
+# has to be longer than DRAIN_SECONDS.
+#
+# run with:
+#   gunicorn -c gunicorn.conf.py 'server:create_app()'
+######################################################################
+
+import os
+import signal
+import threading
+import multiprocessing
+
+bind = '0.0.0.0:%s' % os.getenv('PORT', '5000')
+# the usual two per core plus one, each with THREADS threads
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('THREADS', '4'))
+# the workers know they are not alone, see server.etag_version()
+os.environ['SERVER_WORKERS'] = str(workers)
+worker_class = os.getenv('WORKER_CLASS', 'gthread')
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', '1000'))
+if worker_class == 'gevent':
+    os.environ.setdefault('MYSQL_DRIVER', 'pymysql')
+# seconds an idle keep-alive connection is held open
+keepalive = int(os.getenv('KEEP_ALIVE', '5'))
+timeout = int(os.getenv('WORKER_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '30'))
+preload_app = False
+accesslog = os.getenv('ACCESS_LOG')
+
+DRAIN_SECONDS = float(os.getenv('DRAIN_SECONDS', '0'))
+
+
+def post_worker_init(worker):
+    """ Delays the worker's own SIGTERM handling by DRAIN_SECONDS """
+    import server as service
+    stop = signal.getsignal(signal.SIGTERM)
+
+    def drain(signum, frame):
+        service.drain()
+        if DRAIN_SECONDS <= 0:
+            stop(signum, frame)
+        elif worker_class == 'gevent':
+            # a signal handler runs in the event loop, which cannot
+            # wait for a thread to start
+            import gevent
+            gevent.spawn_later(DRAIN_SECONDS, stop, signum, frame)
+        else:
+            # gunicorn's handler only marks the worker as no longer alive
+            threading.Timer(DRAIN_SECONDS, stop, (signum, frame)).start()
+    signal.signal(signal.SIGTERM, drain)
+
+
+def worker_exit(arbiter, worker):
+    import server as service
+    service.shutdown()
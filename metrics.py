@@ -0,0 +1,187 @@
+######################################################################
+# Request metrics in the Prometheus text format
+#
+# RequestMetrics is fed by the Flask request hooks: start() when a
+# request begins and finish() with its route, status and response size
+# when it ends. instrument() times every statement an engine runs
+# through its cursor events; statements run by the thread of a request
+# in flight add to that request's database time and query count.
+# Everything is kept as counters and fixed-bucket histograms under one
+# lock taken once per request, so the hooks cost a few microseconds.
+#
+# Statements slower than the slow query threshold are logged with
+# their SQL text and duration, whether or not metrics are kept.
+######################################################################
+
+import time
+import weakref
+import logging
+from bisect import bisect_left
+from threading import Lock, local
+from sqlalchemy import event
+
+# seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# bytes
+SIZE_BUCKETS = (128, 512, 2048, 8192, 32768, 131072, 524288, 2097152, 8388608)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger(__name__)
+
+# engine -> the listeners instrument() added to it
+instrumented = weakref.WeakKeyDictionary()
+
+
+class Histogram(object):
+    """ Counts of observations per bucket, Prometheus style """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        """ Yields the exposition lines of the histogram """
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '%s_bucket{%sle="%s"} %d' % (name, labels, format_value(bound), cumulative)
+        cumulative += self.counts[-1]
+        yield '%s_bucket{%sle="+Inf"} %d' % (name, labels, cumulative)
+        yield '%s_sum{%s} %s' % (name, labels[:-1], format_value(self.sum))
+        yield '%s_count{%s} %d' % (name, labels[:-1], cumulative)
+
+
+class RequestMetrics(object):
+    """ Latency, database time, queries and response sizes per route """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = Lock()
+        self.current = local()
+        # (route, method, status) -> count
+        self.requests = {}
+        # (route, method) -> Histogram or count
+        self.latency = {}
+        self.db_time = {}
+        self.queries = {}
+        self.sizes = {}
+
+    def start(self):
+        """ Called when a request begins, in the thread serving it """
+        current = self.current
+        current.start = self.clock()
+        current.db_time = 0.0
+        current.queries = 0
+        current.active = True
+
+    def query(self, duration):
+        """ Called for every statement, counted if a request is in flight """
+        current = self.current
+        if getattr(current, 'active', False):
+            current.db_time += duration
+            current.queries += 1
+
+    def finish(self, route, method, status, size):
+        """ Called when the request's response is ready """
+        current = self.current
+        if not getattr(current, 'active', False):
+            return
+        current.active = False
+        elapsed = self.clock() - current.start
+        key = (route, method)
+        with self.lock:
+            self.requests[(route, method, status)] = self.requests.get((route, method, status), 0) + 1
+            latency = self.latency.get(key)
+            if latency is None:
+                latency = self.latency[key] = Histogram(LATENCY_BUCKETS)
+                self.db_time[key] = Histogram(LATENCY_BUCKETS)
+                self.sizes[key] = Histogram(SIZE_BUCKETS)
+                self.queries[key] = 0
+            latency.observe(elapsed)
+            self.db_time[key].observe(current.db_time)
+            self.queries[key] += current.queries
+            if size is not None:
+                self.sizes[key].observe(size)
+
+    def render(self, gauges=()):
+        """
+        Returns every metric in the Prometheus text format, followed by
+        the (name, type, help, value) gauges and counters given
+        """
+        lines = []
+        with self.lock:
+            lines.extend(header('http_requests_total', 'counter', 'Requests served'))
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append('http_requests_total{%sstatus="%d"} %d' % (
+                    route_labels(route, method), status, count))
+            for name, kind, help_text, series in (
+                    ('http_request_duration_seconds', 'histogram',
+                     'Time from the start of a request to its response', self.latency),
+                    ('http_request_db_seconds', 'histogram',
+                     'Time a request spent executing statements', self.db_time),
+                    ('http_response_size_bytes', 'histogram',
+                     'Size of buffered response bodies', self.sizes)):
+                lines.extend(header(name, kind, help_text))
+                for (route, method), histogram in sorted(series.items()):
+                    lines.extend(histogram.samples(name, route_labels(route, method)))
+            lines.extend(header('http_request_db_queries_total', 'counter', 'Statements executed by requests'))
+            for (route, method), count in sorted(self.queries.items()):
+                lines.append('http_request_db_queries_total{%s} %d' % (route_labels(route, method)[:-1], count))
+        for name, kind, help_text, value in gauges:
+            lines.extend(header(name, kind, help_text))
+            lines.append('%s %s' % (name, format_value(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def instrument(engine, request_metrics=None, slow_query_threshold=None):
+    """
+    Times the statements the engine runs, for request_metrics and for
+    the slow query log above slow_query_threshold seconds, replacing
+    what an earlier call instrumented the engine with
+    """
+    clock = time.time
+    for name, listener in instrumented.pop(engine, ()):
+        event.remove(engine, name, listener)
+    if request_metrics is None and slow_query_threshold is None:
+        return
+
+    # the start is kept on the statement's execution context, a plain
+    # attribute, where conn.info would go through the pool's records
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.query_start = clock()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = clock() - context.query_start
+        if request_metrics is not None:
+            request_metrics.query(duration)
+        if slow_query_threshold is not None and duration >= slow_query_threshold:
+            logger.warning('Slow query (%.1f ms): %s', duration * 1000, statement)
+
+    listeners = [('before_cursor_execute', before_cursor_execute),
+                 ('after_cursor_execute', after_cursor_execute)]
+    for name, listener in listeners:
+        event.listen(engine, name, listener)
+    instrumented[engine] = listeners
+
+
+def header(name, kind, help_text):
+    return ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, kind)]
+
+
+def route_labels(route, method):
+    """ The labels of a route, each followed by a comma """
+    return 'route="%s",method="%s",' % (route, method)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
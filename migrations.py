@@ -0,0 +1,155 @@
+######################################################################
+# Versioned schema migrations for the Recommendations service
+#
+# Each migration is applied once, in order, and recorded in the
+# schema_version table. Migrations are written to be idempotent, so a
+# database created from recommendations.sql or by an older release
+# converges on the same schema as a fresh one.
+#
+# upgrade() holds a lock while it reads the version and applies the
+# pending migrations, so the workers of the service, which all upgrade
+# on start, wait for the first one rather than racing it: GET_LOCK on
+# MySQL, an flock next to the database file on SQLite.
+#
+# run with:
+#   python migrations.py [status|upgrade] [database url]
+# the url defaults to DATABASE_URI
+######################################################################
+
+import os
+import sys
+import fcntl
+from datetime import datetime
+from contextlib import contextmanager
+from threading import Lock
+from sqlalchemy import select, func, inspect
+import storage
+
+rec = storage.recommendations
+
+LOCK_NAME = 'recommendations_migrations'
+# seconds to wait for another process to finish migrating
+LOCK_TIMEOUT = 300
+# in-memory SQLite databases are only shared by the threads of a process
+memory_lock = Lock()
+
+
+class MigrationError(Exception):
+    """ A migration cannot be applied to the data in the database """
+    pass
+
+
+def create_recommendations(conn):
+    rec.create(conn, checkfirst=True)
+
+
+def add_lookup_indexes(conn):
+    for index in storage.lookup_indexes:
+        _create_index(conn, index)
+
+
+def add_relationship_uniqueness(conn):
+    duplicates = conn.execute(
+        select([rec.c.parent_product_id, rec.c.related_product_id, rec.c.type])
+        .group_by(rec.c.parent_product_id, rec.c.related_product_id, rec.c.type)
+        .having(func.count() > 1)).fetchall()
+    if duplicates:
+        raise MigrationError('%d relationships are stored more than once, '
+                             'first (parent, related, type): %s'
+                             % (len(duplicates), tuple(duplicates[0])))
+    _create_index(conn, storage.relationship_index)
+
+
+def add_ranking_index(conn):
+    _create_index(conn, storage.ranking_index)
+
+
+def create_click_events(conn):
+    storage.click_events.create(conn, checkfirst=True)
+
+
+def create_shard_directory(conn):
+    storage.shard_buckets.create(conn, checkfirst=True)
+    storage.id_sequences.create(conn, checkfirst=True)
+
+
+MIGRATIONS = [
+    (1, 'create recommendations table', create_recommendations),
+    (2, 'add product and type lookup indexes', add_lookup_indexes),
+    (3, 'add unique parent, related, type relationship', add_relationship_uniqueness),
+    (4, 'add product priority ranking index', add_ranking_index),
+    (5, 'create click events table', create_click_events),
+    (6, 'create shard directory tables', create_shard_directory),
+]
+
+
+def current_version(engine):
+    storage.schema_version.create(engine, checkfirst=True)
+    version = engine.execute(select([func.max(storage.schema_version.c.version)])).scalar()
+    return version or 0
+
+
+def upgrade(engine):
+    """ Applies every pending migration, returns the versions applied """
+    applied = []
+    with migration_lock(engine):
+        version = current_version(engine)
+        for number, description, migrate in MIGRATIONS:
+            if number <= version:
+                continue
+            with engine.begin() as conn:
+                migrate(conn)
+                conn.execute(storage.schema_version.insert(),
+                             version=number, description=description,
+                             applied_at=datetime.utcnow())
+            applied.append(number)
+    return applied
+
+
+@contextmanager
+def migration_lock(engine):
+    """ Holds off the migrations of every other process on the database """
+    if engine.dialect.name == 'mysql':
+        conn = engine.connect()
+        try:
+            if conn.execute(select([func.get_lock(LOCK_NAME, LOCK_TIMEOUT)])).scalar() != 1:
+                raise MigrationError('another process held the migration lock for %ds' % LOCK_TIMEOUT)
+            try:
+                yield
+            finally:
+                conn.execute(select([func.release_lock(LOCK_NAME)]))
+        finally:
+            conn.close()
+    elif engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:'):
+        with open(engine.url.database + '.migrations.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        with memory_lock:
+            yield
+
+
+def _create_index(conn, index):
+    existing = [ix['name'] for ix in inspect(conn).get_indexes(index.table.name)]
+    if index.name not in existing:
+        index.create(conn)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    url = sys.argv[2] if len(sys.argv) > 2 else os.getenv('DATABASE_URI')
+    if command not in ('status', 'upgrade') or not url:
+        print("usage: python migrations.py [status|upgrade] [database url]")
+        sys.exit(2)
+    engine = storage.create_db_engine(url)
+    if command == 'upgrade':
+        for number in upgrade(engine):
+            print("applied migration %d" % number)
+    version = current_version(engine)
+    print("schema version %d of %d" % (version, MIGRATIONS[-1][0]))
@@ -0,0 +1,169 @@
+######################################################################
+# Precompiled statements for the Recommendations service
+#
+# Every statement is a SQLAlchemy Core construct with bound parameters.
+# prepare() compiles them once for the engine's dialect and the route
+# handlers execute the cached Compiled objects, so a request pays for
+# neither string building nor SQL compilation and user input never
+# ends up inside the SQL text.
+######################################################################
+
+from sqlalchemy import select, bindparam, and_, case
+from sqlalchemy.exc import IntegrityError
+from storage import recommendations as rec
+
+# MySQL's ER_DUP_ENTRY; SQLite only tells in the message
+DUPLICATE_ENTRY = 1062
+
+# The filters GET /recommendations combines from its query parameters
+FILTERS = {
+    'all': None,
+    'by_type': rec.c.type == bindparam('type'),
+    'by_product': rec.c.parent_product_id == bindparam('parent_product_id'),
+    'by_product_and_type': and_(rec.c.type == bindparam('type'),
+                                rec.c.parent_product_id == bindparam('parent_product_id')),
+}
+
+STATEMENTS = {
+    'select_by_id':
+        select([rec]).where(rec.c.id == bindparam('rec_id')),
+    'update':
+        rec.update().where(and_(rec.c.id == bindparam('rec_id'),
+                                rec.c.parent_product_id == bindparam('parent_product_id'),
+                                rec.c.related_product_id == bindparam('related_product_id')))
+                    .values(type=bindparam('new_type'), priority=bindparam('new_priority')),
+    # delete and clicked also match the parent product the caller will
+    # invalidate, so a rowcount of 1 confirms it in the same round trip
+    'delete':
+        rec.delete().where(and_(rec.c.id == bindparam('rec_id'),
+                                rec.c.parent_product_id == bindparam('parent_product_id'))),
+    # matches at priority 1 too, so only a missing row has a rowcount of 0
+    'clicked':
+        rec.update().where(and_(rec.c.id == bindparam('rec_id'),
+                                rec.c.parent_product_id == bindparam('parent_product_id')))
+                    .values(priority=case([(rec.c.priority > 1, rec.c.priority - 1)],
+                                          else_=rec.c.priority)),
+    # the whole table grouped by parent, for the in-memory graph
+    'snapshot':
+        select([rec]).order_by(rec.c.parent_product_id, rec.c.id),
+    # n coalesced clicks at once, never pushing priority below 1
+    'clicked_batch':
+        rec.update().where(and_(rec.c.id == bindparam('rec_id'), rec.c.priority > 1))
+                    .values(priority=case([(rec.c.priority - bindparam('clicks') < 1, 1)],
+                                          else_=rec.c.priority - bindparam('clicks'))),
+}
+
+for name, criterion in FILTERS.items():
+    query = select([rec])
+    if criterion is not None:
+        query = query.where(criterion)
+    STATEMENTS['list_' + name] = query
+    # in id order, for merging the rows of several shards
+    STATEMENTS['sorted_' + name] = query.order_by(rec.c.id)
+    # keyset pagination: the page after a given id, walking the primary key
+    STATEMENTS['page_' + name] = query.where(rec.c.id > bindparam('after_id')) \
+                                      .order_by(rec.c.id).limit(bindparam('limit'))
+    # the K highest priority rows, a lower number is a higher priority
+    if 'product' in name:
+        STATEMENTS['top_' + name] = query.order_by(rec.c.priority, rec.c.id) \
+                                         .limit(bindparam('limit'))
+
+# INSERT has no WHERE clause to bind against, its VALUES list is fixed
+# at compile time from the column keys instead. The id is left out so
+# the database assigns it.
+INSERT_COLUMNS = ['parent_product_id', 'related_product_id', 'type', 'priority']
+
+compiled = {}
+
+
+def prepare(engine):
+    """ Compiles every statement for the engine's dialect """
+    compiled.clear()
+    for name, statement in STATEMENTS.items():
+        compiled[name] = statement.compile(dialect=engine.dialect)
+    compiled['insert'] = rec.insert().compile(dialect=engine.dialect,
+                                              column_keys=INSERT_COLUMNS)
+    # sharded ids are allocated before the insert, see shards.py
+    compiled['insert_with_id'] = rec.insert().compile(dialect=engine.dialect,
+                                                      column_keys=['id'] + INSERT_COLUMNS)
+
+
+def select_parents(ids):
+    """
+    Selects the parent product of each id. The IN list changes length
+    with every call so it is built per call rather than precompiled.
+    """
+    return select([rec.c.id, rec.c.parent_product_id]).where(rec.c.id.in_(ids))
+
+
+def select_rows(ids):
+    """ Selects the rows of ids, built per call like select_parents() """
+    return select([rec]).where(rec.c.id.in_(ids))
+
+
+def select_products(product_ids, rec_type=None, ranked=False):
+    """
+    Selects the recommendations of several parent products in one IN
+    query, grouped by parent and, when ranked, by priority within it.
+    Built per call like select_parents().
+    """
+    query = select([rec]).where(rec.c.parent_product_id.in_(product_ids))
+    if rec_type is not None:
+        query = query.where(rec.c.type == rec_type)
+    if ranked:
+        return query.order_by(rec.c.parent_product_id, rec.c.priority, rec.c.id)
+    return query.order_by(rec.c.parent_product_id, rec.c.id)
+
+
+def insert_rows(conn, rows):
+    """
+    Inserts rows one by one, returns the id the database assigned to
+    each, or None where the row violates a unique constraint.
+    executemany cannot report generated keys, so this loops on a single
+    DBAPI cursor instead, skipping SQLAlchemy's per-execute overhead.
+    Call inside a transaction.
+    """
+    insert = compiled['insert']
+    if not insert.positional:
+        return [_insert_row(conn, insert, row) for row in rows]
+    integrity_error = conn.dialect.dbapi.IntegrityError
+    cursor = conn.connection.cursor()
+    ids = []
+    try:
+        for row in rows:
+            try:
+                cursor.execute(insert.string, [row[key] for key in insert.positiontup])
+            except integrity_error as err:
+                if not is_duplicate(err):
+                    raise
+                ids.append(None)
+            else:
+                ids.append(cursor.lastrowid)
+    finally:
+        cursor.close()
+    return ids
+
+
+def _insert_row(conn, insert, row):
+    try:
+        return conn.execute(insert, row).inserted_primary_key[0]
+    except IntegrityError as err:
+        if not is_duplicate(err):
+            raise
+        return None
+
+
+def is_duplicate(error):
+    """
+    Whether an IntegrityError, SQLAlchemy's or the DBAPI's, violates a
+    unique constraint rather than, say, a NOT NULL one
+    """
+    error = getattr(error, 'orig', error)
+    if error.args and error.args[0] == DUPLICATE_ENTRY:
+        return True
+    return 'UNIQUE constraint failed' in str(error)
+
+
+def execute(conn, name, **params):
+    """ Executes a precompiled statement with the given bound parameters """
+    return conn.execute(compiled[name], **params)
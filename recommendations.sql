@@ -36,7 +36,11 @@ CREATE TABLE `recommendations` (
   `related_product_id` int(11) NOT NULL,
   `type` varchar(20) DEFAULT NULL,
   `priority` int(11) NOT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uq_recommendations_relationship` (`parent_product_id`,`related_product_id`,`type`),
+  KEY `ix_recommendations_product_type_priority` (`parent_product_id`,`type`,`priority`),
+  KEY `ix_recommendations_type` (`type`),
+  KEY `ix_recommendations_product_priority` (`parent_product_id`,`priority`)
 ) ENGINE=InnoDB AUTO_INCREMENT=4 DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
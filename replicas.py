@@ -0,0 +1,124 @@
+######################################################################
+# Read replica routing
+#
+# A ReplicaSet hands out connections to the replicas of the primary
+# database, picking one round-robin or the one with the fewest
+# connections checked out. A replica that fails to connect is ejected
+# for EJECT_SECONDS and the next one is tried; once the time is up it
+# is tried again, and ejected again if it still fails. When every
+# replica is ejected connect() returns None and reads go to the primary.
+#
+# Replicas lag behind the primary, so a read just after a write could
+# miss it. RecentWrites remembers what was written in the last few
+# seconds, by product; reads of those go to the primary until the
+# window has passed.
+######################################################################
+
+import time
+import logging
+from itertools import count
+from threading import Lock
+from sqlalchemy.exc import DBAPIError
+
+ROUND_ROBIN = 'round-robin'
+LEAST_BUSY = 'least-busy'
+POLICIES = (ROUND_ROBIN, LEAST_BUSY)
+# seconds an unreachable replica is left out
+EJECT_SECONDS = 10
+# seconds reads stay on the primary after a write, longer than the
+# replicas are expected to lag
+READ_YOUR_WRITES_SECONDS = 5
+# products remembered by RecentWrites before expired ones are dropped
+MAX_RECENT_WRITES = 10000
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaSet(object):
+    """ Connections to the healthy replicas, chosen by policy """
+
+    def __init__(self, engines, policy=ROUND_ROBIN, eject_seconds=EJECT_SECONDS,
+                 clock=time.time):
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of %s' % ', '.join(POLICIES))
+        self.engines = list(engines)
+        self.policy = policy
+        self.eject_seconds = eject_seconds
+        self.clock = clock
+        self.lock = Lock()
+        self.turns = count()
+        # engine index -> time it may be tried again
+        self.ejected = {}
+        self.ejections = 0
+
+    def connect(self):
+        """
+        Returns a connection to a replica, or None if no replica could
+        be reached
+        """
+        for index in self.candidates():
+            try:
+                return self.engines[index].connect()
+            except DBAPIError as err:
+                self.eject(index, err)
+        return None
+
+    def candidates(self):
+        """ The indexes of the healthy replicas, in the order to try them """
+        now = self.clock()
+        with self.lock:
+            healthy = [index for index in range(len(self.engines))
+                       if self.ejected.get(index, 0) <= now]
+        if not healthy:
+            return []
+        # rotating the list spreads ties, and all of round-robin
+        start = next(self.turns) % len(healthy)
+        healthy = healthy[start:] + healthy[:start]
+        if self.policy == LEAST_BUSY:
+            healthy.sort(key=lambda index: self.engines[index].pool.checkedout())
+        return healthy
+
+    def eject(self, index, err=None):
+        """ Leaves a replica out for eject_seconds """
+        logger.warning('Ejecting replica %d for %ss: %s', index, self.eject_seconds, err)
+        with self.lock:
+            self.ejected[index] = self.clock() + self.eject_seconds
+            self.ejections += 1
+
+    def stats(self):
+        now = self.clock()
+        with self.lock:
+            healthy = [self.ejected.get(index, 0) <= now for index in range(len(self.engines))]
+            ejections = self.ejections
+        return {'policy': self.policy,
+                'replicas': len(self.engines),
+                'healthy': sum(healthy),
+                'ejections': ejections,
+                'checked_out': [engine.pool.checkedout() for engine in self.engines]}
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+class RecentWrites(object):
+    """ Keys written in the last window seconds """
+
+    def __init__(self, window=READ_YOUR_WRITES_SECONDS, clock=time.time,
+                 max_keys=MAX_RECENT_WRITES):
+        self.window = window
+        self.clock = clock
+        self.max_keys = max_keys
+        self.lock = Lock()
+        # key -> time its window ends
+        self.until = {}
+
+    def touch(self, key):
+        now = self.clock()
+        with self.lock:
+            if len(self.until) >= self.max_keys:
+                self.until = dict((k, t) for k, t in self.until.items() if t > now)
+            self.until[key] = now + self.window
+
+    def recent(self, key):
+        return self.until.get(key, 0) > self.clock()
@@ -0,0 +1,75 @@
+######################################################################
+# JSON serialization for the Recommendations service
+#
+# dumps() uses the fastest encoder installed (orjson, then ujson) and
+# falls back to the standard library; JSON_BACKEND names one to force
+# it. Flask's own json.dumps sorts keys, which sends the standard
+# library down its pure Python encoder, so the service never uses it
+# for responses.
+#
+# Recommendation rows are the bulk of every list body. They are
+# encoded straight from the result tuples into a fixed template in
+# column order, without building a dict per row first.
+######################################################################
+
+import os
+import json
+from json.encoder import encode_basestring_ascii
+
+# Columns of a recommendation row, in the order they are selected
+COLUMNS = ('id', 'parent_product_id', 'related_product_id', 'type', 'priority')
+
+ROW_TEMPLATE = '{"id": %d, "parent_product_id": %d, "related_product_id": %d, "type": %s, "priority": %s}'
+
+BACKENDS = ('orjson', 'ujson', 'json')
+
+
+def _orjson():
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+    return dumps
+
+
+def _ujson():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=True)
+    return dumps
+
+
+def _json():
+    encoder = json.JSONEncoder()
+    return encoder.encode
+
+
+LOADERS = {'orjson': _orjson, 'ujson': _ujson, 'json': _json}
+
+
+def load_backend(name=None):
+    """ Returns (name, dumps) of the named backend, or the first installed """
+    if name and name != 'auto':
+        return name, LOADERS[name]()
+    for candidate in BACKENDS:
+        try:
+            return candidate, LOADERS[candidate]()
+        except ImportError:
+            continue
+
+
+backend, dumps = load_backend(os.getenv('JSON_BACKEND'))
+
+
+def encode_row(rec):
+    """ Encodes one recommendation row as a JSON object """
+    id, parent_product_id, related_product_id, rec_type, priority = rec
+    return ROW_TEMPLATE % (id, parent_product_id, related_product_id,
+                           encode_basestring_ascii(rec_type),
+                           'null' if priority is None else int(priority))
+
+
+def encode_rows(rows):
+    """ Encodes recommendation rows as a JSON array """
+    return '[' + ', '.join([encode_row(rec) for rec in rows]) + ']'
@@ -12,13 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
+# startup is measured from here, before the heavy imports
+IMPORT_STARTED = time.time()
+
 import os
+import re
+import imp
+import atexit
+import base64
+import logging
 from threading import Lock
-from flask import Flask, Response, jsonify, request, json
+from contextlib import contextmanager
+from collections import OrderedDict
+from flask import Flask, Response, jsonify, request, json, g, url_for, send_from_directory
+from urllib import urlencode
 #from simplejson import JSONDecodeError
 from sqlalchemy import *
 from sqlalchemy.exc import *
-from flasgger import Swagger
+import storage
+import queries
+import migrations
+import cache
+import clicks
+import graph
+import serializer
+import metrics
+import replicas
+import shards
+import changes
 
 # Create Flask application
 app = Flask(__name__)
@@ -37,16 +59,45 @@ app.config['SWAGGER'] = {
     ]
 }
 
-# Initialize Swagger after configuring it
-Swagger(app)
+# The spec is built from the route docstrings on its first request, so
+# flasgger and its YAML parser are not imported until it is asked for
+swagger_spec = None
+swagger_lock = Lock()
 
 # Status Codes
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
 HTTP_400_BAD_REQUEST = 400
 HTTP_404_NOT_FOUND = 404
 HTTP_409_CONFLICT = 409
+HTTP_410_GONE = 410
+HTTP_500_INTERNAL_SERVER_ERROR = 500
+HTTP_501_NOT_IMPLEMENTED = 501
+HTTP_503_SERVICE_UNAVAILABLE = 503
+
+# Rows written per executemany by the bulk endpoints
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', '1000'))
+
+# Paginated lists return PAGE_SIZE rows unless limit asks for fewer/more
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Parent products one batch lookup may ask for
+MAX_LOOKUP_PRODUCTS = 100
+# Rows fetched from the server-side cursor per chunk of an export
+EXPORT_CHUNK_SIZE = 1000
+# The width of the type column
+MAX_TYPE_LENGTH = 20
+
+# Conditional GETs: clients and CDNs may reuse a response for
+# HTTP_MAX_AGE seconds, then revalidate it with its ETag
+CACHE_CONTROL = 'public, max-age=%d, must-revalidate' % int(os.getenv('HTTP_MAX_AGE', '0'))
+ITEM_ETAG = re.compile(r'^r(\d+)-p(\d+)-')
+# Recommendations whose parent product is remembered in item_parents
+MAX_ITEM_PARENTS = 100000
+
+logger = logging.getLogger(__name__)
 
 debug = (os.getenv('DEBUG', 'False') == 'True')
 port = os.getenv('PORT', '5000')
@@ -54,6 +105,63 @@ port = os.getenv('PORT', '5000')
 # Lock for thread-safe counter increment
 lock = Lock()
 
+# Serialized GET /recommendations?product-id= bodies
+list_cache = cache.create_cache()
+# Processes serving requests, set by gunicorn.conf.py. The versions of
+# an in-process cache are not seen by the others, so ETags are only
+# issued when it is the only one or the cache is shared
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', '1'))
+
+# Set by initialize_mysql() when CLICK_MODE=batched
+click_batcher = None
+
+# Set by initialize_mysql() when CLICK_EVENTS=True
+click_events = None
+
+# Set by initialize_mysql() when READ_MODE=graph
+graph_loader = None
+
+# Set by initialize_mysql() when METRICS=True
+request_metrics = None
+
+# Set by initialize_mysql(), None until the process is initialized
+database_url = None
+database_test = False
+# Created from database_url by get_engine(), when initialize_mysql() or
+# the first request that needs the database calls it
+engine = None
+engine_lock = Lock()
+
+# Seconds from importing server to create_app() returning, reported
+# against STARTUP_BUDGET_MS
+STARTUP_BUDGET_MS = float(os.getenv('STARTUP_BUDGET_MS', '1000'))
+startup_seconds = None
+
+# Set by get_engine() when REPLICA_URIS lists read replicas
+replica_set = None
+# Products written within READ_YOUR_WRITES_SECONDS, read from the primary
+recent_writes = replicas.RecentWrites()
+# Cookie holding the time a client's reads may go back to the replicas
+WROTE_COOKIE = 'wrote-until'
+
+# Set by get_engine() when SHARD_URIS lists the shard databases, the
+# engine then holds the shard directory
+shard_set = None
+
+# Set by initialize_mysql() when CHANGE_LOG_DIR is set
+change_log = None
+# Seconds a GET /recommendations/changes stream stays open
+CHANGE_STREAM_SECONDS = float(os.getenv('CHANGE_STREAM_SECONDS', '300'))
+
+# Set by drain() once the process has been asked to stop
+draining = False
+
+# Recommendation id -> parent product id, remembered from reads and
+# writes, least recently used first; see versioned_row() and
+# mutate_by_id()
+item_parents = OrderedDict()
+item_parents_lock = Lock()
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -89,9 +197,42 @@ def list_recommendations():
         description: the id of the product you would like recommendations for
         required: false
         type: int
+      - name: limit
+        in: query
+        description: the number of Recommendations per page, ordered by id
+        required: false
+        type: integer
+      - name: cursor
+        in: query
+        description: the X-Next-Cursor header of the previous page
+        required: false
+        type: string
+      - name: top
+        in: query
+        description: only the given number of highest priority Recommendations of the product-id
+        required: false
+        type: integer
+      - name: product-ids
+        in: query
+        description: comma separated parent products to look up at once, answered as an object of arrays keyed by product id
+        required: false
+        type: string
+      - name: dedup
+        in: query
+        description: with product-ids, list each related product only under the first parent that recommends it
+        required: false
+        type: boolean
+      - name: export
+        in: query
+        description: stream every matching Recommendation as one json array or as ndjson
+        required: false
+        type: string
+        enum:
+          - json
+          - ndjson
     responses:
       200:
-        description: An array of Recommendations
+        description: An array of Recommendations, X-Next-Cursor and Link headers point to the next page. Lists of a product-id carry an ETag
         schema:
           type: array
           items:
@@ -113,30 +254,241 @@ def list_recommendations():
                 priority:
                   type: integer
                   description: the priority of the recommendation (a lower number means higher priority)
+      304:
+        description: Not Modified (the If-None-Match ETag of a product-id list is still current)
+      400:
+        description: Bad Request (the limit, cursor, top or export mode is not valid)
     """
     message = []
     request_type = request.args.get('type')
     request_product_id = request.args.get('product-id')
-    # To mitigate query limit issues consider using session in sqlalchemy
-    query_str = 'SELECT * FROM recommendations'
+    request_limit = request.args.get('limit')
+    request_cursor = request.args.get('cursor')
+    request_export = request.args.get('export')
+    request_top = request.args.get('top')
+    request_product_ids = request.args.get('product-ids')
+    if request_product_ids is not None:
+        return lookup_response(request_product_ids.split(','), request_type,
+                               request_top, request.args.get('dedup') == 'true')
+    if request_product_id:
+        try:
+            request_product_id = int(request_product_id)
+        except ValueError:
+            # no product can match an id that is not a number
+            return reply(message, HTTP_200_OK)
     if request_type and request_product_id:
-        query_str += (' WHERE type=%s AND parent_product_id=%s' \
-                      % (request_type, request_product_id))
+        name = 'by_product_and_type'
     elif request_type:
-        query_str += (' WHERE type=%s' % request_type)
+        name = 'by_type'
     elif request_product_id:
-        query_str += (' WHERE parent_product_id=%s' % request_product_id)
+        name = 'by_product'
+    else:
+        name = 'all'
+    params = {'type': request_type, 'parent_product_id': request_product_id}
+
+    if request_top:
+        try:
+            top = min(int(request_top), MAX_PAGE_SIZE)
+            if top < 1:
+                raise ValueError('top must be positive')
+        except ValueError:
+            return reply({'error': 'top must be a positive number'}, HTTP_400_BAD_REQUEST)
+        if not request_product_id:
+            return reply({'error': 'top requires a product-id'}, HTTP_400_BAD_REQUEST)
+        return cached_list(request_product_id, list_variant(request_type, top),
+                           'top_' + name, dict(params, limit=top))
+
+    if request_export:
+        if request_export not in ('json', 'ndjson'):
+            return reply({'error': 'export must be json or ndjson'}, HTTP_400_BAD_REQUEST)
+        return export_response(name, params, request_export == 'ndjson')
+
+    if request_limit or request_cursor:
+        try:
+            limit = min(int(request_limit or PAGE_SIZE), MAX_PAGE_SIZE)
+            after_id = decode_cursor(request_cursor) if request_cursor else 0
+            if limit < 1:
+                raise ValueError('limit must be positive')
+        except (ValueError, TypeError):
+            return reply({'error': 'Invalid limit or cursor'}, HTTP_400_BAD_REQUEST)
+        params.update(after_id=after_id, limit=limit)
+        if sharded():
+            rows, resume = shard_set.gather('page_' + name, params, limit)
+        else:
+            rows = queries.execute(get_read_conn(), 'page_' + name, **params).fetchall()
+            resume = rows[-1][0] if len(rows) == limit else None
+        response = reply_json(serializer.encode_rows(rows), HTTP_200_OK)
+        if resume is not None:
+            next_cursor = encode_cursor(resume)
+            args = request.args.to_dict()
+            args.update({'limit': limit, 'cursor': next_cursor})
+            response.headers['X-Next-Cursor'] = next_cursor
+            response.headers['Link'] = '<%s?%s>; rel="next"' % (request.base_url, urlencode(args))
+        return response
+
+    if request_product_id:
+        return cached_list(request_product_id, list_variant(request_type),
+                           'list_' + name, params)
+    if sharded():
+        # every shard at once, merged in id order
+        results, resume = shard_set.gather('sorted_' + name, params)
+    else:
+        results = queries.execute(get_read_conn(), 'list_' + name, **params)
+    return reply_json(serializer.encode_rows(results), HTTP_200_OK)
+
+######################################################################
+# LOOK UP THE RECOMMENDATIONS OF SEVERAL PRODUCTS AT ONCE
+######################################################################
+@app.route('/recommendations/lookup', methods=['POST'])
+def lookup_recommendations():
+    """
+    Retrieve the Recommendations of several products at once
+    This endpoint will return the Recommendations of every product in the body, grouped by product
+    ---
+    tags:
+      - Recommendations
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          id: Lookup
+          required:
+            - product-ids
+          properties:
+            product-ids:
+              type: array
+              items:
+                type: integer
+              description: the parent products to look up
+            type:
+              type: string
+              description: the type of Recommendation you are looking for
+            top:
+              type: integer
+              description: only the given number of highest priority Recommendations per product
+            dedup:
+              type: boolean
+              description: list each related product only under the first parent that recommends it
+    responses:
+      200:
+        description: An object mapping each product id to its array of Recommendations
+      400:
+        description: Bad Request (the body is not valid)
+    """
+    try:
+        payload = json.loads(request.get_data())
+        product_ids = payload['product-ids']
+        if not isinstance(product_ids, list):
+            raise ValueError('product-ids must be an array')
+    except (ValueError, KeyError, TypeError):
+        return reply({'error': 'body must be an object with a product-ids array'}, HTTP_400_BAD_REQUEST)
+    return lookup_response(product_ids, payload.get('type'), payload.get('top'),
+                           bool(payload.get('dedup')))
+
+######################################################################
+# FOLLOW THE CHANGES TO THE RECOMMENDATIONS
+######################################################################
+@app.route('/recommendations/changes', methods=['GET'])
+def list_changes():
+    """
+    Retrieve the changes made to the Recommendations
+    This endpoint will return the creates, updates, deletes and clicks after a seq of the change log, waiting for them if asked to
+    ---
+    tags:
+      - Recommendations
+    produces:
+      - application/json
+      - application/x-ndjson
+    parameters:
+      - name: since
+        in: query
+        description: the seq of the last change seen, without it no changes are returned and X-Last-Seq is the newest seq
+        required: false
+        type: integer
+      - name: limit
+        in: query
+        description: the most changes to return
+        required: false
+        type: integer
+      - name: wait
+        in: query
+        description: seconds to wait for a change when there is none yet, or for a stream how long it stays open
+        required: false
+        type: number
+      - name: stream
+        in: query
+        description: stream the changes as ndjson while they are made, with an empty line while there are none
+        required: false
+        type: boolean
+    responses:
+      200:
+        description: An array of changes in seq order, X-Last-Seq is the since of the next request
+        schema:
+          type: array
+          items:
+            schema:
+              id: Change
+              properties:
+                seq:
+                  type: integer
+                  description: position of the change in the log, one more than the change before it
+                time:
+                  type: number
+                  description: when the change was logged, in seconds since the epoch
+                op:
+                  type: string
+                  description: create, update, delete or clicked
+                id:
+                  type: integer
+                  description: id of the Recommendation changed
+                parent_product_id:
+                  type: integer
+                  description: unique id of the parent product
+                recommendation:
+                  type: object
+                  description: the Recommendation as created or updated
+      400:
+        description: Bad Request (the since, limit or wait is not valid)
+      404:
+        description: Not Found (no CHANGE_LOG_DIR is configured)
+      410:
+        description: Gone (the changes after since are no longer in the log, read every Recommendation again)
+    """
+    if change_log is None:
+        return reply({'error': 'no CHANGE_LOG_DIR is configured'}, HTTP_404_NOT_FOUND)
+    stream = request.args.get('stream') == 'true'
+    max_wait = CHANGE_STREAM_SECONDS if stream else changes.MAX_WAIT
     try:
-        results = conn.execute(query_str)
-    except OperationalError:
-        results = []
-    for rec in results:
-        message.append({'id': rec[0],
-                        'parent_product_id': rec[1],
-                        'related_product_id': rec[2],
-                        'type': rec[3],
-                        'priority': rec[4]})
-    return reply(message, HTTP_200_OK)
+        since = request.args.get('since')
+        since = int(since) if since is not None else None
+        limit = min(int(request.args.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE)
+        wait = min(float(request.args.get('wait', max_wait if stream else 0)), max_wait)
+        if (since is not None and since < 0) or limit < 1 or wait < 0:
+            raise ValueError('since, limit and wait must not be negative')
+    except ValueError:
+        return reply({'error': 'Invalid since, limit or wait'}, HTTP_400_BAD_REQUEST)
+    if since is None:
+        response = reply_json('[]', HTTP_200_OK)
+        response.headers['X-Last-Seq'] = str(change_log.stats()['last_seq'])
+        return response
+    try:
+        lines = change_log.read(since, limit)
+        if stream:
+            return Response(stream_changes(lines, since, wait), status=HTTP_200_OK,
+                            mimetype='application/x-ndjson')
+        if not lines and wait:
+            change_log.wait(since, wait)
+            lines = change_log.read(since, limit)
+    except changes.ChangesGoneError as err:
+        return reply({'error': '%s, read every Recommendation again' % err}, HTTP_410_GONE)
+    response = reply_json('[' + ', '.join(lines) + ']', HTTP_200_OK)
+    response.headers['X-Last-Seq'] = str(changes.seq_of(lines[-1]) if lines else since)
+    return response
 
 ######################################################################
 # RETRIEVE Recommendations for a given recommendations ID
@@ -178,15 +530,22 @@ def get_recommendations(id):
             priority:
               type: integer
               description: the priority of the recommendation (a lower number means higher priority)
+      304:
+        description: Not Modified (the If-None-Match ETag is still current)
       404:
         description: Recommendation not found
     """
-    message = retrieve_by_id(id)
-    rc = HTTP_200_OK
-    if not message:
+    # the ETag names the parent product, whose version can be checked
+    # without reading the row
+    for tag in request.if_none_match:
+        match = ITEM_ETAG.match(tag)
+        if match and int(match.group(1)) == id and item_etag(id, int(match.group(2))) == tag:
+            return not_modified(tag)
+    rec, tag = versioned_row(id)
+    if rec is None:
         message = {'error': 'Recommendation with id: %s was not found' % str(id)}
-        rc = HTTP_404_NOT_FOUND
-    return reply(message, rc)
+        return reply(message, HTTP_404_NOT_FOUND)
+    return with_etag(reply_json(serializer.encode_row(rec), HTTP_200_OK), tag)
 
 ######################################################################
 # ADD A NEW PRODUCT RECOMMENDATION RELATIONSHIP
@@ -250,19 +609,26 @@ def create_recommendations():
               description: the priority of the recommendation (a lower number means higher priority)
       400:
         description: Bad Request (the posted data was not valid)
+      409:
+        description: Conflict (the relationship already exists)
     """
     message, valid = is_valid(request.get_data())
     if valid:
         payload = json.loads(request.get_data())
-        id = next_index()
-        conn.execute("INSERT INTO recommendations VALUES (%s, %s, %s, \"%s\", %s)" % \
-                    (id, \
-                    payload['parent_product_id'], \
-                    payload['related_product_id'], \
-                    payload['type'], \
-                    payload['priority']))
-        message = retrieve_by_id(id)
-        rc = HTTP_201_CREATED
+        conn = product_conn(payload['parent_product_id'], write=True)
+        # the new id is marked pending before the commit, until it is logged
+        with pending() as mark:
+            try:
+                with conn.begin():
+                    message = insert_recommendation(conn, payload)
+                    mark([message['id']])
+            except IntegrityError as err:
+                return integrity_error_reply(err, payload)
+            invalidate_product(message['parent_product_id'])
+            remember_parent(message['id'], message['parent_product_id'])
+            rec = [message[column] for column in serializer.COLUMNS]
+            log_changes(changes.CREATE, [rec])
+        return reply_json(serializer.encode_row(rec), HTTP_201_CREATED)
     else:
         # message = { 'error' : 'Data is not valid' }
         rc = HTTP_400_BAD_REQUEST
@@ -335,24 +701,37 @@ def update_recommendations(id):
                description: the priority of the recommendation (a lower number means higher priority)
       400:
         description: Bad Request (the posted data was not valid)
+      409:
+        description: Conflict (another recommendation has the same parent, related product and type)
     """
-    if get_recommendations(id).status_code == 404:
-        message = {'error': 'Recommendation with id: %s was not found' % str(id)}
-        return reply(message, HTTP_404_NOT_FOUND)
     message, valid = is_valid(request.get_data())
     if valid:
         payload = json.loads(request.get_data())
-        conn.execute("UPDATE recommendations \
-                      SET type=\"%s\", priority=%s \
-                      WHERE parent_product_id=%s \
-                      AND related_product_id=%s AND id=%s"
-                     % (payload['type'],
-                        payload['priority'],
-                        payload['parent_product_id'],
-                        payload['related_product_id'],
-                        id
-                        ))
-        return get_recommendations(id)
+        rec = [id, int(payload['parent_product_id']), int(payload['related_product_id']),
+               payload['type'], int(payload['priority'])]
+        with serialized([id]):
+            try:
+                updated = queries.execute(id_conn(id, write=True), 'update',
+                                          rec_id=id,
+                                          parent_product_id=rec[1],
+                                          related_product_id=rec[2],
+                                          new_type=rec[3],
+                                          new_priority=rec[4]).rowcount
+            except IntegrityError as err:
+                return integrity_error_reply(err, payload)
+            if updated:
+                # the row now holds exactly the values it was matched and set with
+                invalidate_product(rec[1])
+                remember_parent(id, rec[1])
+                log_changes(changes.UPDATE, [rec])
+                return reply_json(serializer.encode_row(rec), HTTP_200_OK)
+            # either the id does not exist or it belongs to another
+            # relationship, which is left as it is
+            rec = retrieve_by_id(id, id_conn(id, write=True))
+            if rec is None:
+                message = {'error': 'Recommendation with id: %s was not found' % str(id)}
+                return reply(message, HTTP_404_NOT_FOUND)
+            return reply_json(serializer.encode_row(rec), HTTP_200_OK)
     else:
         #message = {'error': 'Invalid Request'}
         rc = HTTP_400_BAD_REQUEST
@@ -380,8 +759,12 @@ def delete_recommendations(id):
       204:
         description: recommendation deleted
     """
-    if get_recommendations(id).status_code == 200:
-        conn.execute("DELETE FROM recommendations WHERE id=%d" % id)
+    with serialized([id]):
+        parent_product_id = mutate_by_id('delete', id)
+        if parent_product_id is not None:
+            forget_parent(id)
+            invalidate_product(parent_product_id)
+            log_changes(changes.DELETE, [(id, parent_product_id)])
     return '', HTTP_204_NO_CONTENT
 
 ######################################################################
@@ -405,6 +788,11 @@ def increase_priority(id):
         description: ID of recommendation to retrieve
         type: integer
         required: true
+      - name: session
+        in: query
+        description: the client session the click belongs to, recorded with CLICK_EVENTS=True (or the X-Session-Id header)
+        required: false
+        type: string
     responses:
       200:
         description: Recommendation priority Updated
@@ -420,121 +808,1587 @@ def increase_priority(id):
       404:
         description: Recommendation not found
     """
-    if get_recommendations(id).status_code == 404:
-        message = {'error': 'Recommendation with id: %s was not found' % str(id)}
-        return reply(message, HTTP_404_NOT_FOUND)
     """
     Decrements the priority from low to high of the recommendations_id until 1
     """
-    conn.execute("UPDATE recommendations \
-                  SET priority= priority - 1 \
-                  WHERE id=%d \
-                  AND priority>1"
-                 % (id))
+    if click_batcher is not None:
+        # only an id this process has not seen is read before queueing;
+        # a remembered id deleted elsewhere still answers 200, and its
+        # clicks match no row when the batch is written
+        parent_product_id = recall_parent(id)
+        if parent_product_id is None:
+            rec = retrieve_by_id(id)
+            if rec is not None:
+                parent_product_id = remember_parent(id, rec['parent_product_id'])
+        if parent_product_id is not None:
+            click_batcher.click(id, parent_product_id)
+    else:
+        with serialized([id]):
+            parent_product_id = mutate_by_id('clicked', id)
+            if parent_product_id is not None:
+                invalidate_product(parent_product_id)
+                log_changes(changes.CLICKED, [(id, parent_product_id)])
+    if parent_product_id is None:
+        message = {'error': 'Recommendation with id: %s was not found' % str(id)}
+        return reply(message, HTTP_404_NOT_FOUND)
+    if click_events is not None:
+        session = request.args.get('session') or request.headers.get('X-Session-Id')
+        click_events.record(id, parent_product_id, session and session[:64])
     return reply(None, HTTP_200_OK)
 
 ######################################################################
-#  U T I L I T Y   F U N C T I O N S
+# BULK ADD PRODUCT RECOMMENDATION RELATIONSHIPS
 ######################################################################
-def next_index():
-    max_id_result = conn.execute("select max(id) from recommendations")
-    return list(max_id_result)[0][0] + 1
-
-def reply(message, rc):
-    # print "message = " + str(message);
-    response = Response(json.dumps(message))
-    response.headers['Content-Type'] = 'application/json'
-    response.status_code = rc
-    return response
-
-def is_valid(raw_data):
-    try:
-        data = json.loads(raw_data)
-    except:
-        message = {'error': 'JSON decoding error'}
-        return message, False
-    if set(data.keys()) != set(['priority', 'related_product_id', 'parent_product_id', 'type']):
-        # app.logger.error('key set does not match')
-        message = {'error': 'key set does not match'}
-        return message, False
-    try:
-        # Not sure if we should check data type or exceptions
-        # If we check exceptions, input 1 and "1" will be treated as the same
-        priority = int(data['priority'])
-        related_pid = int(data['related_product_id'])
-        parent_pid = int(data['parent_product_id'])
-    except ValueError as err:
-        # app.logger.error('Data value error: %s', err)
-        message = {'error': 'Data value error: %s' % err}
-        return message, False
-    except TypeError as err:
-        # app.logger.error('Data type error: %s', err)
-        message = {'error': 'Data type error: %s' % err}
-        return message, False
-    return "", True
-
-def retrieve_by_id(id):
-    message = {}
-    results = conn.execute("SELECT * FROM recommendations WHERE id=%d" % (int(id)))
-    for rec in results:
-        message = {"id": rec[0],
-                   "parent_product_id": rec[1],
-                   "related_product_id": rec[2],
-                   "type": rec[3],
-                   "priority": rec[4]}
-    return message
-
+@app.route('/recommendations/bulk', methods=['POST'])
+def create_recommendations_bulk():
+    """
+    Create many product recommendation relationships at once
+    This endpoint will create a recommendation for every row of a JSON array or NDJSON body
+    ---
+    tags:
+      - Recommendations
+    consumes:
+      - application/json
+      - application/x-ndjson
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            schema:
+              id: data
+              properties:
+                parent_product_id:
+                  type: integer
+                  description: unique id of the parent product
+                related_product_id:
+                  type: integer
+                  description: unique id of the recommended product
+                type:
+                  type: string
+                  description: the category of recommendation (e.g., up-sell, x-sell, etc.)
+                priority:
+                  type: integer
+                  description: the priority of the recommendation (a lower number means higher priority)
+    responses:
+      200:
+        description: The status of every row, in the order they were sent
+        schema:
+          type: array
+          items:
+            schema:
+              id: BulkStatus
+              properties:
+                index:
+                  type: integer
+                  description: position of the row in the request
+                status:
+                  type: integer
+                  description: HTTP status of the row (201 created, 400 invalid, 409 already exists)
+                id:
+                  type: integer
+                  description: id of the recommendation the row refers to
+                error:
+                  type: string
+                  description: why the row was rejected
+      400:
+        description: Bad Request (the body is not a JSON array)
+      501:
+        description: Not Implemented (the recommendations are sharded)
+    """
+    if sharded():
+        return reply({'error': 'bulk writes are not supported with SHARD_URIS'}, HTTP_501_NOT_IMPLEMENTED)
+    rows = bulk_rows()
+    if rows is None:
+        return reply({'error': 'JSON decoding error'}, HTTP_400_BAD_REQUEST)
+    results = []
+    touched = set()
+    # changes of the rows written, logged once the transaction commits
+    logged = []
+    conn = get_conn()
+    with pending() as mark:
+        with conn.begin():
+            for chunk in chunked(enumerate(rows), BULK_CHUNK_SIZE):
+                params = []
+                for index, row in chunk:
+                    message, valid = is_valid_payload(row)
+                    if not valid:
+                        results.append({'index': index, 'status': HTTP_400_BAD_REQUEST,
+                                        'error': message['error']})
+                        continue
+                    params.append({'parent_product_id': int(row['parent_product_id']),
+                                   'related_product_id': int(row['related_product_id']),
+                                   'type': row['type'],
+                                   'priority': int(row['priority'])})
+                    results.append({'index': index, 'status': HTTP_201_CREATED})
+                    touched.add(int(row['parent_product_id']))
+                created = [result for result in results[-len(chunk):]
+                           if result['status'] == HTTP_201_CREATED]
+                marked = len(logged)
+                for result, row, id in zip(created, params, queries.insert_rows(conn, params)):
+                    if id is None:
+                        result.update(conflict_message(row), status=HTTP_409_CONFLICT)
+                    else:
+                        result['id'] = id
+                        logged.append((id, row['parent_product_id'], row['related_product_id'],
+                                       row['type'], row['priority']))
+                mark(rec[0] for rec in logged[marked:])
+        invalidate_products(touched)
+        log_changes(changes.CREATE, logged)
+    return reply(results, HTTP_200_OK)
 
 ######################################################################
-# Connect to MySQL and catch connection exceptions
+# BULK UPDATE PRODUCT RECOMMENDATION RELATIONSHIPS
 ######################################################################
-def connect_mysql(user, passwd, server, port, database):
-    engine = create_engine("mysql://%s:%s@%s:%s/%s" % (user, passwd, server, port, database), echo = False)
-    return engine.connect()
-
+@app.route('/recommendations/bulk', methods=['PUT'])
+def update_recommendations_bulk():
+    """
+    Update many product recommendation relationships at once
+    This endpoint will update the recommendation named by the id of every row of a JSON array or NDJSON body
+    ---
+    tags:
+      - Recommendations
+    consumes:
+      - application/json
+      - application/x-ndjson
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            schema:
+              id: BulkUpdate
+              properties:
+                id:
+                  type: integer
+                  description: ID of the recommendation to update
+                parent_product_id:
+                  type: integer
+                  description: unique id of the parent product
+                related_product_id:
+                  type: integer
+                  description: unique id of the recommended product
+                type:
+                  type: string
+                  description: the category of recommendation (e.g., up-sell, x-sell, etc.)
+                priority:
+                  type: integer
+                  description: the priority of the recommendation (a lower number means higher priority)
+    responses:
+      200:
+        description: The status of every row, in the order they were sent
+        schema:
+          type: array
+          items:
+            schema:
+              id: BulkStatus
+              properties:
+                index:
+                  type: integer
+                  description: position of the row in the request
+                status:
+                  type: integer
+                  description: HTTP status of the row (200 updated, 400 invalid, 404 not found, 409 conflict)
+                id:
+                  type: integer
+                  description: id of the recommendation the row refers to
+                error:
+                  type: string
+                  description: why the row was rejected
+      400:
+        description: Bad Request (the body is not a JSON array)
+      501:
+        description: Not Implemented (the recommendations are sharded)
+    """
+    if sharded():
+        return reply({'error': 'bulk writes are not supported with SHARD_URIS'}, HTTP_501_NOT_IMPLEMENTED)
+    rows = bulk_rows()
+    if rows is None:
+        return reply({'error': 'JSON decoding error'}, HTTP_400_BAD_REQUEST)
+    results = []
+    touched = set()
+    # changes of the rows written, logged once the transaction commits
+    logged = []
+    rows, ids = bulk_ids(rows)
+    with serialized(ids):
+        conn = get_conn()
+        with conn.begin():
+            for chunk in chunked(enumerate(rows), BULK_CHUNK_SIZE):
+                checked = []
+                for index, row in chunk:
+                    rec_id = row.pop('id', None) if isinstance(row, dict) else None
+                    message, valid = is_valid_payload(row)
+                    if valid:
+                        try:
+                            rec_id = int(rec_id)
+                        except (ValueError, TypeError):
+                            message, valid = {'error': 'Data value error: invalid id'}, False
+                    checked.append((index, rec_id, row, message, valid))
+                parents = existing_parents([c[1] for c in checked if c[4]])
+                params = []
+                updated = []
+                for index, rec_id, row, message, valid in checked:
+                    if not valid:
+                        results.append({'index': index, 'status': HTTP_400_BAD_REQUEST,
+                                        'error': message['error']})
+                    elif rec_id not in parents:
+                        results.append({'index': index, 'status': HTTP_404_NOT_FOUND, 'id': rec_id,
+                                        'error': 'Recommendation with id: %s was not found' % rec_id})
+                    else:
+                        params.append({'rec_id': rec_id,
+                                       'new_type': row['type'],
+                                       'new_priority': int(row['priority']),
+                                       'parent_product_id': int(row['parent_product_id']),
+                                       'related_product_id': int(row['related_product_id'])})
+                        updated.append({'index': index, 'status': HTTP_200_OK, 'id': rec_id})
+                        results.append(updated[-1])
+                        touched.add(parents[rec_id])
+                if params:
+                    try:
+                        conn.execute(queries.compiled['update'], params)
+                    except IntegrityError:
+                        # find the conflicting rows one by one, every update
+                        # sets absolute values so repeating the others is safe
+                        for result, row in zip(updated, params):
+                            try:
+                                conn.execute(queries.compiled['update'], row)
+                            except IntegrityError as err:
+                                if not queries.is_duplicate(err):
+                                    raise
+                                result.update(conflict_message({'parent_product_id': row['parent_product_id'],
+                                                                'related_product_id': row['related_product_id'],
+                                                                'type': row['new_type']}),
+                                              status=HTTP_409_CONFLICT)
+                logged.extend((row['rec_id'], row['parent_product_id'], row['related_product_id'],
+                               row['new_type'], row['new_priority'])
+                              for result, row in zip(updated, params) if result['status'] == HTTP_200_OK)
+        invalidate_products(touched)
+        log_changes(changes.UPDATE, logged)
+    return reply(results, HTTP_200_OK)
 
 ######################################################################
-# INITIALIZE MySQL
-# This method will work in the following conditions:
-#   1) In Bluemix with cleardb bound through VCAP_SERVICES
-#   2) With MySQL --linked in a Docker container in virtual machine
+# BULK DELETE PRODUCT RECOMMENDATIONS
 ######################################################################
-def initialize_mysql(test=False):
-    global conn
-    conn = None
-    # Get the crdentials from the Bluemix environment
-    if 'VCAP_SERVICES' in os.environ:
-        print("Using VCAP_SERVICES...")
-        VCAP_SERVICES = os.environ['VCAP_SERVICES']
-        services = json.loads(VCAP_SERVICES)
-        creds = services['cleardb'][0]['credentials']
-        print("Conecting to Mysql on host %s port %s" % (creds['hostname'], creds['port']))
-        conn = connect_mysql(creds['username'], creds['password'], creds['hostname'], creds['port'], creds['name'])
+@app.route('/recommendations/bulk', methods=['DELETE'])
+def delete_recommendations_bulk():
+    """
+    Delete many recommendations at once
+    This endpoint will delete every recommendation whose id is listed in a JSON array or NDJSON body
+    ---
+    tags:
+      - Recommendations
+    consumes:
+      - application/json
+      - application/x-ndjson
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            type: integer
+            description: ID of a recommendation to delete
+    responses:
+      200:
+        description: The status of every row, in the order they were sent
+        schema:
+          type: array
+          items:
+            schema:
+              id: BulkStatus
+              properties:
+                index:
+                  type: integer
+                  description: position of the row in the request
+                status:
+                  type: integer
+                  description: HTTP status of the row (204 deleted, 400 invalid, 404 not found)
+                id:
+                  type: integer
+                  description: id of the recommendation the row refers to
+                error:
+                  type: string
+                  description: why the row was rejected
+      400:
+        description: Bad Request (the body is not a JSON array)
+      501:
+        description: Not Implemented (the recommendations are sharded)
+    """
+    if sharded():
+        return reply({'error': 'bulk writes are not supported with SHARD_URIS'}, HTTP_501_NOT_IMPLEMENTED)
+    rows = bulk_rows()
+    if rows is None:
+        return reply({'error': 'JSON decoding error'}, HTTP_400_BAD_REQUEST)
+    results = []
+    touched = set()
+    # changes of the rows written, logged once the transaction commits
+    logged = []
+    rows, ids = bulk_ids(rows)
+    with serialized(ids):
+        conn = get_conn()
+        with conn.begin():
+            for chunk in chunked(enumerate(rows), BULK_CHUNK_SIZE):
+                ids = []
+                for index, row in chunk:
+                    # a row is either a bare id or an object with an id
+                    if isinstance(row, dict):
+                        row = row.get('id')
+                    try:
+                        ids.append((index, int(row)))
+                    except (ValueError, TypeError):
+                        results.append({'index': index, 'status': HTTP_400_BAD_REQUEST,
+                                        'error': 'Data value error: invalid id'})
+                        ids.append((index, None))
+                parents = existing_parents([rec_id for index, rec_id in ids if rec_id is not None])
+                params = []
+                for index, rec_id in ids:
+                    if rec_id is None:
+                        continue
+                    if rec_id in parents:
+                        params.append({'rec_id': rec_id, 'parent_product_id': parents[rec_id]})
+                        results.append({'index': index, 'status': HTTP_204_NO_CONTENT, 'id': rec_id})
+                        touched.add(parents[rec_id])
+                    else:
+                        results.append({'index': index, 'status': HTTP_404_NOT_FOUND, 'id': rec_id,
+                                        'error': 'Recommendation with id: %s was not found' % rec_id})
+                if params:
+                    conn.execute(queries.compiled['delete'], params)
+                logged.extend((row['rec_id'], row['parent_product_id']) for row in params)
+        invalidate_products(touched)
+        log_changes(changes.DELETE, logged)
+    results.sort(key=lambda result: result['index'])
+    return reply(results, HTTP_200_OK)
+
+######################################################################
+# ADMIN - CACHE STATISTICS
+######################################################################
+@app.route('/admin/cache', methods=['GET'])
+def cache_stats():
+    """
+    Retrieve the recommendation list cache statistics
+    This endpoint will return the hit, miss and eviction counters of the cache
+    ---
+    tags:
+      - Admin
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Cache statistics
+        schema:
+          id: CacheStats
+          properties:
+            size:
+              type: integer
+              description: number of cached lists
+            maxsize:
+              type: integer
+              description: maximum number of cached lists
+            ttl:
+              type: number
+              description: seconds a cached list stays valid
+            hits:
+              type: integer
+              description: lookups answered from the cache
+            misses:
+              type: integer
+              description: lookups that went to the database
+            evictions:
+              type: integer
+              description: entries dropped for space or expiry
+    """
+    return reply(list_cache.stats(), HTTP_200_OK)
+
+######################################################################
+# ADMIN - INVALIDATE CACHED LISTS
+######################################################################
+@app.route('/admin/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    """
+    Drop the cached lists of products written outside the service
+    This endpoint will drop the cached lists of the products and change their ETags, as a write would
+    ---
+    tags:
+      - Admin
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          id: InvalidateRequest
+          required:
+            - product-ids
+          properties:
+            product-ids:
+              type: array
+              items:
+                type: integer
+              description: the parent products whose recommendations changed
+    responses:
+      200:
+        description: The number of products invalidated
+        schema:
+          id: InvalidateResult
+          properties:
+            invalidated:
+              type: integer
+              description: number of products invalidated
+      400:
+        description: Bad Request (product-ids is not a list of numbers)
+    """
+    try:
+        product_ids = [int(product_id) for product_id in json.loads(request.get_data())['product-ids']]
+    except (ValueError, TypeError, KeyError):
+        return reply({'error': 'product-ids must be a list of numbers'}, HTTP_400_BAD_REQUEST)
+    invalidate_products(set(product_ids))
+    return reply({'invalidated': len(set(product_ids))}, HTTP_200_OK)
+
+######################################################################
+# ADMIN - GRAPH STATISTICS
+######################################################################
+@app.route('/admin/graph', methods=['GET'])
+def graph_stats():
+    """
+    Retrieve the in-memory recommendation graph statistics
+    This endpoint will return the size of the graph product lists are served from with READ_MODE=graph
+    ---
+    tags:
+      - Admin
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Graph statistics
+        schema:
+          id: GraphStats
+          properties:
+            generation:
+              type: integer
+              description: number of reloads since start-up
+            loaded_at:
+              type: number
+              description: unix time the snapshot was read
+            products:
+              type: integer
+              description: number of parent products
+            edges:
+              type: integer
+              description: number of recommendations
+            bytes:
+              type: integer
+              description: memory held by the graph arrays
+            bytes_per_edge:
+              type: number
+              description: memory per recommendation
+      404:
+        description: Not Found (the service is not in graph mode)
+    """
+    if graph_loader is None:
+        return reply({'error': 'READ_MODE is not graph'}, HTTP_404_NOT_FOUND)
+    return reply(graph_loader.graph.stats(), HTTP_200_OK)
+
+######################################################################
+# ADMIN - READ REPLICA STATISTICS
+######################################################################
+@app.route('/admin/replicas', methods=['GET'])
+def replica_stats():
+    """
+    Retrieve the read replica statistics
+    This endpoint will return the state of the replicas GET requests are read from
+    ---
+    tags:
+      - Admin
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Replica statistics
+        schema:
+          id: ReplicaStats
+          properties:
+            policy:
+              type: string
+              description: round-robin or least-busy
+            replicas:
+              type: integer
+              description: number of replicas configured
+            healthy:
+              type: integer
+              description: number of replicas not ejected
+            ejections:
+              type: integer
+              description: number of times a replica was ejected since start-up
+            checked_out:
+              type: array
+              items:
+                type: integer
+              description: connections checked out of each replica's pool
+      404:
+        description: Not Found (no REPLICA_URIS are configured)
+    """
+    if replica_set is None:
+        return reply({'error': 'no REPLICA_URIS are configured'}, HTTP_404_NOT_FOUND)
+    return reply(replica_set.stats(), HTTP_200_OK)
+
+######################################################################
+# READINESS
+######################################################################
+@app.route('/ready', methods=['GET'])
+def readiness():
+    """
+    Check whether this instance should receive traffic
+    This endpoint will answer 200 once the database is reachable and until the instance starts draining
+    ---
+    tags:
+      - Admin
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Ready
+      503:
+        description: Service Unavailable (starting, draining or the database is unreachable)
+    """
+    if database_url is None:
+        return reply({'status': 'starting'}, HTTP_503_SERVICE_UNAVAILABLE)
+    if draining:
+        return reply({'status': 'draining'}, HTTP_503_SERVICE_UNAVAILABLE)
+    try:
+        # creates the engine if no request has needed it yet
+        get_conn().scalar(select([1]))
+    except DBAPIError:
+        return reply({'status': 'database unavailable'}, HTTP_503_SERVICE_UNAVAILABLE)
+    return reply({'status': 'ready'}, HTTP_200_OK)
+
+######################################################################
+# ADMIN - SHARD STATISTICS
+######################################################################
+@app.route('/admin/shards', methods=['GET'])
+def shard_stats():
+    """
+    Retrieve the shard directory
+    This endpoint will return how many buckets of parent products each shard holds
+    ---
+    tags:
+      - Admin
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Shard statistics
+        schema:
+          id: ShardStats
+          properties:
+            buckets:
+              type: array
+              items:
+                type: integer
+              description: number of buckets each shard holds
+            moving:
+              type: array
+              items:
+                type: integer
+              description: buckets being moved between shards, which cannot be written
+      404:
+        description: Not Found (no SHARD_URIS are configured)
+    """
+    if not sharded():
+        return reply({'error': 'no SHARD_URIS are configured'}, HTTP_404_NOT_FOUND)
+    return reply(shard_set.stats(), HTTP_200_OK)
+
+######################################################################
+# ADMIN - CHANGE LOG STATISTICS
+######################################################################
+@app.route('/admin/changes', methods=['GET'])
+def change_log_stats():
+    """
+    Retrieve the change log statistics
+    This endpoint will return the seqs the change log holds and its segments
+    ---
+    tags:
+      - Admin
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Change log statistics
+        schema:
+          id: ChangeLogStats
+          properties:
+            first_seq:
+              type: integer
+              description: the oldest change still in the log, since must be at least one less
+            last_seq:
+              type: integer
+              description: the newest change
+            segments:
+              type: integer
+              description: segment files on disk
+            in_memory:
+              type: integer
+              description: changes this process serves from memory
+      404:
+        description: Not Found (no CHANGE_LOG_DIR is configured)
+    """
+    if change_log is None:
+        return reply({'error': 'no CHANGE_LOG_DIR is configured'}, HTTP_404_NOT_FOUND)
+    return reply(change_log.stats(), HTTP_200_OK)
+
+######################################################################
+# METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Retrieve the service metrics
+    This endpoint will return request, database and cache metrics in the Prometheus text format
+    ---
+    tags:
+      - Admin
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Request latency, database time, query count and response size per route, and the cache counters
+      404:
+        description: Not Found (metrics are disabled with METRICS=False)
+    """
+    if request_metrics is None:
+        return reply({'error': 'METRICS is not True'}, HTTP_404_NOT_FOUND)
+    stats = list_cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    gauges = [('cache_hits_total', 'counter', 'Product lists answered from the cache', stats['hits']),
+              ('cache_misses_total', 'counter', 'Product lists read from the database', stats['misses']),
+              ('cache_hit_ratio', 'gauge', 'Share of product list lookups answered from the cache',
+               float(stats['hits']) / lookups if lookups else 0.0)]
+    if 'evictions' in stats:
+        gauges.append(('cache_evictions_total', 'counter', 'Entries dropped for space or expiry',
+                       stats['evictions']))
+    if startup_seconds is not None:
+        gauges.append(('process_startup_seconds', 'gauge', 'Time from importing the service to serving',
+                       startup_seconds))
+    return Response(request_metrics.render(gauges), status=HTTP_200_OK, content_type=metrics.CONTENT_TYPE)
+
+######################################################################
+# SWAGGER
+# The same routes Swagger(app) would register, except that the spec is
+# built once, on its first request, and served from memory after that
+######################################################################
+@app.route(app.config['SWAGGER']['specs'][0]['route'])
+def get_swagger_spec():
+    """ The Swagger spec of every route with a YAML docstring """
+    global swagger_spec
+    if swagger_spec is None:
+        with swagger_lock:
+            if swagger_spec is None:
+                swagger_spec = build_swagger_spec()
+    return Response(swagger_spec, status=HTTP_200_OK, content_type='application/json')
+
+@app.route('/specs')
+def get_swagger_specs():
+    """ The specs listed by the Swagger UI """
+    config = app.config['SWAGGER']
+    specs = [{'url': url_for('get_swagger_spec'),
+              'title': spec.get('title'),
+              'version': spec.get('version'),
+              'endpoint': spec.get('endpoint')}
+             for spec in config['specs']]
+    return jsonify(specs=specs, title=config.get('title', 'Flasgger'))
+
+@app.route('/apidocs/<path:filename>')
+def get_swagger_ui(filename):
+    """ The Swagger UI shipped with flasgger """
+    # found without importing flasgger
+    folder = os.path.join(imp.find_module('flasgger')[1], 'swaggerui')
+    return send_from_directory(folder, filename)
+
+def build_swagger_spec():
+    """ Renders the spec with flasgger, returning the JSON body """
+    from flasgger.base import OutputView
+    config = app.config['SWAGGER']
+    view = OutputView(view_args={'config': config, 'spec': config['specs'][0]})
+    return view.get().get_data()
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def get_conn():
+    """ Checks out a pooled connection for the lifetime of the request """
+    if 'db_conn' not in g:
+        g.db_conn = get_engine().connect()
+    return g.db_conn
+
+def get_read_conn(product_ids=()):
+    """
+    Checks out a replica connection for the reads of the request, or
+    returns the primary's when there are no replicas, none can be
+    reached, or the client or one of the products wrote recently
+    """
+    if replica_set is None or wrote_recently(product_ids):
+        return get_conn()
+    if 'read_conn' not in g:
+        conn = replica_set.connect()
+        if conn is None:
+            return get_conn()
+        g.read_conn = conn
+    return g.read_conn
+
+def sharded():
+    """
+    Whether the recommendations are spread over shards, opening the
+    engine first as the shards are configured along with it
+    """
+    get_engine()
+    return shard_set is not None
+
+def get_shard_conn(shard):
+    """ Checks out a connection to a shard for the lifetime of the request """
+    if 'shard_conns' not in g:
+        g.shard_conns = {}
+    if shard not in g.shard_conns:
+        g.shard_conns[shard] = shard_set.engines[shard].connect()
+    return g.shard_conns[shard]
+
+def product_conn(product_id, write=False, primary=False):
+    """
+    The connection to read or write a product's recommendations on,
+    primary for reads that must not come from a lagging replica
+    """
+    if not sharded():
+        return get_conn() if write or primary else get_read_conn([product_id])
+    return get_shard_conn(shard_set.shard(shards.bucket_of_product(product_id), write))
+
+def id_conn(id, product_id=None, write=False):
+    """ The connection to read or write a recommendation on, by id """
+    if not sharded():
+        return get_conn() if write else get_read_conn([product_id])
+    return get_shard_conn(shard_set.shard(shards.bucket_of_id(id), write))
+
+def products_by_conn(product_ids, primary=False):
+    """ Pairs the connection to read products on with the products """
+    if not sharded():
+        return [(get_conn() if primary else get_read_conn(product_ids), product_ids)]
+    grouped = {}
+    for product_id in product_ids:
+        shard = shard_set.shard(shards.bucket_of_product(product_id))
+        grouped.setdefault(shard, []).append(product_id)
+    return [(get_shard_conn(shard), group) for shard, group in sorted(grouped.items())]
+
+def from_replica(conn):
+    """ Whether a connection of the request reads from a replica """
+    return 'read_conn' in g and conn is g.read_conn
+
+def wrote_recently(product_ids=()):
+    """ Whether reads of the request must see the primary's latest writes """
+    try:
+        if float(request.cookies.get(WROTE_COOKIE, 0)) > time.time():
+            return True
+    except ValueError:
+        pass
+    return any(recent_writes.recent(product_id) for product_id in product_ids)
+
+@app.before_request
+def start_request_timer():
+    if request_metrics is not None:
+        request_metrics.start()
+
+@app.after_request
+def record_response(response):
+    """ Keeps the status and size of the response for record_request() """
+    if request_metrics is not None:
+        # the Content-Length header, missing from streamed responses
+        g.response_metrics = (response.status_code, response.content_length)
+    return response
+
+@app.teardown_request
+def record_request(exception):
+    """
+    Adds the request to the metrics, by endpoint to bound the labels.
+    after_request is skipped by an unhandled exception, which is
+    counted as a 500.
+    """
+    if request_metrics is not None:
+        status, size = g.pop('response_metrics', (HTTP_500_INTERNAL_SERVER_ERROR, None))
+        request_metrics.finish(request.endpoint or 'none', request.method, status, size)
+
+@app.after_request
+def stick_to_primary(response):
+    """
+    Sends the reads of a client that has just written to the primary
+    for READ_YOUR_WRITES_SECONDS, through a cookie
+    """
+    if replica_set is not None and request.method not in ('GET', 'HEAD') \
+       and request.endpoint != 'lookup_recommendations' and response.status_code < 400:
+        window = recent_writes.window
+        response.set_cookie(WROTE_COOKIE, '%.3f' % (time.time() + window), max_age=int(window) + 1)
+    return response
+
+@app.teardown_request
+def release_conn(exception):
+    """ Returns the request's connections to their pools, even on errors """
+    for name in ('db_conn', 'read_conn'):
+        db_conn = g.pop(name, None)
+        if db_conn is not None:
+            db_conn.close()
+    for db_conn in g.pop('shard_conns', {}).values():
+        db_conn.close()
+
+@app.errorhandler(shards.ShardMovingError)
+def shard_moving(error):
+    """ Writes to products being moved between shards are retried later """
+    response = reply({'error': str(error)}, HTTP_503_SERVICE_UNAVAILABLE)
+    response.headers['Retry-After'] = '1'
+    return response
+
+def invalidate_product(product_id):
+    """ Called after every write to a product's recommendations """
+    list_cache.invalidate(product_id)
+    if replica_set is not None:
+        recent_writes.touch(product_id)
+    if graph_loader is not None:
+        graph_loader.changed()
+
+def invalidate_products(product_ids):
+    for product_id in product_ids:
+        invalidate_product(product_id)
+
+def clicks_flushed(clicked):
+    """ Invalidates and logs the clicks a flush of the batcher committed """
+    invalidate_products(set(parent_product_id for _, parent_product_id in clicked))
+    log_changes(changes.CLICKED, clicked)
+
+@contextmanager
+def serialized(ids):
+    """
+    Holds the writes of ids and the appends of their changes in step,
+    and marks the ids pending until then, when there is a change log
+    """
+    if change_log is None:
+        yield
+    else:
+        with change_log.serialized(ids), change_log.pending() as mark:
+            mark(ids)
+            yield
+
+@contextmanager
+def pending():
+    """
+    Yields a function that marks the ids of a write pending in the
+    change log, if there is one, until the block is left
+    """
+    if change_log is None:
+        yield lambda ids: None
     else:
-        print("VCAP_SERVICES not found, checking localhost for MySQL")
-        response = os.system("ping -c 1 mysql")
-        if response == 0:
-            mysql_hostname = 'mysql'
+        with change_log.pending() as mark:
+            yield mark
+
+def log_changes(op, rows):
+    """ Appends committed writes to the change log, if there is one """
+    if change_log is not None and rows:
+        change_log.append(op, rows)
+
+@atexit.register
+def stop_click_batcher():
+    """ Writes any queued clicks and click events before the process exits """
+    global click_batcher, click_events
+    if click_batcher is not None:
+        click_batcher.stop()
+        click_batcher = None
+    if click_events is not None:
+        click_events.stop()
+        click_events = None
+
+def lookup_response(product_ids, request_type, request_top, dedup):
+    """
+    Answers a batch lookup: every product is tried in the cache first
+    and all the misses are read with a single IN query, then cached
+    """
+    try:
+        product_ids = unique([int(product_id) for product_id in product_ids])
+        top = int(request_top) if request_top else None
+        if top is not None and top < 1:
+            raise ValueError('top must be positive')
+    except (ValueError, TypeError):
+        return reply({'error': 'product ids and top must be numbers'}, HTTP_400_BAD_REQUEST)
+    if len(product_ids) > MAX_LOOKUP_PRODUCTS:
+        return reply({'error': 'at most %d product ids per lookup' % MAX_LOOKUP_PRODUCTS},
+                     HTTP_400_BAD_REQUEST)
+    variant = list_variant(request_type, top)
+    bodies = {}
+    misses = []
+    tokens = {}
+    snapshot = None if graph_loader is None else graph_loader.graph
+    for product_id in product_ids:
+        if snapshot is not None:
+            rows = snapshot.product(product_id, request_type, top)
+            bodies[product_id] = serializer.encode_rows(rows)
+            continue
+        body, _, token = list_cache.lookup(product_id, variant)
+        if body is None:
+            misses.append(product_id)
+            tokens[product_id] = token
+        else:
+            bodies[product_id] = body
+    if misses:
+        grouped = dict((product_id, []) for product_id in misses)
+        # from the primary, a lagging replica could cache a stale list
+        for conn, group in products_by_conn(misses, primary=True):
+            results = conn.execute(queries.select_products(group, request_type, top is not None))
+            for rec in results:
+                rows = grouped[rec[1]]
+                if top is None or len(rows) < top:
+                    rows.append(rec)
+        for product_id in misses:
+            bodies[product_id] = serializer.encode_rows(grouped[product_id])
+            list_cache.set(product_id, variant, bodies[product_id], tokens[product_id])
+    if dedup:
+        seen = set()
+        for product_id in product_ids:
+            rows = [row for row in json.loads(bodies[product_id])
+                    if row['related_product_id'] not in seen]
+            seen.update(row['related_product_id'] for row in rows)
+            bodies[product_id] = serializer.dumps(rows)
+    # the cached bodies are already JSON, only the object around them is built
+    body = '{%s}' % ', '.join('"%d": %s' % (product_id, bodies[product_id])
+                              for product_id in product_ids)
+    return reply_json(body, HTTP_200_OK)
+
+def unique(items):
+    """ Drops repeated items, keeping the first of each in order """
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
+
+def list_variant(request_type, top=None):
+    """ Names the cache entry of a product list from its other parameters """
+    parts = []
+    if top:
+        parts.append('top=%d' % top)
+    if request_type:
+        parts.append('type=' + request_type)
+    return '&'.join(parts) or None
+
+def cached_list(product_id, variant, statement, params):
+    """ Answers a product list from the cache, or the database on a miss """
+    if graph_loader is not None:
+        return graph_list(product_id, params['type'], params.get('limit'))
+    # the version is read before the list, so the tag can only be older
+    # than the body
+    body, version, token = list_cache.lookup(product_id, variant)
+    tag = list_etag(product_id, version)
+    if tag is not None and request.if_none_match.contains(tag):
+        return not_modified(tag)
+    if body is not None:
+        return with_etag(reply_json(body, HTTP_200_OK), tag)
+    # from the primary, a lagging replica could store a list older than
+    # the token in the cache, where it would outlive the lag under a
+    # fresh tag
+    results = queries.execute(product_conn(product_id, primary=True), statement, **params)
+    body = serializer.encode_rows(results)
+    list_cache.set(product_id, variant, body, token)
+    return with_etag(reply_json(body, HTTP_200_OK), tag)
+
+def graph_list(product_id, request_type, top):
+    """ Answers a product list from the current graph snapshot """
+    snapshot = graph_loader.graph
+    # the body only depends on the snapshot, which is never modified
+    tag = 'p%d-g%x' % (product_id, int(snapshot.loaded_at * 1000))
+    if request.if_none_match.contains(tag):
+        return not_modified(tag)
+    rows = snapshot.product(product_id, request_type, top)
+    return with_etag(reply_json(serializer.encode_rows(rows), HTTP_200_OK), tag)
+
+def etag_version(product_id, version=None):
+    """
+    The version of a product that ETags are built from, or None when
+    another process could change it without this one seeing it
+    """
+    if not list_cache.shared and SERVER_WORKERS > 1:
+        return None
+    return list_cache.version(product_id) if version is None else version
+
+def list_etag(product_id, version=None):
+    version = etag_version(product_id, version)
+    return None if version is None else 'p%d-%s' % (product_id, version)
+
+def item_etag(id, parent_product_id):
+    version = etag_version(parent_product_id)
+    return None if version is None else 'r%d-p%d-%s' % (id, parent_product_id, version)
+
+def versioned_row(id):
+    """
+    Returns a recommendation row and its ETag, or (None, None). The
+    version in the tag must be read before the row, so the parent
+    product is taken from item_parents; a recommendation never changes
+    parent, but the first read of an id has to look it up first. A row
+    read from a replica gets no tag.
+    """
+    parent_product_id = recall_parent(id)
+    tag = None if parent_product_id is None else item_etag(id, parent_product_id)
+    conn = id_conn(id, parent_product_id)
+    rec = retrieve_by_id(id, conn)
+    if rec is not None and rec['parent_product_id'] != parent_product_id:
+        parent_product_id = remember_parent(id, rec['parent_product_id'])
+        tag = item_etag(id, parent_product_id)
+        conn = id_conn(id, parent_product_id)
+        rec = retrieve_by_id(id, conn)
+        if rec is None or rec['parent_product_id'] != parent_product_id:
+            tag = None
+    # a replica may not have the write that made the version yet
+    if from_replica(conn):
+        tag = None
+    return rec, tag
+
+def mutate_by_id(statement, id):
+    """
+    Runs the delete or clicked statement on a recommendation and returns
+    its parent product, or None if there is no such recommendation.
+    When the parent is remembered the statement is the only round trip,
+    the best case: a rowcount of 0 means the id is gone or was reused
+    for another product, and an id this process has not seen, or has
+    evicted from item_parents, is looked up first.
+    """
+    conn = id_conn(id, write=True)
+    parent_product_id = recall_parent(id)
+    if parent_product_id is not None and \
+       queries.execute(conn, statement, rec_id=id, parent_product_id=parent_product_id).rowcount:
+        return parent_product_id
+    rec = retrieve_by_id(id, conn)
+    if rec is None:
+        forget_parent(id)
+        return None
+    parent_product_id = remember_parent(id, rec['parent_product_id'])
+    if queries.execute(conn, statement, rec_id=id, parent_product_id=parent_product_id).rowcount:
+        return parent_product_id
+    return None
+
+def recall_parent(id):
+    """ The remembered parent product of a recommendation, or None """
+    with item_parents_lock:
+        parent_product_id = item_parents.pop(id, None)
+        if parent_product_id is not None:
+            # back to the most recently used end
+            item_parents[id] = parent_product_id
+        return parent_product_id
+
+def remember_parent(id, parent_product_id):
+    with item_parents_lock:
+        item_parents.pop(id, None)
+        item_parents[id] = parent_product_id
+        while len(item_parents) > MAX_ITEM_PARENTS:
+            item_parents.popitem(last=False)
+    return parent_product_id
+
+def forget_parent(id):
+    with item_parents_lock:
+        item_parents.pop(id, None)
+
+def with_etag(response, tag):
+    if tag is not None:
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+def not_modified(tag):
+    return with_etag(Response(status=HTTP_304_NOT_MODIFIED), tag)
+
+def encode_cursor(last_id):
+    """ Wraps the last id of a page into an opaque cursor """
+    return base64.urlsafe_b64encode('id:%d' % last_id)
+
+def decode_cursor(cursor):
+    """ Returns the id a cursor continues after, ValueError if it is not one """
+    try:
+        decoded = base64.urlsafe_b64decode(str(cursor))
+    except TypeError:
+        raise ValueError('malformed cursor')
+    if not decoded.startswith('id:'):
+        raise ValueError('malformed cursor')
+    return int(decoded[3:])
+
+def export_response(name, params, ndjson):
+    """
+    Streams every row of the list_<name> statement in chunks from a
+    server-side cursor, so memory stays flat whatever the table size.
+    The generator runs after the request is torn down, so it checks
+    out a connection of its own.
+    """
+    from_replica = replica_set is not None and not wrote_recently()
+
+    def generate():
+        if sharded():
+            conn = None
+            results = shard_set.stream('sorted_' + name, params)
         else:
-            mysql_hostname = '127.0.0.1'
+            conn = (from_replica and replica_set.connect()) or get_engine().connect()
+            results = queries.execute(conn.execution_options(stream_results=True),
+                                      'list_' + name, **params)
+        try:
+            separator = '\n' if ndjson else ','
+            if not ndjson:
+                yield '['
+            first = True
+            while True:
+                rows = results.fetchmany(EXPORT_CHUNK_SIZE)
+                if not rows:
+                    break
+                chunk = separator.join([serializer.encode_row(rec) for rec in rows])
+                if ndjson:
+                    yield chunk + '\n'
+                else:
+                    yield chunk if first else ',' + chunk
+                first = False
+            if not ndjson:
+                yield ']'
+            results.close()
+        finally:
+            # closing a connection closes its cursor, the merged rows of
+            # the shards have a connection each
+            if conn is None:
+                results.close()
+            else:
+                conn.close()
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(generate(), status=HTTP_200_OK, mimetype=mimetype)
+
+def stream_changes(lines, since, seconds):
+    """
+    Streams the changes read so far, then the ones made while the
+    stream is open, as ndjson
+    """
+    def generate():
+        after = since
+        if lines:
+            after = changes.seq_of(lines[-1])
+            yield '\n'.join(lines) + '\n'
+        try:
+            for chunk in change_log.follow(after, seconds):
+                yield chunk
+        except changes.ChangesGoneError:
+            # fell behind the log, the next request answers 410
+            return
+    return generate()
+
+def conflict_message(payload):
+    return {'error': 'Recommendation of product %s to %s of type %s already exists'
+                     % (payload['parent_product_id'], payload['related_product_id'], payload['type'])}
+
+def integrity_error_reply(error, payload):
+    """ 409 when the relationship already exists, 400 for any other violation """
+    if queries.is_duplicate(error):
+        return reply(conflict_message(payload), HTTP_409_CONFLICT)
+    return reply({'error': 'Data value error: the recommendation violates a constraint'},
+                 HTTP_400_BAD_REQUEST)
+
+def insert_recommendation(conn, payload):
+    """ Inserts a validated payload, returns the row with its new id """
+    message = {'parent_product_id': int(payload['parent_product_id']),
+               'related_product_id': int(payload['related_product_id']),
+               'type': payload['type'],
+               'priority': int(payload['priority'])}
+    if sharded():
+        bucket = shards.bucket_of_product(message['parent_product_id'])
+        message['id'] = shard_set.next_ids(bucket)[0]
+        conn.execute(queries.compiled['insert_with_id'], message)
+        return message
+    result = conn.execute(queries.compiled['insert'], message)
+    message['id'] = result.inserted_primary_key[0]
+    return message
+
+def reply(message, rc):
+    # print "message = " + str(message);
+    return reply_json(serializer.dumps(message), rc)
+
+def reply_json(body, rc):
+    response = Response(body)
+    response.headers['Content-Type'] = 'application/json'
+    response.status_code = rc
+    return response
+
+def is_valid(raw_data):
+    try:
+        data = json.loads(raw_data)
+    except:
+        message = {'error': 'JSON decoding error'}
+        return message, False
+    return is_valid_payload(data)
+
+def is_valid_payload(data):
+    if not isinstance(data, dict) or \
+       set(data.keys()) != set(['priority', 'related_product_id', 'parent_product_id', 'type']):
+        # app.logger.error('key set does not match')
+        message = {'error': 'key set does not match'}
+        return message, False
+    try:
+        # Not sure if we should check data type or exceptions
+        # If we check exceptions, input 1 and "1" will be treated as the same
+        priority = int(data['priority'])
+        related_pid = int(data['related_product_id'])
+        parent_pid = int(data['parent_product_id'])
+    except ValueError as err:
+        # app.logger.error('Data value error: %s', err)
+        message = {'error': 'Data value error: %s' % err}
+        return message, False
+    except TypeError as err:
+        # app.logger.error('Data type error: %s', err)
+        message = {'error': 'Data type error: %s' % err}
+        return message, False
+    if not isinstance(data['type'], basestring) or not 0 < len(data['type']) <= MAX_TYPE_LENGTH:
+        message = {'error': 'Data value error: type must be a string of 1 to %d characters' % MAX_TYPE_LENGTH}
+        return message, False
+    return "", True
+
+def bulk_rows():
+    """
+    Returns an iterator over the rows of a bulk request: a JSON array, or
+    with Content-Type application/x-ndjson one JSON document per line,
+    read lazily from the request stream. Returns None if the JSON array
+    cannot be decoded, an undecodable NDJSON line becomes a None row.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        return ndjson_rows(request.stream)
+    try:
+        rows = json.loads(request.get_data())
+    except ValueError:
+        return None
+    if not isinstance(rows, list):
+        return None
+    return iter(rows)
+
+def bulk_ids(rows):
+    """
+    Returns the rows of a bulk update or delete and the ids they name, a
+    bare id or an object's id. With a change log the rows are read in
+    full, so the stripes of just these ids are held before the first
+    write; without one nothing is held and the rows stay streamed.
+    """
+    if change_log is None:
+        return rows, None
+    rows = list(rows)
+    ids = []
+    for row in rows:
+        if isinstance(row, dict):
+            row = row.get('id')
+        try:
+            ids.append(int(row))
+        except (ValueError, TypeError):
+            pass
+    return rows, ids
+
+def ndjson_rows(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def existing_parents(ids):
+    """ Maps each of the ids that exists to its parent product id """
+    if not ids:
+        return {}
+    results = get_conn().execute(queries.select_parents(ids))
+    return dict((rec[0], rec[1]) for rec in results)
+
+def retrieve_by_id(id, conn=None):
+    """ Returns the row of the recommendation, None if there is none """
+    return queries.execute(conn or get_conn(), 'select_by_id', rec_id=int(id)).first()
+
+
+######################################################################
+# INITIALIZE MySQL
+# This method will work in the following conditions:
+#   1) In Bluemix with cleardb bound through VCAP_SERVICES
+#   2) With any SQLAlchemy URL in DATABASE_URI (TEST_DATABASE_URI for
+#      tests), e.g. sqlite:////tmp/recommendations.db for load testing
+#   3) With MySQL --linked in a Docker container in virtual machine,
+#      or on MYSQL_HOST
+# With lazy=True only the URL is worked out here, and get_engine()
+# opens the database when it is first needed.
+######################################################################
+def initialize_mysql(test=False, lazy=False):
+    global database_url, database_test, engine
+    engine = None
+    # Get the crdentials from the Bluemix environment
+    if 'VCAP_SERVICES' in os.environ:
+        print("Using VCAP_SERVICES...")
+        VCAP_SERVICES = os.environ['VCAP_SERVICES']
+        services = json.loads(VCAP_SERVICES)
+        creds = services['cleardb'][0]['credentials']
+        print("Conecting to Mysql on host %s port %s" % (creds['hostname'], creds['port']))
+        url = storage.mysql_url(creds['username'], creds['password'], creds['hostname'], creds['port'], creds['name'])
+    elif test and 'TEST_DATABASE_URI' in os.environ:
+        url = os.environ['TEST_DATABASE_URI']
+    elif not test and 'DATABASE_URI' in os.environ:
+        url = os.environ['DATABASE_URI']
+    else:
+        # MYSQL_HOST, else a linked mysql container if its name resolves
+        mysql_hostname = os.getenv('MYSQL_HOST') or storage.resolve_host('mysql', '127.0.0.1')
+        print("VCAP_SERVICES not found, using MySQL on host %s" % mysql_hostname)
         if test:
-            engine = create_engine("mysql://%s:%s@%s:%s/%s" % ('root', '', mysql_hostname, 3306, 'tdd'), echo = False)
-            meta = MetaData()
-            recommendations = Table('recommendations', meta,
-                Column('id', Integer, nullable=False, primary_key=True),
-                Column('parent_product_id', Integer, nullable=False),
-                Column('related_product_id', Integer, nullable=False),
-                Column('type', String(20), nullable=False),
-                Column('priority', Integer, nullable=True)
-            )
-            try:
-                recommendations.drop(engine, checkfirst=True)
-            except:
-                pass
-            recommendations.create(engine, checkfirst=True)
-            conn = engine.connect()
+            url = storage.mysql_url('root', '', mysql_hostname, 3306, 'tdd')
         else:
-            conn = connect_mysql('root', '', mysql_hostname, 3306, 'nyudevops')
+            url = storage.mysql_url('root', '', mysql_hostname, 3306, 'nyudevops')
+    database_url = url
+    database_test = test
+    initialize_metrics()
+    initialize_changes()
+    if not lazy:
+        get_engine()
+
+def get_engine():
+    """
+    Returns the engine, creating it on the first call: connects to the
+    database, runs the migrations and starts what depends on the engine
+    """
+    global engine
+    if engine is None:
+        with engine_lock:
+            if engine is None:
+                engine = open_database(database_url, database_test)
+                initialize_replicas()
+                initialize_shards()
+                recover_changes()
+                instrument_engines()
+                initialize_clicks()
+                initialize_graph()
+    return engine
+
+def open_database(url, test):
+    """ Creates the engine and brings the schema up to date """
+    db = storage.create_db_engine(url, **storage.pool_options())
+    queries.prepare(db)
+    # The test database is rebuilt from scratch on every run
+    if test:
+        storage.drop_schema(db)
+    if test or os.getenv('MIGRATE_ON_START', 'True') == 'True':
+        migrations.upgrade(db)
+    return db
+
+
+######################################################################
+# INITIALIZE READ REPLICAS
+# REPLICA_URIS (TEST_REPLICA_URIS for tests) lists the SQLAlchemy URLs
+# of the primary's replicas, comma separated. Reads are spread over
+# them by REPLICA_POLICY, round-robin or least-busy.
+######################################################################
+def initialize_replicas():
+    global replica_set, recent_writes
+    if replica_set is not None:
+        replica_set.dispose()
+        replica_set = None
+    recent_writes = replicas.RecentWrites(
+        float(os.getenv('READ_YOUR_WRITES_SECONDS', replicas.READ_YOUR_WRITES_SECONDS)))
+    urls = os.getenv('TEST_REPLICA_URIS' if database_test else 'REPLICA_URIS')
+    if urls:
+        replica_set = replicas.ReplicaSet(
+            [storage.create_db_engine(url.strip(), **storage.pool_options())
+             for url in urls.split(',') if url.strip()],
+            policy=os.getenv('REPLICA_POLICY', replicas.ROUND_ROBIN),
+            eject_seconds=float(os.getenv('REPLICA_EJECT_SECONDS', replicas.EJECT_SECONDS)))
+
+######################################################################
+# INITIALIZE SHARDS
+# SHARD_URIS (TEST_SHARD_URIS for tests) lists the SQLAlchemy URLs of
+# the databases recommendations are sharded over, comma separated.
+# The directory of which shard holds which products is kept in the
+# main database, and is created on the first start.
+######################################################################
+def initialize_shards():
+    global shard_set
+    if shard_set is not None:
+        shard_set.dispose()
+        shard_set = None
+    urls = os.getenv('TEST_SHARD_URIS' if database_test else 'SHARD_URIS')
+    if not urls:
+        return
+    if replica_set is not None:
+        raise ValueError('REPLICA_URIS cannot be combined with SHARD_URIS')
+    engines = [open_database(url.strip(), database_test) for url in urls.split(',') if url.strip()]
+    shards.init_directory(engine, len(engines))
+    shard_set = shards.ShardSet(engine, engines,
+        refresh_interval=float(os.getenv('SHARD_REFRESH_INTERVAL', shards.REFRESH_INTERVAL)))
+
+######################################################################
+# INITIALIZE CLICK HANDLING
+# CLICK_MODE=sync writes every click as it arrives, CLICK_MODE=batched
+# queues them and flushes coalesced counts in the background.
+# CLICK_EVENTS=True also records every click for the co-click job.
+######################################################################
+def initialize_clicks():
+    global click_batcher, click_events
+    stop_click_batcher()
+    flush_size = int(os.getenv('CLICK_FLUSH_SIZE', clicks.FLUSH_SIZE))
+    flush_interval = float(os.getenv('CLICK_FLUSH_INTERVAL', clicks.FLUSH_INTERVAL))
+    if os.getenv('CLICK_MODE', 'sync') == 'batched':
+        if shard_set is not None:
+            raise ValueError('CLICK_MODE=batched cannot be combined with SHARD_URIS')
+        click_batcher = clicks.ClickBatcher(engine,
+            flush_size=flush_size,
+            flush_interval=flush_interval,
+            on_flush=clicks_flushed,
+            serialize=serialized).start()
+    if os.getenv('CLICK_EVENTS', 'False') == 'True':
+        click_events = clicks.ClickEventLog(engine,
+            flush_size=flush_size,
+            flush_interval=flush_interval).start()
+
+
+######################################################################
+# INITIALIZE THE CHANGE LOG
+# CHANGE_LOG_DIR (TEST_CHANGE_LOG_DIR for tests) is the directory of
+# the log, shared by the processes of the service on one machine.
+# CHANGE_LOG_FSYNC=False leaves flushing it to disk to the OS.
+######################################################################
+def initialize_changes():
+    global change_log
+    if change_log is not None:
+        change_log.close()
+        change_log = None
+    directory = os.getenv('TEST_CHANGE_LOG_DIR' if database_test else 'CHANGE_LOG_DIR')
+    if not directory:
+        return
+    change_log = changes.ChangeLog(directory,
+        segment_bytes=int(os.getenv('CHANGE_LOG_SEGMENT_BYTES', changes.SEGMENT_BYTES)),
+        retain_segments=int(os.getenv('CHANGE_LOG_RETAIN_SEGMENTS', changes.RETAIN_SEGMENTS)),
+        fsync=os.getenv('CHANGE_LOG_FSYNC', 'True') == 'True')
+    if engine is not None:
+        recover_changes()
+
+def recover_changes():
+    """ Logs the writes that processes died before logging, once the engine is open """
+    if change_log is not None:
+        change_log.recover(current_rows)
+
+def current_rows(ids):
+    """ Reads the rows of the ids that exist, on the primary or their shards """
+    if shard_set is None:
+        grouped = {engine: ids}
+    else:
+        grouped = {}
+        for id in ids:
+            db = shard_set.engines[shard_set.shard(shards.bucket_of_id(id))]
+            grouped.setdefault(db, []).append(id)
+    rows = []
+    for db, group in grouped.items():
+        with db.connect() as conn:
+            for chunk in chunked(group, BULK_CHUNK_SIZE):
+                rows.extend(conn.execute(queries.select_rows(chunk)).fetchall())
+    return rows
+
+######################################################################
+# INITIALIZE METRICS
+# METRICS=True keeps the request metrics served on /metrics, at a
+# cost of a few percent of throughput, so they are off by default;
+# SLOW_QUERY_MS logs every statement that takes longer
+######################################################################
+def initialize_metrics():
+    global request_metrics
+    request_metrics = None
+    if os.getenv('METRICS', 'False') == 'True':
+        request_metrics = metrics.RequestMetrics()
+    if engine is not None:
+        instrument_engines()
+
+def instrument_engines():
+    slow_query_ms = os.getenv('SLOW_QUERY_MS')
+    for db in [engine] + (shard_set.engines if shard_set is not None else []) + \
+              (replica_set.engines if replica_set is not None else []):
+        metrics.instrument(db, request_metrics,
+                           float(slow_query_ms) / 1000 if slow_query_ms else None)
+
+
+######################################################################
+# INITIALIZE THE READ MODE
+# READ_MODE=sql reads product lists from the database through the
+# cache, READ_MODE=graph from an in-memory snapshot of the whole table
+######################################################################
+def initialize_graph():
+    global graph_loader
+    if graph_loader is not None:
+        graph_loader.stop()
+        graph_loader = None
+    if os.getenv('READ_MODE', 'sql') == 'graph':
+        if shard_set is not None:
+            raise ValueError('READ_MODE=graph cannot be combined with SHARD_URIS')
+        graph_loader = graph.GraphLoader(engine,
+            refresh_interval=float(os.getenv('GRAPH_REFRESH_INTERVAL', graph.REFRESH_INTERVAL)),
+            refresh_delay=float(os.getenv('GRAPH_REFRESH_DELAY', graph.REFRESH_DELAY)),
+            on_write=os.getenv('GRAPH_REFRESH_ON_WRITE', 'True') == 'True').start()
+
+
+######################################################################
+# APPLICATION FACTORY AND SHUTDOWN
+# WSGI servers that fork workers (see gunicorn.conf.py) call
+# create_app() in each worker after the fork, so every worker opens
+# its own connection pool and starts its own background threads
+######################################################################
+def create_app():
+    """
+    Initializes the service in this process and returns the app. With
+    DB_LAZY_CONNECT=True the database is opened by the first request.
+    """
+    global draining, startup_seconds
+    draining = False
+    initialize_mysql(lazy=os.getenv('DB_LAZY_CONNECT', 'True') == 'True')
+    startup_seconds = time.time() - IMPORT_STARTED
+    report_startup(startup_seconds, STARTUP_BUDGET_MS / 1000)
+    return app
+
+def report_startup(seconds, budget):
+    """ Logs the startup time, as a warning if it went over budget """
+    if seconds > budget:
+        logger.warning('Started in %.0f ms, over the %.0f ms budget', seconds * 1000, budget * 1000)
+    else:
+        logger.info('Started in %.0f ms of the %.0f ms budget', seconds * 1000, budget * 1000)
+
+def drain():
+    """ Fails readiness checks from now on, requests are still served """
+    global draining
+    draining = True
+
+def shutdown():
+    """ Writes queued clicks, stops the graph loader and closes the pool """
+    global graph_loader
+    drain()
+    stop_click_batcher()
+    if graph_loader is not None:
+        graph_loader.stop()
+        graph_loader = None
+    if replica_set is not None:
+        replica_set.dispose()
+    if shard_set is not None:
+        shard_set.dispose()
+    if change_log is not None:
+        change_log.close()
+    if engine is not None:
+        engine.dispose()
 
 
 ######################################################################
@@ -543,6 +2397,5 @@ def initialize_mysql(test=False):
 
 if __name__ == "__main__":
     print "Recommendations Service Starting..."
-    initialize_mysql()
-    # Pull options from environment
-    app.run(host='0.0.0.0', port=int(port), debug=debug)
+    # The development server, use gunicorn -c gunicorn.conf.py in production
+    create_app().run(host='0.0.0.0', port=int(port), debug=debug)
@@ -0,0 +1,440 @@
+######################################################################
+# Sharded storage of recommendations by parent product
+#
+# Parent products are hashed into BUCKETS buckets, and the shard
+# directory, the shard_buckets table of the DATABASE_URI database,
+# says which of the SHARD_URIS databases holds each bucket. All the
+# recommendations of a product are on one shard, so a product list is
+# read from a single database.
+#
+# Ids are global: id = sequence * BUCKETS + bucket, the sequence
+# counted per bucket in the directory's id_sequences table, so the
+# bucket of a recommendation, and through it the shard, is read off
+# its id. BUCKETS is part of every id and can never change; moving a
+# bucket to another shard leaves its ids as they are.
+#
+# Lists that are not filtered by product are read from every shard at
+# once, on a thread pool, and merged in id order. A shard only answers
+# for the buckets it owns, rows it still holds of a bucket moved away
+# are left out of the merge.
+#
+# Buckets are moved online, a few at a time, by move_buckets():
+#   1) their rows are copied to the new shard while the old one serves
+#   2) they are marked moving, and writes to them answer 503 while
+#      the rows changed in the meantime are copied over
+#   3) the new shard becomes their owner and, once every process has
+#      reread the directory, the old copies are deleted
+#
+# run with:
+#   python shards.py [status|init|rebalance|load] [--rows 10k] [--seed 42]
+#                    [--settle 5] [--shards n]
+# on the directory in DATABASE_URI and the shards in SHARD_URIS;
+# rebalance --shards n empties the shards after the first n
+######################################################################
+
+import os
+import sys
+import time
+import heapq
+import logging
+from itertools import islice
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, func
+import storage
+import queries
+import migrations
+
+rec = storage.recommendations
+directory_buckets = storage.shard_buckets
+sequences = storage.id_sequences
+
+BUCKET_BITS = 8
+BUCKETS = 1 << BUCKET_BITS
+ACTIVE = 'active'
+MOVING = 'moving'
+# seconds between rereads of the directory in every process
+REFRESH_INTERVAL = 1
+# seconds move_buckets() waits for every process to reread the
+# directory and finish the requests it started before, longer than
+# REFRESH_INTERVAL plus the slowest request
+SETTLE_SECONDS = 5
+# buckets moved under one freeze by rebalance()
+MOVE_BATCH = 8
+COPY_CHUNK_SIZE = 1000
+# Knuth's multiplicative hash, spreads consecutive product ids
+HASH_MULTIPLIER = 2654435761
+
+logger = logging.getLogger(__name__)
+
+
+class ShardMovingError(Exception):
+    """ A write to a bucket that is being moved to another shard """
+    pass
+
+
+def bucket_of_product(parent_product_id):
+    """ The bucket of a parent product, the high bits of its hash """
+    return ((int(parent_product_id) * HASH_MULTIPLIER) & 0xffffffff) >> (32 - BUCKET_BITS)
+
+
+def bucket_of_id(id):
+    return int(id) % BUCKETS
+
+
+def make_id(sequence, bucket):
+    return sequence * BUCKETS + bucket
+
+
+class ShardSet(object):
+    """ The shard databases and the directory of the buckets they hold """
+
+    def __init__(self, directory, engines, refresh_interval=REFRESH_INTERVAL, clock=time.time):
+        self.directory = directory
+        self.engines = list(engines)
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.lock = Lock()
+        self.pool = ThreadPoolExecutor(max_workers=len(self.engines))
+        self.refresh()
+
+    def refresh(self):
+        """ Rereads the owner and state of every bucket """
+        rows = self.directory.execute(select([directory_buckets])).fetchall()
+        if len(rows) != BUCKETS:
+            raise ValueError('the shard directory is not initialized, run python shards.py init')
+        owners = [0] * BUCKETS
+        moving = set()
+        for bucket, shard, state in rows:
+            if shard >= len(self.engines):
+                raise ValueError('bucket %d is on shard %d, only %d shards are configured'
+                                 % (bucket, shard, len(self.engines)))
+            owners[bucket] = shard
+            if state == MOVING:
+                moving.add(bucket)
+        # replaced whole, readers see either the old or the new directory
+        self.owners, self.moving = owners, frozenset(moving)
+        self.loaded_at = self.clock()
+
+    def maybe_refresh(self):
+        """ Rereads the directory once it is refresh_interval old """
+        if self.clock() - self.loaded_at < self.refresh_interval:
+            return
+        # one thread rereads it, the others go on with the copy they have
+        if self.lock.acquire(False):
+            try:
+                self.refresh()
+            finally:
+                self.lock.release()
+
+    def shard(self, bucket, write=False):
+        """
+        The index of the shard holding a bucket, raising ShardMovingError
+        for writes while the bucket moves
+        """
+        self.maybe_refresh()
+        if write and bucket in self.moving:
+            raise ShardMovingError('bucket %d is moving to another shard' % bucket)
+        return self.owners[bucket]
+
+    def next_ids(self, bucket, count=1):
+        """ Allocates count ids of a bucket from the directory """
+        with self.directory.begin() as conn:
+            conn.execute(sequences.update().where(sequences.c.bucket == bucket)
+                                  .values(next_id=sequences.c.next_id + count))
+            last = conn.execute(select([sequences.c.next_id])
+                                .where(sequences.c.bucket == bucket)).scalar()
+        return [make_id(sequence, bucket) for sequence in range(last - count + 1, last + 1)]
+
+    def scatter(self, function):
+        """ Calls function(shard, engine) on every shard at once """
+        if len(self.engines) == 1:
+            return [function(0, self.engines[0])]
+        futures = [self.pool.submit(function, shard, engine)
+                   for shard, engine in enumerate(self.engines)]
+        return [future.result() for future in futures]
+
+    def gather(self, statement, params, limit=None):
+        """
+        Runs a precompiled statement returning rows in id order on every
+        shard at once, and merges the rows of the buckets each owns in
+        id order. With a limit, the statement returns at most limit rows
+        per shard and the result is cut where it could be missing rows.
+        Returns the rows and the id to read on from, None after the last.
+        """
+        self.maybe_refresh()
+        owners = self.owners
+
+        def read(shard, engine):
+            rows = queries.execute(engine, statement, **params).fetchall()
+            full = limit is not None and len(rows) == limit
+            return [row for row in rows if owners[row[0] % BUCKETS] == shard], \
+                   rows[-1][0] if full else None
+
+        results = self.scatter(read)
+        rows = list(merge([shard_rows for shard_rows, last in results]))
+        # a shard that filled its limit may have more rows past its last
+        cutoffs = [last for shard_rows, last in results if last is not None]
+        cutoff = min(cutoffs) if cutoffs else None
+        if cutoff is not None:
+            rows = [row for row in rows if row[0] <= cutoff]
+        # the shards together may return more than limit rows
+        if limit is not None and len(rows) >= limit:
+            rows = rows[:limit]
+            return rows, rows[-1][0]
+        return rows, cutoff
+
+    def stream(self, statement, params):
+        """
+        Streams the rows of a statement returning rows in id order from
+        every shard, merged in id order, as a MergedResult
+        """
+        self.maybe_refresh()
+        owners = self.owners
+
+        def read(shard, engine):
+            conn = engine.connect()
+            try:
+                results = queries.execute(conn.execution_options(stream_results=True), statement, **params)
+                for row in results:
+                    if owners[row[0] % BUCKETS] == shard:
+                        yield row
+            finally:
+                conn.close()
+        return MergedResult([read(shard, engine) for shard, engine in enumerate(self.engines)])
+
+    def stats(self):
+        owners = self.owners
+        return {'buckets': [owners.count(shard) for shard in range(len(self.engines))],
+                'moving': sorted(self.moving)}
+
+    def dispose(self):
+        self.pool.shutdown(wait=False)
+        for engine in self.engines:
+            engine.dispose()
+
+
+class MergedResult(object):
+    """ Rows streamed from several shards, read like a result proxy """
+
+    def __init__(self, readers):
+        self.readers = readers
+        self.rows = merge(readers)
+
+    def fetchmany(self, size):
+        return list(islice(self.rows, size))
+
+    def close(self):
+        """ Returns the connection of every shard """
+        for reader in self.readers:
+            reader.close()
+
+
+def merge(row_lists):
+    """ Merges iterables of rows, each in id order, into one in id order """
+    # rows are compared by id alone, ids are unique
+    decorated = [((row[0], row) for row in rows) for rows in row_lists]
+    return (row for id, row in heapq.merge(*decorated))
+
+
+######################################################################
+# DIRECTORY AND RESHARDING
+######################################################################
+def init_directory(directory, shard_count):
+    """
+    Spreads the buckets over shard_count shards in a new directory.
+    Returns False if the directory was already initialized.
+    """
+    migrations.upgrade(directory)
+    with directory.begin() as conn:
+        if conn.execute(select([func.count()]).select_from(directory_buckets)).scalar():
+            return False
+        conn.execute(directory_buckets.insert(),
+                     [{'bucket': bucket, 'shard': bucket % shard_count, 'state': ACTIVE}
+                      for bucket in range(BUCKETS)])
+        conn.execute(sequences.insert(),
+                     [{'bucket': bucket, 'next_id': 0} for bucket in range(BUCKETS)])
+    return True
+
+
+def plan(owners, shard_count):
+    """
+    The (bucket, shard) moves that spread the buckets evenly over
+    shard_count shards, moving as few buckets as possible
+    """
+    share, extra = divmod(BUCKETS, shard_count)
+    held = dict((shard, []) for shard in range(shard_count))
+    homeless = []
+    for bucket, shard in enumerate(owners):
+        (held[shard] if shard in held else homeless).append(bucket)
+    # the largest shards keep the extra buckets
+    largest = sorted(held, key=lambda shard: -len(held[shard]))
+    quotas = dict((shard, share + (1 if rank < extra else 0)) for rank, shard in enumerate(largest))
+    for shard in range(shard_count):
+        while len(held[shard]) > quotas[shard]:
+            homeless.append(held[shard].pop())
+    moves = []
+    for shard in range(shard_count):
+        while len(held[shard]) < quotas[shard]:
+            bucket = homeless.pop()
+            held[shard].append(bucket)
+            moves.append((bucket, shard))
+    return sorted(moves)
+
+
+def bucket_filter(bucket_list):
+    return (rec.c.id % BUCKETS).in_(bucket_list)
+
+
+def sync_buckets(source, target, bucket_list):
+    """
+    Makes the target's rows of the buckets the same as the source's,
+    returns the number of rows written
+    """
+    query = select([rec]).where(bucket_filter(bucket_list))
+    wanted = dict((row[0], tuple(row)) for row in source.execute(query))
+    present = dict((row[0], tuple(row)) for row in target.execute(query))
+    stale = [id for id, row in present.items() if wanted.get(id) != row]
+    missing = [row for id, row in sorted(wanted.items()) if present.get(id) != row]
+    columns = [column.name for column in rec.columns]
+    with target.begin() as conn:
+        for chunk in chunked(stale, COPY_CHUNK_SIZE):
+            conn.execute(rec.delete().where(rec.c.id.in_(chunk)))
+        for chunk in chunked(missing, COPY_CHUNK_SIZE):
+            conn.execute(rec.insert(), [dict(zip(columns, row)) for row in chunk])
+    return len(stale) + len(missing)
+
+
+def set_buckets(directory, bucket_list, shard, state):
+    directory.execute(directory_buckets.update().where(directory_buckets.c.bucket.in_(bucket_list))
+                      .values(shard=shard, state=state))
+
+
+def move_buckets(shard_set, bucket_list, target, settle=SETTLE_SECONDS, sleep=time.sleep):
+    """
+    Moves buckets to the target shard while the service runs, returns
+    the number of rows copied. A move that was interrupted is finished
+    by moving the same buckets again.
+    """
+    shard_set.refresh()
+    by_source = {}
+    for bucket in bucket_list:
+        if shard_set.owners[bucket] != target:
+            by_source.setdefault(shard_set.owners[bucket], []).append(bucket)
+    if not by_source:
+        return 0
+    destination = shard_set.engines[target]
+    copied = 0
+    for source, moved in sorted(by_source.items()):
+        copied += sync_buckets(shard_set.engines[source], destination, moved)
+    for source, moved in sorted(by_source.items()):
+        set_buckets(shard_set.directory, moved, source, MOVING)
+    # until every process sees the buckets as moving, and the writes
+    # they started before are done
+    sleep(settle)
+    for source, moved in sorted(by_source.items()):
+        copied += sync_buckets(shard_set.engines[source], destination, moved)
+        set_buckets(shard_set.directory, moved, target, ACTIVE)
+    # until no process reads the old copies
+    sleep(settle)
+    for source, moved in sorted(by_source.items()):
+        shard_set.engines[source].execute(rec.delete().where(bucket_filter(moved)))
+    shard_set.refresh()
+    return copied
+
+
+def rebalance(shard_set, shard_count=None, settle=SETTLE_SECONDS, batch=MOVE_BATCH,
+              sleep=time.sleep):
+    """
+    Spreads the buckets evenly over the first shard_count shards of
+    the set, all of them by default, batch buckets at a time, and
+    returns the number of buckets moved
+    """
+    shard_set.refresh()
+    moves = plan(shard_set.owners, shard_count or len(shard_set.engines))
+    by_target = {}
+    for bucket, target in moves:
+        by_target.setdefault(target, []).append(bucket)
+    for target, bucket_list in sorted(by_target.items()):
+        for moved in chunked(bucket_list, batch):
+            copied = move_buckets(shard_set, moved, target, settle, sleep)
+            logger.info('Moved buckets %s to shard %d, %d rows copied', moved, target, copied)
+    return len(moves)
+
+
+def load(shard_set, rows, chunk_size=COPY_CHUNK_SIZE):
+    """
+    Inserts rows, giving each a new id on the shard of its parent
+    product, returns the number of rows loaded
+    """
+    insert = rec.insert()
+    count = 0
+    for chunk in chunked(rows, chunk_size):
+        by_bucket = {}
+        for row in chunk:
+            by_bucket.setdefault(bucket_of_product(row['parent_product_id']), []).append(row)
+        by_shard = {}
+        for bucket, bucket_rows in by_bucket.items():
+            for row, id in zip(bucket_rows, shard_set.next_ids(bucket, len(bucket_rows))):
+                by_shard.setdefault(shard_set.shard(bucket), []).append(dict(row, id=id))
+        for shard, shard_rows in by_shard.items():
+            shard_set.engines[shard].execute(insert, shard_rows)
+        count += len(chunk)
+    return count
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    import dataset
+    args = sys.argv[1:]
+    options = {'--rows': '10k', '--seed': str(dataset.SEED), '--settle': str(SETTLE_SECONDS),
+               '--shards': None}
+    for name in list(options):
+        if name in args:
+            position = args.index(name)
+            options[name] = args[position + 1]
+            del args[position:position + 2]
+    command = args[0] if args else 'status'
+    urls = [url.strip() for url in os.getenv('SHARD_URIS', '').split(',') if url.strip()]
+    if command not in ('status', 'init', 'rebalance', 'load') or not urls or not os.getenv('DATABASE_URI'):
+        print("usage: python shards.py [status|init|rebalance|load] [--rows 10k] [--seed 42]\n"
+              "                          [--settle 5] [--shards n]\n"
+              "       with the directory in DATABASE_URI and the shards in SHARD_URIS")
+        sys.exit(2)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    directory = storage.create_db_engine(os.getenv('DATABASE_URI'))
+    engines = [storage.create_db_engine(url) for url in urls]
+    if command == 'init':
+        for engine in engines:
+            migrations.upgrade(engine)
+        if not init_directory(directory, len(engines)):
+            print("the directory was already initialized")
+    shard_set = ShardSet(directory, engines)
+    start = time.time()
+    if command == 'rebalance':
+        shard_count = int(options['--shards']) if options['--shards'] else None
+        moved = rebalance(shard_set, shard_count, settle=float(options['--settle']))
+        print("moved %d buckets in %.1fs" % (moved, time.time() - start))
+    elif command == 'load':
+        count = load(shard_set, dataset.generate(dataset.parse_size(options['--rows']), int(options['--seed'])))
+        print("loaded %d recommendations in %.1fs" % (count, time.time() - start))
+    stats = shard_set.stats()
+    for shard, engine in enumerate(engines):
+        rows = engine.execute(select([func.count()]).select_from(rec)).scalar()
+        print("shard %d: %d buckets, %d rows  %s" % (shard, stats['buckets'][shard], rows, urls[shard]))
+    if stats['moving']:
+        print("moving: %s" % stats['moving'])
+    shard_set.dispose()
@@ -0,0 +1,188 @@
+######################################################################
+# Storage layer for the Recommendations service
+#
+# Builds a pooled SQLAlchemy engine for either MySQL (production) or a
+# file-backed SQLite database (local load testing). Request handlers
+# never share a connection: each one checks out its own from the pool
+# and hands it back when the request is torn down.
+######################################################################
+
+import os
+import socket
+import threading
+from sqlalchemy import create_engine, event, select, exc
+from sqlalchemy import MetaData, Table, Column, Index, Integer, String, DateTime
+from sqlalchemy.pool import QueuePool
+
+metadata = MetaData()
+
+recommendations = Table('recommendations', metadata,
+    Column('id', Integer, nullable=False, primary_key=True),
+    Column('parent_product_id', Integer, nullable=False),
+    Column('related_product_id', Integer, nullable=False),
+    Column('type', String(20), nullable=False),
+    Column('priority', Integer, nullable=True)
+)
+
+# Indexes for the lookups the service serves, added by migrations 2 to 4
+# on databases created before they existed
+lookup_indexes = [
+    Index('ix_recommendations_product_type_priority',
+          recommendations.c.parent_product_id, recommendations.c.type,
+          recommendations.c.priority),
+    Index('ix_recommendations_type', recommendations.c.type),
+]
+ranking_index = Index('ix_recommendations_product_priority',
+                      recommendations.c.parent_product_id,
+                      recommendations.c.priority)
+relationship_index = Index('uq_recommendations_relationship',
+                           recommendations.c.parent_product_id,
+                           recommendations.c.related_product_id,
+                           recommendations.c.type, unique=True)
+
+# One row per click when CLICK_EVENTS=True, the input of the co-click
+# job (see cooccurrence.py), added by migration 5
+click_events = Table('click_events', metadata,
+    Column('id', Integer, nullable=False, primary_key=True),
+    Column('recommendation_id', Integer, nullable=False),
+    Column('parent_product_id', Integer, nullable=False),
+    Column('session', String(64), nullable=True),
+    Column('clicked_at', DateTime, nullable=False),
+    Index('ix_click_events_clicked_at', 'clicked_at')
+)
+
+# The shard directory, read when SHARD_URIS is set (see shards.py): the
+# shard each bucket of parent products lives on, and the next id of
+# each bucket. Added by migration 6, and left empty on other databases.
+shard_buckets = Table('shard_buckets', metadata,
+    Column('bucket', Integer, nullable=False, primary_key=True, autoincrement=False),
+    Column('shard', Integer, nullable=False),
+    Column('state', String(10), nullable=False)
+)
+id_sequences = Table('id_sequences', metadata,
+    Column('bucket', Integer, nullable=False, primary_key=True, autoincrement=False),
+    Column('next_id', Integer, nullable=False)
+)
+
+# One row per migration applied to the database
+schema_version = Table('schema_version', metadata,
+    Column('version', Integer, nullable=False, primary_key=True, autoincrement=False),
+    Column('description', String(100), nullable=False),
+    Column('applied_at', DateTime, nullable=False)
+)
+
+# Pool defaults, each one can be overridden from the environment
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+POOL_TIMEOUT = 30
+POOL_RECYCLE = 3600
+POOL_PRE_PING = True
+
+# The MySQL DBAPI driver, MYSQL_DRIVER=pymysql for gevent workers: the
+# pure Python PyMySQL yields to other requests while it waits on the
+# server where the C MySQLdb blocks the whole worker
+MYSQL_DRIVER = 'mysqldb'
+
+# Seconds to wait for a MySQL host name to resolve before falling back
+RESOLVE_TIMEOUT = 0.5
+
+
+def mysql_url(user, passwd, server, port, database):
+    driver = os.getenv('MYSQL_DRIVER', MYSQL_DRIVER)
+    return "mysql+%s://%s:%s@%s:%s/%s" % (driver, user, passwd, server, port, database)
+
+
+def resolve_host(name, fallback, timeout=RESOLVE_TIMEOUT):
+    """
+    Returns name if it resolves within timeout seconds, else fallback.
+    The lookup runs on a daemon thread, so a slow DNS server delays
+    startup by timeout at most.
+    """
+    resolved = []
+
+    def lookup():
+        try:
+            socket.getaddrinfo(name, None)
+        except socket.error:
+            return
+        resolved.append(name)
+    thread = threading.Thread(target=lookup, name='resolve-%s' % name)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    return resolved[0] if resolved else fallback
+
+
+def pool_options():
+    """ Reads the connection pool configuration from the environment """
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', POOL_SIZE)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', MAX_OVERFLOW)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', POOL_TIMEOUT)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', POOL_RECYCLE)),
+        'pre_ping': os.getenv('DB_POOL_PRE_PING', str(POOL_PRE_PING)) == 'True'
+    }
+
+
+def create_db_engine(url, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+                     pool_timeout=POOL_TIMEOUT, pool_recycle=POOL_RECYCLE,
+                     pre_ping=POOL_PRE_PING):
+    """ Creates an engine with a QueuePool sized from the arguments """
+    kwargs = {'echo': False,
+              'poolclass': QueuePool,
+              'pool_size': pool_size,
+              'max_overflow': max_overflow,
+              'pool_timeout': pool_timeout,
+              'pool_recycle': pool_recycle}
+    if url.startswith('sqlite'):
+        # pysqlite refuses to share connections across threads by default,
+        # the pool already guarantees a connection has a single owner
+        kwargs['connect_args'] = {'check_same_thread': False, 'timeout': pool_timeout}
+    engine = create_engine(url, **kwargs)
+    if url.startswith('sqlite'):
+        event.listen(engine, 'connect', _sqlite_on_connect)
+    if pre_ping:
+        event.listen(engine, 'engine_connect', _ping_connection)
+    return engine
+
+
+def create_schema(engine):
+    """ Creates every table and index of a fresh database """
+    metadata.create_all(engine, checkfirst=True)
+
+
+def drop_schema(engine):
+    metadata.drop_all(engine, checkfirst=True)
+
+
+######################################################################
+#  E N G I N E   E V E N T S
+######################################################################
+def _sqlite_on_connect(dbapi_conn, connection_record):
+    # WAL lets readers proceed while a writer holds the database
+    cursor = dbapi_conn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+
+def _ping_connection(connection, branch):
+    """
+    Pessimistic disconnect handling: test every connection as it is
+    checked out so a dropped server connection is replaced rather than
+    failing the request that happens to draw it from the pool
+    """
+    if branch:
+        return
+    save_should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        # the ping invalidates the whole pool on a disconnect, so the
+        # retry transparently opens a fresh connection
+        if err.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = save_should_close_with_result
@@ -0,0 +1,220 @@
+# run with:
+# python -m unittest discover
+
+import time
+import unittest
+from Queue import Queue
+from cache import LRUCache, RedisCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class FakeRedis(object):
+    """ The subset of the Redis commands RedisCache uses, held in memory """
+
+    def __init__(self):
+        self.data = {}
+        self.subscribers = []
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hdel(self, key, field):
+        self.data.get(key, {}).pop(field, None)
+
+    def expire(self, key, seconds):
+        pass
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def keys(self, pattern):
+        return [key for key in self.data if key.startswith(pattern.rstrip('*'))]
+
+    def publish(self, channel, message):
+        for queue in self.subscribers:
+            queue.put({'type': 'message', 'channel': channel, 'data': message})
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    """ Queues commands and runs them on execute(), counted as one round trip """
+
+    def __init__(self, server):
+        self.server = server
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((getattr(self.server, name), args))
+
+    def execute(self):
+        return [command(*args) for command, args in self.commands]
+
+
+class FakePubSub(object):
+    def __init__(self, server):
+        self.server = server
+        self.queue = Queue()
+
+    def subscribe(self, channel):
+        self.server.subscribers.append(self.queue)
+
+    def listen(self):
+        while True:
+            yield self.queue.get()
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, None, '[]')
+        self.assertEqual(self.cache.get(1), '[]')
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set(1, None, 'a')
+        self.cache.set(2, None, 'b')
+        self.cache.get(1)
+        self.cache.set(3, None, 'c')
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), 'a')
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        self.cache.set(1, None, 'a')
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_invalidate_drops_every_type_of_a_product(self):
+        self.cache.set(1, None, 'a')
+        self.cache.set(1, 'x-sell', 'b')
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1))
+        self.assertIsNone(self.cache.get(1, 'x-sell'))
+
+    def test_set_after_concurrent_invalidate_is_dropped(self):
+        token = self.cache.token(1)
+        self.cache.invalidate(1)
+        self.cache.set(1, None, 'stale', token)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_invalidate_changes_the_version_of_the_product(self):
+        version = self.cache.version(1)
+        other = self.cache.version(2)
+        self.cache.invalidate(1)
+        self.assertNotEqual(self.cache.version(1), version)
+        self.assertEqual(self.cache.version(2), other)
+        # versions of another process never match
+        self.assertNotEqual(LRUCache().version(1), self.cache.version(1))
+
+
+class TestRedisCache(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.cache = RedisCache(self.redis, ttl=10)
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get(1, 'x-sell'))
+        self.cache.set(1, 'x-sell', '[]', self.cache.token(1))
+        self.assertEqual(self.cache.get(1, 'x-sell'), '[]')
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_entries_are_shared_between_instances(self):
+        other = RedisCache(self.redis, ttl=10)
+        self.cache.set(1, None, 'a')
+        self.assertEqual(other.get(1), 'a')
+        other.invalidate(1)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_set_after_concurrent_invalidate_is_dropped(self):
+        token = self.cache.token(1)
+        RedisCache(self.redis).invalidate(1)
+        self.cache.set(1, None, 'stale', token)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_version_is_shared_between_instances(self):
+        other = RedisCache(self.redis, ttl=10)
+        version = self.cache.version(1)
+        self.assertEqual(other.version(1), version)
+        other.invalidate(1)
+        self.assertNotEqual(self.cache.version(1), version)
+
+    def test_lookup_reads_the_version_with_the_body(self):
+        self.cache.set(1, None, 'a')
+        self.assertEqual(self.cache.lookup(1), ('a', '0', 0))
+        self.cache.invalidate(1)
+        body, version, token = self.cache.lookup(1)
+        self.assertEqual((body, version), (None, self.cache.version(1)))
+        self.cache.set(1, None, 'b', token)
+        self.assertEqual(self.cache.get(1), 'b')
+
+    def test_near_cache_fill_after_an_invalidation_is_dropped(self):
+        near = LRUCache(maxsize=10, ttl=10)
+        other = RedisCache(self.redis, ttl=10, local=near)
+        self.cache.set(1, None, 'a')
+        execute = FakePipeline.execute
+        def invalidated_during_the_read(pipe):
+            results = execute(pipe)
+            # as if the published invalidation arrived before the fill
+            near.invalidate(1)
+            return results
+        FakePipeline.execute = invalidated_during_the_read
+        try:
+            self.assertEqual(other.get(1), 'a')
+        finally:
+            FakePipeline.execute = execute
+        self.assertEqual(near.stats()['size'], 0)
+        # a near cache hit keeps the version it was read with
+        self.assertEqual(other.lookup(1), ('a', '0', 0))
+        self.assertEqual(other.lookup(1), ('a', '0', 0))
+        self.assertEqual(near.stats()['hits'], 1)
+
+    def test_invalidation_is_published_to_near_caches(self):
+        near = LRUCache(maxsize=10, ttl=10)
+        other = RedisCache(self.redis, ttl=10, local=near)
+        other.listen()
+        self.cache.set(1, None, 'a')
+        self.assertEqual(other.get(1), 'a')
+        self.assertEqual(near.stats()['size'], 1)
+        self.cache.invalidate(1)
+        deadline = time.time() + 5
+        while near.stats()['size'] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(other.get(1))
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+# run with:
+# python -m unittest discover
+
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+import multiprocessing
+from threading import Thread
+import changes
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestChangeLog(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.directory = tempfile.mkdtemp()
+        self.logs = []
+
+    def tearDown(self):
+        for log in self.logs:
+            log.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, **options):
+        options.setdefault('fsync', False)
+        options.setdefault('poll_interval', 0.01)
+        log = changes.ChangeLog(self.directory, clock=self.clock, **options)
+        self.logs.append(log)
+        return log
+
+    def seqs(self, lines):
+        return [json.loads(line)['seq'] for line in lines]
+
+    def test_append_numbers_every_change(self):
+        log = self.open()
+        self.clock.now = 12.5
+        self.assertEqual(log.append(changes.CREATE, [(1, 10, 20, 'x-sell', 3), (2, 10, 21, 'up-sell', 4)]), 2)
+        self.assertEqual(log.append(changes.CLICKED, [(1, 10)]), 3)
+        self.assertIsNone(log.append(changes.DELETE, []))
+        lines = log.read(0, 10)
+        self.assertEqual(json.loads(lines[0]),
+                         {'seq': 1, 'time': 12.5, 'op': 'create', 'id': 1, 'parent_product_id': 10,
+                          'recommendation': {'id': 1, 'parent_product_id': 10, 'related_product_id': 20,
+                                             'type': 'x-sell', 'priority': 3}})
+        self.assertEqual(json.loads(lines[2]),
+                         {'seq': 3, 'time': 12.5, 'op': 'clicked', 'id': 1, 'parent_product_id': 10})
+        self.assertEqual(self.seqs(log.read(1, 1)), [2])
+        self.assertEqual(log.read(3, 10), [])
+        self.assertRaises(ValueError, log.append, 'upsert', [(1, 10)])
+
+    def test_since_past_the_end(self):
+        log = self.open()
+        log.append(changes.DELETE, [(1, 10)])
+        self.assertRaises(changes.ChangesGoneError, log.read, 2, 10)
+
+    def test_reopened_log_goes_on_from_disk(self):
+        log = self.open()
+        for id in range(1, 6):
+            log.append(changes.DELETE, [(id, 10)])
+        log.close()
+        self.logs.remove(log)
+        log = self.open(memory=2)
+        self.assertEqual(log.append(changes.DELETE, [(6, 10)]), 6)
+        # the older changes are read from the segment
+        self.assertEqual(self.seqs(log.read(0, 10)), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(self.seqs(log.read(2, 2)), [3, 4])
+        self.assertEqual(log.stats()['in_memory'], 1)
+
+    def test_segments_rotate_and_old_ones_are_dropped(self):
+        log = self.open(segment_bytes=200, retain_segments=2, memory=1)
+        for id in range(1, 21):
+            log.append(changes.DELETE, [(id, 10)])
+        stats = log.stats()
+        self.assertEqual((stats['last_seq'], stats['segments']), (20, 2))
+        first_seq = stats['first_seq']
+        self.assertEqual(self.seqs(log.read(first_seq - 1, 100)), range(first_seq, 21))
+        self.assertRaises(changes.ChangesGoneError, log.read, first_seq - 2, 100)
+        self.assertEqual(sorted(os.listdir(self.directory))[:-1],
+                         [changes.segment_name(seq) for seq in log.segments()])
+
+    def test_processes_share_the_log(self):
+        first = self.open(segment_bytes=200)
+        second = self.open(segment_bytes=200)
+        for id in range(1, 11):
+            (first if id % 3 else second).append(changes.DELETE, [(id, 10)])
+        for log in (first, second):
+            lines = log.read(0, 100)
+            self.assertEqual(self.seqs(lines), range(1, 11))
+            self.assertEqual([json.loads(line)['id'] for line in lines], range(1, 11))
+
+    def test_torn_line_is_dropped(self):
+        log = self.open()
+        log.append(changes.DELETE, [(1, 10)])
+        with open(os.path.join(self.directory, changes.segment_name(1)), 'ab') as segment:
+            segment.write('{"seq": 2, "time": 0.000, "op": "del')
+        log.close()
+        self.logs.remove(log)
+        log = self.open()
+        self.assertEqual(len(log.read(0, 10)), 1)
+        logging.disable(logging.WARNING)
+        try:
+            self.assertEqual(log.append(changes.DELETE, [(2, 10)]), 2)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual([json.loads(line)['id'] for line in log.read(0, 10)], [1, 2])
+
+    def test_writes_of_an_id_are_logged_in_order(self):
+        log = self.open()
+        priorities = {1: 0, 2: 0}
+        def write(id):
+            for _ in range(50):
+                with log.serialized([id]):
+                    priorities[id] += 1
+                    priority = priorities[id]
+                    time.sleep(0)
+                    log.append(changes.UPDATE, [(id, 10, 20, 'x-sell', priority)])
+        threads = [Thread(target=write, args=(id,)) for id in (1, 2, 1, 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for id in (1, 2):
+            self.assertEqual([json.loads(line)['recommendation']['priority']
+                              for line in log.read(0, 1000) if json.loads(line)['id'] == id],
+                             range(1, 101))
+
+    def test_serialized_holds_off_other_processes(self):
+        log = self.open()
+        held = multiprocessing.Event()
+        def hold():
+            with log.serialized([1]):
+                held.set()
+                time.sleep(0.3)
+        child = multiprocessing.Process(target=hold)
+        child.start()
+        try:
+            self.assertTrue(held.wait(5))
+            start = time.time()
+            with log.serialized([2]):
+                self.assertTrue(time.time() - start < 0.2)
+            with log.serialized():
+                self.assertTrue(time.time() - start >= 0.2)
+        finally:
+            child.join()
+
+    def journals(self):
+        return [name for name in os.listdir(self.directory) if name.startswith(changes.JOURNAL_PREFIX)]
+
+    def test_pending_ids_of_a_dead_process_are_recovered(self):
+        log = self.open()
+        log.append(changes.CREATE, [(2, 10, 20, 'x-sell', 3)])
+        def crash():
+            with log.pending() as mark:
+                mark([1, 2])
+                mark([3])
+                # dies after the commit, before the append
+                os._exit(0)
+        child = multiprocessing.Process(target=crash)
+        child.start()
+        child.join()
+        self.assertEqual(len(self.journals()), 1)
+        logging.disable(logging.WARNING)
+        try:
+            log.recover(lambda ids: [(id, 10, 21, 'up-sell', 4) for id in ids if id == 1])
+        finally:
+            logging.disable(logging.NOTSET)
+        lines = [json.loads(line) for line in log.read(1, 10)]
+        # 3 was never logged, so nothing knows of it
+        self.assertEqual([(line['op'], line['id'], line['parent_product_id']) for line in lines],
+                         [('update', 1, 10), ('delete', 2, 10)])
+        self.assertEqual(lines[0]['recommendation']['priority'], 4)
+        self.assertEqual(self.journals(), [])
+
+    def test_cleared_marks_are_not_recovered(self):
+        log = self.open()
+        other = self.open()
+        with log.pending() as mark:
+            mark([1])
+            with log.pending() as mark:
+                mark([2])
+            # the process is alive
+            other.recover(lambda ids: self.fail('recovered the ids of a live process'))
+        journal = os.path.join(self.directory, self.journals()[0])
+        self.assertEqual(os.path.getsize(journal), 0)
+        log.close()
+        self.logs.remove(log)
+        self.assertEqual(self.journals(), [])
+
+    def test_wait_is_woken_by_an_append(self):
+        log = self.open()
+        writer = self.open()
+        self.assertFalse(log.wait(0, 0.05))
+        thread = Thread(target=lambda: (time.sleep(0.05), writer.append(changes.DELETE, [(1, 10)])))
+        thread.start()
+        start = time.time()
+        self.assertTrue(log.wait(0, 5))
+        self.assertTrue(time.time() - start < 2)
+        thread.join()
+
+    def test_follow_streams_changes_and_heartbeats(self):
+        log = self.open()
+        log.append(changes.DELETE, [(1, 10), (2, 10)])
+        chunks = list(log.follow(0, 0.1, heartbeat=0.03))
+        self.assertEqual(self.seqs(chunks[0].splitlines()), [1, 2])
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(set(chunks[1:]), set(['\n']))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# run with:
+# python -m unittest discover
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+import storage
+import cache
+import cooccurrence
+
+try:
+    import numpy
+    import scipy
+except ImportError:
+    numpy = None
+
+rec = storage.recommendations
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+@unittest.skipIf(numpy is None, 'the co-click job needs numpy and scipy')
+class TestCooccurrence(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.engine = storage.create_db_engine('sqlite:///' + os.path.join(self.workdir, 'c.db'))
+        storage.create_schema(self.engine)
+        # product 1 recommends 2, 3 and 4, product 5 recommends 6
+        self.engine.execute(rec.insert(), [
+            {'id': 1, 'parent_product_id': 1, 'related_product_id': 2, 'type': 'x-sell', 'priority': 1},
+            {'id': 2, 'parent_product_id': 1, 'related_product_id': 3, 'type': 'x-sell', 'priority': 2},
+            {'id': 3, 'parent_product_id': 1, 'related_product_id': 4, 'type': 'up-sell', 'priority': 3},
+            {'id': 4, 'parent_product_id': 5, 'related_product_id': 6, 'type': 'x-sell', 'priority': 1}])
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.workdir)
+
+    def click(self, rec_id, parent_product_id, session, days_ago=0):
+        self.engine.execute(storage.click_events.insert(),
+                            recommendation_id=rec_id, parent_product_id=parent_product_id,
+                            session=session, clicked_at=datetime.utcnow() - timedelta(days=days_ago))
+
+    def coclick(self, parent_product_id):
+        return [row[0] for row in self.engine.execute(
+            rec.select().with_only_columns([rec.c.related_product_id])
+            .where(rec.c.type == cooccurrence.COCLICK_TYPE)
+            .where(rec.c.parent_product_id == parent_product_id)
+            .order_by(rec.c.priority))]
+
+    def test_products_clicked_together_are_recommended(self):
+        # sessions a and b both click 2 and 3 on product 1, c clicks 4 once
+        for session in ('a', 'b'):
+            self.click(1, 1, session)
+            self.click(2, 1, session)
+        self.click(3, 1, 'c')
+        self.click(4, 5, 'c')
+        self.assertEqual(cooccurrence.run(self.engine, min_count=2), 6)
+        # 2 and 3 are never seen apart, 1 was also in session c
+        self.assertEqual(self.coclick(2), [3, 1])
+        self.assertEqual(self.coclick(3), [2, 1])
+        self.assertEqual(self.coclick(1), [2, 3])
+        self.assertEqual(self.coclick(4), [])
+        # curated rows are left alone
+        self.assertEqual(self.engine.execute(rec.count().where(rec.c.type != 'co-click')).scalar(), 4)
+
+    def test_top_k_and_rerun(self):
+        for session in ('a', 'b'):
+            self.click(1, 1, session)
+            self.click(2, 1, session)
+            self.click(3, 1, session)
+        cooccurrence.run(self.engine, top_k=1)
+        self.assertEqual(len(self.coclick(1)), 1)
+        # a run over no events removes the previous results
+        self.assertEqual(cooccurrence.run(self.engine, days=1e-9), 0)
+        self.assertEqual(self.coclick(1), [])
+
+    def test_rewritten_parents_are_invalidated(self):
+        list_cache = cache.LRUCache()
+        for product_id in (1, 2, 3, 5):
+            list_cache.set(product_id, None, '[]')
+        versions = [list_cache.version(product_id) for product_id in (1, 5)]
+        invalidate = cooccurrence.cache_invalidator(list_cache)
+        for session in ('a', 'b'):
+            self.click(1, 1, session)
+            self.click(2, 1, session)
+        cooccurrence.run(self.engine, invalidate=invalidate)
+        self.assertEqual([list_cache.get(product_id) for product_id in (1, 2, 3, 5)],
+                         [None, None, None, '[]'])
+        self.assertEqual([list_cache.version(product_id) == version
+                          for product_id, version in zip((1, 5), versions)], [False, True])
+        # parents left without co-clicks are invalidated too
+        invalidated = []
+        cooccurrence.run(self.engine, days=1e-9, invalidate=invalidated.extend)
+        self.assertEqual(sorted(invalidated), [1, 2, 3])
+
+    def test_clicks_without_a_session_pair_parent_and_related(self):
+        for _ in range(2):
+            self.click(4, 5, None)
+        cooccurrence.run(self.engine)
+        self.assertEqual(self.coclick(5), [6])
+        self.assertEqual(self.coclick(6), [5])
+
+    def test_chunks_give_the_same_result(self):
+        for session in ('a', 'b', 'c'):
+            for rec_id in (1, 2, 3):
+                self.click(rec_id, 1, session)
+        baskets, products = cooccurrence.read_baskets(self.engine)
+        matrix, product_ids = cooccurrence.incidence_matrix(baskets, products)
+        whole = [(p, list(c)) for p, c, s in cooccurrence.similar_products(matrix, chunk_size=100)]
+        chunked = [(p, list(c)) for p, c, s in cooccurrence.similar_products(matrix, chunk_size=1)]
+        self.assertEqual(whole, chunked)
+        self.assertEqual(len(whole), 4)
+
+    def test_large_baskets_are_ignored(self):
+        matrix, product_ids = cooccurrence.incidence_matrix(
+            [0, 0, 0, 1, 1], [1, 2, 3, 1, 2], max_basket=2)
+        self.assertEqual(matrix.nnz, 2)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# run with:
+# python -m unittest discover
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+import storage
+import dataset
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestDataset(unittest.TestCase):
+
+    def test_generate_is_reproducible(self):
+        self.assertEqual(list(dataset.generate(1000, seed=1)), list(dataset.generate(1000, seed=1)))
+        self.assertNotEqual(list(dataset.generate(1000, seed=1)), list(dataset.generate(1000, seed=2)))
+
+    def test_generate_rows(self):
+        rows = list(dataset.generate(20000))
+        self.assertEqual([row['id'] for row in rows], range(1, 20001))
+        relationships = set((row['parent_product_id'], row['related_product_id']) for row in rows)
+        self.assertEqual(len(relationships), len(rows))
+        self.assertFalse([row for row in rows if row['parent_product_id'] == row['related_product_id']])
+        self.assertEqual(set(row['type'] for row in rows), set(name for name, _ in dataset.TYPE_MIX))
+        self.assertTrue(all(1 <= row['priority'] <= dataset.MAX_PRIORITY for row in rows))
+
+    def test_fan_out_has_a_heavy_tail(self):
+        fan_out = {}
+        for row in dataset.generate(50000):
+            fan_out[row['parent_product_id']] = fan_out.get(row['parent_product_id'], 0) + 1
+        mean = 50000.0 / len(fan_out)
+        self.assertTrue(5 < mean < 20, mean)
+        self.assertGreater(max(fan_out.values()), 5 * mean)
+        self.assertGreater(sorted(fan_out.values())[len(fan_out) // 2], 0)
+        self.assertLess(sorted(fan_out.values())[len(fan_out) // 2], mean)
+
+    def test_ndjson_and_csv_round_trip(self):
+        rows = list(dataset.generate(100))
+        for write, read in ((dataset.write_ndjson, dataset.read_ndjson),
+                            (dataset.write_csv, dataset.read_csv)):
+            out = StringIO()
+            write(iter(rows), out)
+            self.assertEqual(list(read(StringIO(out.getvalue()))), rows)
+
+    def test_load(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            engine = storage.create_db_engine('sqlite:///' + os.path.join(workdir, 'd.db'))
+            count, parents = dataset.load(engine, dataset.generate(2500), chunk_size=1000)
+            self.assertEqual(count, 2500)
+            self.assertEqual(engine.execute(storage.recommendations.count()).scalar(), 2500)
+            self.assertEqual(engine.execute(
+                "SELECT count(DISTINCT parent_product_id) FROM recommendations").scalar(), parents)
+            engine.dispose()
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_parse_size(self):
+        self.assertEqual(dataset.parse_size('10k'), 10000)
+        self.assertEqual(dataset.parse_size('10M'), 10000000)
+        self.assertEqual(dataset.parse_size('123'), 123)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# run with:
+# python -m unittest discover
+
+import os
+import shutil
+import tempfile
+import unittest
+import storage
+import queries
+from graph import RecommendationGraph, GraphLoader, load_graph
+
+ROWS = [(4, 1, 9, 'up-sell', 3),
+        (1, 1, 2, 'x-sell', 5),
+        (2, 1, 3, 'up-sell', 5),
+        (3, 2, 4, 'up-sell', None),
+        (5, 7, 8, 'x-sell', 1)]
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRecommendationGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = RecommendationGraph(sorted(ROWS, key=lambda row: (row[1], row[0])))
+
+    def test_product(self):
+        self.assertEqual(self.graph.product(1), [(1, 1, 2, 'x-sell', 5),
+                                                 (2, 1, 3, 'up-sell', 5),
+                                                 (4, 1, 9, 'up-sell', 3)])
+        self.assertEqual(self.graph.product(2), [(3, 2, 4, 'up-sell', None)])
+        self.assertEqual(self.graph.product(7), [(5, 7, 8, 'x-sell', 1)])
+
+    def test_unknown_product(self):
+        self.assertEqual(self.graph.product(0), [])
+        self.assertEqual(self.graph.product(3), [])
+        self.assertEqual(self.graph.product(8), [])
+        self.assertEqual(RecommendationGraph([]).product(1), [])
+
+    def test_type_and_top(self):
+        self.assertEqual([row[0] for row in self.graph.product(1, 'up-sell')], [2, 4])
+        self.assertEqual(self.graph.product(1, 'accessory'), [])
+        self.assertEqual([row[0] for row in self.graph.product(1, top=2)], [4, 1])
+        self.assertEqual([row[0] for row in self.graph.product(1, 'up-sell', 1)], [4])
+
+    def test_stats(self):
+        stats = self.graph.stats()
+        self.assertEqual((stats['products'], stats['edges'], stats['types']), (3, 5, 2))
+        self.assertEqual(stats['bytes'], self.graph.memory())
+        self.assertTrue(0 < stats['bytes_per_edge'] < 64)
+
+    def test_many_types(self):
+        rows = [(id, 1, id, 'type-%d' % id, 1) for id in range(1, 301)]
+        graph = RecommendationGraph(rows)
+        self.assertEqual(graph.stats()['types'], 300)
+        self.assertEqual(graph.product(1, 'type-300'), [(300, 1, 300, 'type-300', 1)])
+
+
+class TestGraphLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.engine = storage.create_db_engine('sqlite:///' + os.path.join(self.workdir, 'g.db'))
+        storage.create_schema(self.engine)
+        queries.prepare(self.engine)
+        self.engine.execute(storage.recommendations.insert(),
+                            [dict(zip(('id', 'parent_product_id', 'related_product_id', 'type', 'priority'), row))
+                             for row in ROWS])
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.workdir)
+
+    def test_load_graph(self):
+        graph = load_graph(self.engine)
+        self.assertEqual(len(graph), len(ROWS))
+        self.assertEqual([row[0] for row in graph.product(1)], [1, 2, 4])
+
+    def test_refresh_swaps_in_a_new_graph(self):
+        loader = GraphLoader(self.engine, refresh_interval=0)
+        first = loader.refresh()
+        self.engine.execute(storage.recommendations.delete())
+        second = loader.refresh()
+        self.assertIs(loader.graph, second)
+        self.assertEqual(second.generation, first.generation + 1)
+        self.assertEqual(second.product(1), [])
+        # the old snapshot is untouched for readers still holding it
+        self.assertEqual(len(first.product(1)), 3)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# run with:
+# python -m unittest discover
+
+import logging
+import unittest
+from sqlalchemy import create_engine
+import metrics
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.metrics = metrics.RequestMetrics(clock=self.clock)
+
+    def request(self, route, elapsed, status=200, size=100, queries=()):
+        self.metrics.start()
+        for duration in queries:
+            self.metrics.query(duration)
+        self.clock.now += elapsed
+        self.metrics.finish(route, 'GET', status, size)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram((1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.samples('h', 'a="b",')), [
+            'h_bucket{a="b",le="1"} 2',
+            'h_bucket{a="b",le="5"} 3',
+            'h_bucket{a="b",le="+Inf"} 4',
+            'h_sum{a="b"} 14.5',
+            'h_count{a="b"} 4'])
+
+    def test_requests_are_counted_per_route_and_status(self):
+        self.request('get_recommendations', 0.002, queries=(0.001, 0.0005))
+        self.request('get_recommendations', 0.02, status=404, size=None)
+        text = self.metrics.render()
+        self.assertIn('http_requests_total{route="get_recommendations",method="GET",status="200"} 1', text)
+        self.assertIn('http_requests_total{route="get_recommendations",method="GET",status="404"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket'
+                      '{route="get_recommendations",method="GET",le="0.0025"} 1', text)
+        self.assertIn('http_request_duration_seconds_count{route="get_recommendations",method="GET"} 2', text)
+        self.assertIn('http_request_db_seconds_sum{route="get_recommendations",method="GET"} 0.0015', text)
+        self.assertIn('http_request_db_queries_total{route="get_recommendations",method="GET"} 2', text)
+        # a response without a known size is not a size sample
+        self.assertIn('http_response_size_bytes_count{route="get_recommendations",method="GET"} 1', text)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_queries_outside_requests_are_not_counted(self):
+        self.metrics.query(1.0)
+        self.request('index', 0.001)
+        self.assertIn('http_request_db_queries_total{route="index",method="GET"} 0', self.metrics.render())
+
+    def test_gauges(self):
+        text = self.metrics.render([('cache_hit_ratio', 'gauge', 'Hits', 0.75)])
+        self.assertIn('# TYPE cache_hit_ratio gauge\ncache_hit_ratio 0.75\n', text)
+
+    def test_instrument_times_statements(self):
+        engine = create_engine('sqlite://')
+        metrics.instrument(engine, self.metrics)
+        self.metrics.start()
+        engine.execute('SELECT 1')
+        engine.execute('SELECT 2')
+        self.metrics.finish('index', 'GET', 200, 10)
+        self.assertIn('http_request_db_queries_total{route="index",method="GET"} 2', self.metrics.render())
+        # instrumenting again replaces the listeners
+        metrics.instrument(engine, self.metrics)
+        self.metrics.start()
+        engine.execute('SELECT 1')
+        self.metrics.finish('index', 'GET', 200, 10)
+        self.assertIn('http_request_db_queries_total{route="index",method="GET"} 3', self.metrics.render())
+        metrics.instrument(engine)
+        self.metrics.start()
+        engine.execute('SELECT 1')
+        self.metrics.finish('index', 'GET', 200, 10)
+        self.assertIn('http_request_db_queries_total{route="index",method="GET"} 3', self.metrics.render())
+
+    def test_slow_query_log(self):
+        engine = create_engine('sqlite://')
+        metrics.instrument(engine, slow_query_threshold=0)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        metrics.logger.addHandler(handler)
+        try:
+            engine.execute('SELECT 1')
+        finally:
+            metrics.logger.removeHandler(handler)
+        self.assertEqual(len(records), 1)
+        self.assertIn('SELECT 1', records[0].getMessage())
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
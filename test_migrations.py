@@ -0,0 +1,81 @@
+# run with:
+# python -m unittest discover
+
+import os
+import shutil
+import tempfile
+import unittest
+from threading import Thread
+from sqlalchemy import inspect
+import storage
+import migrations
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.engine = storage.create_db_engine('sqlite:///' + os.path.join(self.workdir, 'm.db'))
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.workdir)
+
+    def index_names(self):
+        return set(ix['name'] for ix in inspect(self.engine).get_indexes('recommendations'))
+
+    def create_legacy_table(self):
+        # the table as recommendations.sql used to create it, without indexes
+        self.engine.execute("CREATE TABLE recommendations (id INTEGER NOT NULL PRIMARY KEY, "
+                            "parent_product_id INTEGER NOT NULL, related_product_id INTEGER NOT NULL, "
+                            "type VARCHAR(20), priority INTEGER NOT NULL)")
+
+    def test_upgrade_fresh_database(self):
+        self.assertEqual(migrations.upgrade(self.engine), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(migrations.current_version(self.engine), 6)
+        self.assertEqual(self.index_names(), set(['ix_recommendations_product_priority',
+                                                  'ix_recommendations_product_type_priority',
+                                                  'ix_recommendations_type',
+                                                  'uq_recommendations_relationship']))
+
+    def test_upgrade_is_applied_once(self):
+        migrations.upgrade(self.engine)
+        self.assertEqual(migrations.upgrade(self.engine), [])
+
+    def test_concurrent_upgrades_wait_for_each_other(self):
+        url = 'sqlite:///' + os.path.join(self.workdir, 'm.db')
+        results = []
+        def upgrade():
+            engine = storage.create_db_engine(url)
+            try:
+                results.append(migrations.upgrade(engine))
+            finally:
+                engine.dispose()
+        threads = [Thread(target=upgrade) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [[], [], [], [1, 2, 3, 4, 5, 6]])
+        self.assertEqual(migrations.current_version(self.engine), 6)
+
+    def test_upgrade_legacy_table(self):
+        self.create_legacy_table()
+        self.engine.execute("INSERT INTO recommendations VALUES (1,1,2,'x-sell',5)")
+        migrations.upgrade(self.engine)
+        self.assertIn('uq_recommendations_relationship', self.index_names())
+        self.assertEqual(self.engine.execute("SELECT count(*) FROM recommendations").scalar(), 1)
+
+    def test_upgrade_refuses_duplicate_relationships(self):
+        self.create_legacy_table()
+        self.engine.execute("INSERT INTO recommendations VALUES (1,1,2,'x-sell',5),(2,1,2,'x-sell',3)")
+        self.assertRaises(migrations.MigrationError, migrations.upgrade, self.engine)
+        self.assertEqual(migrations.current_version(self.engine), 2)
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
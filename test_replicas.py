@@ -0,0 +1,111 @@
+# run with:
+# python -m unittest discover
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+import storage
+import replicas
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.workdir = tempfile.mkdtemp()
+        # each replica file answers with its own name
+        self.engines = []
+        for name in ('a', 'b', 'c'):
+            engine = storage.create_db_engine('sqlite:///' + os.path.join(self.workdir, name + '.db'))
+            engine.execute("CREATE TABLE name (value VARCHAR(1))")
+            engine.execute("INSERT INTO name VALUES ('%s')" % name)
+            self.engines.append(engine)
+        # a replica that cannot be reached, its directory does not exist
+        self.down = storage.create_db_engine('sqlite:///' + os.path.join(self.workdir, 'down', 'x.db'))
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        for engine in self.engines + [self.down]:
+            engine.dispose()
+        shutil.rmtree(self.workdir)
+
+    def read(self, replica_set):
+        conn = replica_set.connect()
+        if conn is None:
+            return None
+        try:
+            return conn.scalar("SELECT value FROM name")
+        finally:
+            conn.close()
+
+    def test_round_robin(self):
+        replica_set = replicas.ReplicaSet(self.engines, clock=self.clock)
+        self.assertEqual([self.read(replica_set) for _ in range(6)], ['a', 'b', 'c', 'a', 'b', 'c'])
+
+    def test_least_busy(self):
+        replica_set = replicas.ReplicaSet(self.engines, policy=replicas.LEAST_BUSY, clock=self.clock)
+        held = [replica_set.connect(), replica_set.connect()]
+        try:
+            # a and b each have a connection checked out
+            self.assertEqual(self.read(replica_set), 'c')
+            self.assertEqual(replica_set.stats()['checked_out'], [1, 1, 0])
+        finally:
+            for conn in held:
+                conn.close()
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, replicas.ReplicaSet, self.engines, policy='random')
+
+    def test_unreachable_replica_is_ejected(self):
+        replica_set = replicas.ReplicaSet([self.down] + self.engines[:1], eject_seconds=10, clock=self.clock)
+        self.assertEqual([self.read(replica_set) for _ in range(3)], ['a', 'a', 'a'])
+        stats = replica_set.stats()
+        self.assertEqual((stats['healthy'], stats['ejections']), (1, 1))
+        # tried again once the time is up, and ejected again
+        self.clock.now = 11
+        self.assertEqual(replica_set.stats()['healthy'], 2)
+        self.assertEqual([self.read(replica_set) for _ in range(2)], ['a', 'a'])
+        self.assertEqual(replica_set.stats()['ejections'], 2)
+
+    def test_no_replica_reachable(self):
+        replica_set = replicas.ReplicaSet([self.down], clock=self.clock)
+        self.assertIsNone(replica_set.connect())
+        self.assertIsNone(replica_set.connect())
+        self.assertEqual(replica_set.stats()['ejections'], 1)
+
+    def test_recent_writes(self):
+        recent = replicas.RecentWrites(window=5, clock=self.clock)
+        recent.touch(1)
+        self.clock.now = 4
+        self.assertTrue(recent.recent(1))
+        self.assertFalse(recent.recent(2))
+        self.clock.now = 6
+        self.assertFalse(recent.recent(1))
+
+    def test_recent_writes_drop_expired_keys(self):
+        recent = replicas.RecentWrites(window=5, clock=self.clock, max_keys=2)
+        recent.touch(1)
+        recent.touch(2)
+        self.clock.now = 10
+        recent.touch(3)
+        self.assertEqual(sorted(recent.until), [3])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# run with:
+# python -m unittest discover
+
+import json
+import unittest
+import serializer
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSerializer(unittest.TestCase):
+
+    def test_encode_row(self):
+        row = json.loads(serializer.encode_row((1, 2, 3, 'x-sell', 4)))
+        self.assertEqual(row, {'id': 1, 'parent_product_id': 2, 'related_product_id': 3,
+                               'type': 'x-sell', 'priority': 4})
+
+    def test_encode_row_escapes_type_and_null_priority(self):
+        row = json.loads(serializer.encode_row((1, 2, 3, u'say "hi"\n\xe9', None)))
+        self.assertEqual(row['type'], u'say "hi"\n\xe9')
+        self.assertEqual(row['priority'], None)
+
+    def test_encode_rows(self):
+        self.assertEqual(serializer.encode_rows([]), '[]')
+        rows = json.loads(serializer.encode_rows([(1, 2, 3, 'x-sell', 4), (2, 2, 4, 'up-sell', 5)]))
+        self.assertEqual([row['id'] for row in rows], [1, 2])
+        self.assertEqual(rows[1]['related_product_id'], 4)
+
+    def test_every_backend_round_trips(self):
+        message = {'error': u'caf\xe9', 'ids': [1, 2], 'nested': {'ok': True, 'none': None}}
+        for name in serializer.BACKENDS:
+            try:
+                backend, dumps = serializer.load_backend(name)
+            except ImportError:
+                continue
+            self.assertEqual(backend, name)
+            self.assertEqual(json.loads(dumps(message)), message)
+
+    def test_auto_backend(self):
+        backend, dumps = serializer.load_backend('auto')
+        self.assertIn(backend, serializer.BACKENDS)
+        self.assertEqual(dumps(None), 'null')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
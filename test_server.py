@@ -1,16 +1,23 @@
 # run with:
 # python -m unittest discover
 
+import os
+import time
+import shutil
+import tempfile
 import unittest
+from threading import Thread, Event
 import logging
 import json
 import server
+from sqlalchemy import event
 from flask_api import status    # HTTP Status Codes
 
 # Status Codes
 HTTP_200_OK = status.HTTP_200_OK
 HTTP_201_CREATED = status.HTTP_201_CREATED
 HTTP_204_NO_CONTENT = status.HTTP_204_NO_CONTENT
+HTTP_304_NOT_MODIFIED = status.HTTP_304_NOT_MODIFIED
 HTTP_400_BAD_REQUEST = status.HTTP_400_BAD_REQUEST
 HTTP_404_NOT_FOUND = status.HTTP_404_NOT_FOUND
 HTTP_409_CONFLICT = status.HTTP_409_CONFLICT
@@ -25,13 +32,15 @@ class TestRecommendationServer(unittest.TestCase):
 
     @classmethod
     def tearDownClass(self):
-        server.conn.close()
+        server.engine.dispose()
 
     def setUp(self):
         server.app.debug = True
         self.app = server.app.test_client()
-        server.conn.execute("DELETE FROM `recommendations` WHERE id in (1,2,3)")
-        server.conn.execute("INSERT INTO `recommendations` VALUES (1,1,2,'x-sell',5),(2,1,3,'up-sell',5),(3,2,4,'up-sell',5)")
+        server.list_cache.clear()
+        server.item_parents.clear()
+        server.engine.execute("DELETE FROM `recommendations`")
+        server.engine.execute("INSERT INTO `recommendations` VALUES (1,1,2,'x-sell',5),(2,1,3,'up-sell',5),(3,2,4,'up-sell',5)")
 
     def test_index(self):
         resp = self.app.get('/')
@@ -43,6 +52,107 @@ class TestRecommendationServer(unittest.TestCase):
         self.assertTrue( resp.status_code == HTTP_200_OK )
         self.assertTrue( len(resp.data) > 0 )
 
+    def test_get_recommendation_list_paginated(self):
+        resp = self.app.get('/recommendations?limit=2')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertEqual([d['id'] for d in json.loads(resp.data)], [1, 2])
+        cursor = resp.headers['X-Next-Cursor']
+        self.assertIn('rel="next"', resp.headers['Link'])
+        resp = self.app.get('/recommendations?limit=2&cursor=' + cursor)
+        self.assertEqual([d['id'] for d in json.loads(resp.data)], [3])
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+
+    def test_get_recommendation_list_paginated_with_filter(self):
+        resp = self.app.get('/recommendations?type=up-sell&limit=1')
+        self.assertEqual([d['id'] for d in json.loads(resp.data)], [2])
+        resp = self.app.get('/recommendations?type=up-sell&limit=1&cursor=' + resp.headers['X-Next-Cursor'])
+        self.assertEqual([d['id'] for d in json.loads(resp.data)], [3])
+
+    def test_get_recommendation_list_invalid_cursor(self):
+        resp = self.app.get('/recommendations?cursor=garbage')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+        resp = self.app.get('/recommendations?limit=0')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+
+    def test_export_recommendation_list(self):
+        resp = self.app.get('/recommendations?export=json')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertEqual(json.loads(resp.data), json.loads(self.app.get('/recommendations').data))
+
+    def test_export_recommendation_list_ndjson(self):
+        resp = self.app.get('/recommendations?export=ndjson&product-id=1')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.data.splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [1, 2])
+        self.assertEqual(server.engine.pool.checkedout(), 0)
+
+    def test_export_recommendation_list_invalid_mode(self):
+        resp = self.app.get('/recommendations?export=csv')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+
+    def test_get_top_recommendations(self):
+        server.engine.execute("INSERT INTO `recommendations` VALUES (4,1,5,'x-sell',1),(5,1,6,'up-sell',3)")
+        resp = self.app.get('/recommendations?product-id=1&top=2')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertEqual([d['id'] for d in json.loads(resp.data)], [4, 5])
+        resp = self.app.get('/recommendations?product-id=1&top=2&type=x-sell')
+        self.assertEqual([d['id'] for d in json.loads(resp.data)], [4, 1])
+
+    def test_get_top_recommendations_invalidated(self):
+        self.assertEqual([d['id'] for d in json.loads(self.app.get('/recommendations?product-id=1&top=1').data)], [1])
+        self.app.put('/recommendations/2/clicked', content_type='application/json')
+        self.assertEqual([d['id'] for d in json.loads(self.app.get('/recommendations?product-id=1&top=1').data)], [2])
+
+    def test_get_top_recommendations_invalid(self):
+        resp = self.app.get('/recommendations?product-id=1&top=0')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+        resp = self.app.get('/recommendations?top=5')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+
+    def test_lookup_several_products(self):
+        resp = self.app.get('/recommendations?product-ids=1,2,7,1')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertEqual(sorted(data.keys()), ['1', '2', '7'])
+        self.assertEqual([d['id'] for d in data['1']], [1, 2])
+        self.assertEqual([d['id'] for d in data['2']], [3])
+        self.assertEqual(data['7'], [])
+        self.assertEqual(data['1'], self.get_product_list(1))
+
+    def test_lookup_uses_cache_and_one_query_for_misses(self):
+        self.get_product_list(1)
+        before = server.list_cache.stats()
+        resp = self.app.post('/recommendations/lookup', data=json.dumps({'product-ids': [1, 2, 3]}),
+                             content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        after = server.list_cache.stats()
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 2)
+        # the misses were cached by the lookup
+        self.assertEqual([d['id'] for d in self.get_product_list(2)], [3])
+        self.assertEqual(server.list_cache.stats()['hits'] - after['hits'], 1)
+
+    def test_lookup_top_and_dedup(self):
+        server.engine.execute("INSERT INTO `recommendations` VALUES (4,2,2,'x-sell',1),(5,1,4,'x-sell',9)")
+        resp = self.app.post('/recommendations/lookup',
+                             data=json.dumps({'product-ids': [1, 2], 'top': 2, 'dedup': True}),
+                             content_type='application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([d['id'] for d in data['1']], [1, 2])
+        # related product 2 was already recommended for product 1
+        self.assertEqual([d['id'] for d in data['2']], [3])
+
+    def test_lookup_invalid(self):
+        resp = self.app.get('/recommendations?product-ids=1,a')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+        resp = self.app.post('/recommendations/lookup', data='[1, 2]', content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+
+    def test_changes_not_configured(self):
+        resp = self.app.get('/recommendations/changes?since=0')
+        self.assertEqual( resp.status_code, HTTP_404_NOT_FOUND )
+
     def test_get_recommendation(self):
         resp = self.app.get('/recommendations/3')
         self.assertEqual( resp.status_code, HTTP_200_OK )
@@ -71,6 +181,12 @@ class TestRecommendationServer(unittest.TestCase):
         resp_get_deleted = self.app.get('recommendations/2')
         self.assertTrue ( resp_get_deleted.status_code == HTTP_404_NOT_FOUND )
         
+    def test_get_recommendation_by_hyphenated_type(self):
+        resp = self.app.get('/recommendations?type=up-sell')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(sorted(d['id'] for d in data), [2, 3])
+
     def test_get_recommendation_by_type(self):
         log = logging.getLogger("Test GET recommendations by type")
         resp = self.app.get('/recommendations?type=x-sell')
@@ -99,6 +215,67 @@ class TestRecommendationServer(unittest.TestCase):
         resp = self.app.put('/recommendations/0/clicked', content_type='application/json')
         self.assertEqual( resp.status_code, HTTP_404_NOT_FOUND )
 
+    def test_clicked_recommendation_batched(self):
+        self.start_batched_clicks()
+        try:
+            for _ in range(3):
+                resp = self.app.put('/recommendations/3/clicked', content_type='application/json')
+                self.assertEqual( resp.status_code, HTTP_200_OK )
+            self.assertEqual(self.get_product_list(2)[0]['priority'], 5)
+            self.assertEqual(server.click_batcher.flush(), 1)
+            self.assertEqual(self.get_product_list(2)[0]['priority'], 2)
+        finally:
+            self.stop_batched_clicks()
+
+    def test_clicked_recommendation_batched_reads_only_unseen_ids(self):
+        self.start_batched_clicks()
+        try:
+            click = lambda: self.app.put('/recommendations/3/clicked', content_type='application/json')
+            self.assertEqual(self.count_queries(click), 1)
+            self.assertEqual(self.count_queries(click), 0)
+            self.assertEqual(server.click_batcher.flush(), 1)
+            self.assertEqual(self.get_product_list(2)[0]['priority'], 3)
+        finally:
+            self.stop_batched_clicks()
+
+    def test_clicked_recommendation_batched_stops_at_one(self):
+        self.start_batched_clicks()
+        try:
+            for _ in range(10):
+                self.app.put('/recommendations/1/clicked', content_type='application/json')
+        finally:
+            # stopping flushes whatever is still queued
+            self.stop_batched_clicks()
+        resp = self.app.get('/recommendations/1')
+        self.assertEqual(json.loads(resp.data)['priority'], 1)
+
+    def test_clicked_recommendation_events(self):
+        os.environ['CLICK_EVENTS'] = 'True'
+        os.environ['CLICK_FLUSH_INTERVAL'] = '3600'
+        try:
+            server.initialize_clicks()
+            self.app.put('/recommendations/3/clicked?session=abc')
+            self.app.put('/recommendations/1/clicked', headers={'X-Session-Id': 'def'})
+            self.app.put('/recommendations/0/clicked')
+            self.assertEqual(server.click_events.flush(), 2)
+            events = server.engine.execute(server.storage.click_events.select()
+                                           .order_by('id')).fetchall()
+            self.assertEqual([(e['recommendation_id'], e['parent_product_id'], e['session']) for e in events],
+                             [(3, 2, 'abc'), (1, 1, 'def')])
+        finally:
+            del os.environ['CLICK_EVENTS']
+            del os.environ['CLICK_FLUSH_INTERVAL']
+            server.initialize_clicks()
+            server.engine.execute(server.storage.click_events.delete())
+
+    def test_clicked_recommendation_batched_id_not_found(self):
+        self.start_batched_clicks()
+        try:
+            resp = self.app.put('/recommendations/0/clicked', content_type='application/json')
+            self.assertEqual( resp.status_code, HTTP_404_NOT_FOUND )
+        finally:
+            self.stop_batched_clicks()
+
     def test_get_recommendation_by_non_existent_type(self):
         resp = self.app.get('/recommendations?type=foo')
         self.assertTrue(resp.status_code == HTTP_200_OK)
@@ -121,12 +298,16 @@ class TestRecommendationServer(unittest.TestCase):
         self.assertFalse(data)
 
     def test_get_recommendation_by_type_and_parent_id(self):
-        log = logging.getLogger("Test GET recommendations by parent_product_id and type")
-        log.warning("result with spaces between queries are errorneous.")
-
         resp = self.app.get('/recommendations?product-id=1&type=up-sell')
         data = json.loads(resp.data)
         self.assertTrue(resp.status_code == HTTP_200_OK, msg=data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['id'], 2)
+
+    def test_get_recommendation_by_quoted_type(self):
+        resp = self.app.get('/recommendations?type=x-sell" OR "1"="1')
+        data = json.loads(resp.data)
+        self.assertTrue(resp.status_code == HTTP_200_OK, msg=data)
         self.assertFalse(data)
 
     def test_get_recommendation_by_type_and_non_existent_parent_id(self):
@@ -164,11 +345,104 @@ class TestRecommendationServer(unittest.TestCase):
         self.assertEqual( len(data), recommendation_count + 1 )
         self.assertIn( new_json, data )
 
+    def test_create_recommendation_in_empty_table(self):
+        server.engine.execute("DELETE FROM `recommendations`")
+        new_recommendation = {'parent_product_id': 2, 'priority': 5, 'related_product_id': 2, 'type': 'x-sell'}
+        resp = self.app.post('/recommendations', data=json.dumps(new_recommendation), content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_201_CREATED )
+        new_json = json.loads(resp.data)
+        self.assertEqual(self.app.get('/recommendations/%d' % new_json['id']).data, resp.data)
+
+    def test_create_recommendation_concurrently(self):
+        recommendation_count = self.get_recommendation_count()
+        statuses, ids = [], []
+        def create(parent_product_id):
+            client = server.app.test_client()
+            for related_product_id in range(10):
+                new_recommendation = {'parent_product_id': parent_product_id, 'priority': 1,
+                                      'related_product_id': related_product_id, 'type': 'x-sell'}
+                resp = client.post('/recommendations', data=json.dumps(new_recommendation),
+                                   content_type='application/json')
+                statuses.append(resp.status_code)
+                ids.append(json.loads(resp.data).get('id'))
+        threads = [Thread(target=create, args=(parent,)) for parent in range(10, 26)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(set(statuses), set([HTTP_201_CREATED]))
+        self.assertEqual(len(set(ids)), 160)
+        self.assertEqual(self.get_recommendation_count(), recommendation_count + 160)
+
+    def test_create_recommendation_conflict(self):
+        new_recommendation = {'parent_product_id': 1, 'priority': 1, 'related_product_id': 2, 'type': 'x-sell'}
+        resp = self.app.post('/recommendations', data=json.dumps(new_recommendation), content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_409_CONFLICT )
+
+    def test_update_recommendation_conflict(self):
+        new_recommendation = {'parent_product_id': 1, 'priority': 1, 'related_product_id': 3, 'type': 'x-sell'}
+        self.app.post('/recommendations', data=json.dumps(new_recommendation), content_type='application/json')
+        resp = self.app.put('/recommendations/2', data=json.dumps(new_recommendation), content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_409_CONFLICT )
+
+    def test_bulk_conflicts(self):
+        rows = [{'parent_product_id': 1, 'priority': 1, 'related_product_id': 2, 'type': 'x-sell'},
+                {'parent_product_id': 1, 'priority': 1, 'related_product_id': 2, 'type': 'up-sell'}]
+        resp = self.app.post('/recommendations/bulk', data=json.dumps(rows), content_type='application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([d['status'] for d in data], [HTTP_409_CONFLICT, HTTP_201_CREATED])
+        rows = [{'id': 1, 'parent_product_id': 1, 'priority': 1, 'related_product_id': 2, 'type': 'up-sell'},
+                {'id': 3, 'parent_product_id': 2, 'priority': 9, 'related_product_id': 4, 'type': 'up-sell'}]
+        resp = self.app.put('/recommendations/bulk', data=json.dumps(rows), content_type='application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([d['status'] for d in data], [HTTP_409_CONFLICT, HTTP_200_OK])
+        self.assertEqual(json.loads(self.app.get('/recommendations/3').data)['priority'], 9)
+
+    def test_only_duplicates_are_conflicts(self):
+        rows = [{'parent_product_id': 1, 'priority': 1, 'related_product_id': 2, 'type': None}]
+        resp = self.app.post('/recommendations/bulk', data=json.dumps(rows), content_type='application/json')
+        self.assertEqual([d['status'] for d in json.loads(resp.data)], [HTTP_400_BAD_REQUEST])
+        conn = server.engine.connect()
+        try:
+            with conn.begin():
+                self.assertEqual(server.queries.insert_rows(conn, [dict(rows[0], type='x-sell')]), [None])
+            with conn.begin():
+                self.assertRaises(conn.dialect.dbapi.IntegrityError, server.queries.insert_rows, conn, rows)
+        finally:
+            conn.close()
+
+    def test_queries_use_indexes(self):
+        if server.engine.dialect.name != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is SQLite specific')
+        params = {'type': 'x-sell', 'parent_product_id': 1, 'related_product_id': 2, 'rec_id': 1,
+                  'after_id': 0, 'limit': 10, 'new_type': 'x-sell', 'new_priority': 1, 'clicks': 1}
+        for name, compiled in server.queries.compiled.items():
+            if name in ('list_all', 'sorted_all', 'snapshot', 'insert', 'insert_with_id'):
+                continue
+            bound = compiled.construct_params(params)
+            plan = server.engine.execute('EXPLAIN QUERY PLAN ' + compiled.string,
+                                         [bound[key] for key in compiled.positiontup]).fetchall()
+            details = [row[-1] for row in plan]
+            self.assertFalse([d for d in details if d.startswith('SCAN')], msg='%s: %s' % (name, details))
+            if name.startswith('top_'):
+                # the index must also deliver the priority order
+                self.assertFalse([d for d in details if 'TEMP B-TREE' in d], msg='%s: %s' % (name, details))
+
     def test_create_recommendation_with_no_data(self):
         resp = self.app.post('/recommendations', content_type='application/json')
         data = json.loads(resp.data)
         self.assertTrue( resp.status_code == HTTP_400_BAD_REQUEST )
 
+    def test_create_and_update_recommendation_with_invalid_type(self):
+        for rec_type in (5, None, '', 'x' * 21):
+            payload = json.dumps({'parent_product_id': 2, 'related_product_id': 9,
+                                  'type': rec_type, 'priority': 5})
+            resp = self.app.post('/recommendations', data=payload, content_type='application/json')
+            self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST, msg=repr(rec_type))
+            resp = self.app.put('/recommendations/1', data=payload, content_type='application/json')
+            self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST, msg=repr(rec_type))
+        self.assertEqual(json.loads(self.app.get('/recommendations/1').data)['type'], 'x-sell')
+
     def test_create_recommendation_with_no_parent_product_id(self):
         new_recommendation = {'priority': '5', 'related_product_id':'2', 'type': 'x-sell'}
         data = json.dumps(new_recommendation)
@@ -257,9 +531,440 @@ class TestRecommendationServer(unittest.TestCase):
         self.assertEqual (new_json['priority'], 5)
         self.assertEqual (new_json['related_product_id'], 2)
 
+    def test_product_list_served_from_cache(self):
+        before = server.list_cache.stats()
+        first = self.app.get('/recommendations?product-id=1')
+        second = self.app.get('/recommendations?product-id=1')
+        self.assertEqual(first.data, second.data)
+        after = json.loads(self.app.get('/admin/cache').data)
+        self.assertEqual(after['misses'], before['misses'] + 1)
+        self.assertEqual(after['hits'], before['hits'] + 1)
+
+    def test_no_stale_reads_after_create(self):
+        self.get_product_list(2)
+        new_recommendation = {'parent_product_id': 2, 'priority': 5, 'related_product_id': 9, 'type': 'x-sell'}
+        self.app.post('/recommendations', data=json.dumps(new_recommendation), content_type='application/json')
+        self.assertIn(9, [d['related_product_id'] for d in self.get_product_list(2)])
+
+    def test_no_stale_reads_after_update(self):
+        self.get_product_list(2, 'up-sell')
+        new_recommendation = {'parent_product_id': 2, 'priority': 5, 'related_product_id': 4, 'type': 'x-sell'}
+        self.app.put('/recommendations/3', data=json.dumps(new_recommendation), content_type='application/json')
+        self.assertEqual(self.get_product_list(2, 'up-sell'), [])
+
+    def test_no_stale_reads_after_delete(self):
+        self.get_product_list(1)
+        self.app.delete('/recommendations/1')
+        self.assertEqual([d['id'] for d in self.get_product_list(1)], [2])
+
+    def test_no_stale_reads_after_clicked(self):
+        self.get_product_list(2)
+        self.app.put('/recommendations/3/clicked', content_type='application/json')
+        self.assertEqual(self.get_product_list(2)[0]['priority'], 4)
+
+    def test_mutation_keeps_other_products_cached(self):
+        self.get_product_list(1)
+        self.app.put('/recommendations/3/clicked', content_type='application/json')
+        hits = server.list_cache.stats()['hits']
+        self.get_product_list(1)
+        self.assertEqual(server.list_cache.stats()['hits'], hits + 1)
+
+    def test_conditional_get_product_list(self):
+        resp = self.app.get('/recommendations?product-id=1')
+        etag = resp.headers['ETag']
+        self.assertIn('must-revalidate', resp.headers['Cache-Control'])
+        queries = self.count_queries(lambda: self.assertEqual(
+            self.app.get('/recommendations?product-id=1', headers={'If-None-Match': etag}).status_code,
+            HTTP_304_NOT_MODIFIED))
+        self.assertEqual(queries, 0)
+        resp = self.app.get('/recommendations?product-id=1&type=x-sell', headers={'If-None-Match': '"stale"'})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+
+    def test_conditional_get_recommendation(self):
+        resp = self.app.get('/recommendations/1')
+        etag = resp.headers['ETag']
+        self.assertEqual(self.app.get('/recommendations/1').headers['ETag'], etag)
+        queries = self.count_queries(lambda: self.assertEqual(
+            self.app.get('/recommendations/1', headers={'If-None-Match': etag}).status_code,
+            HTTP_304_NOT_MODIFIED))
+        self.assertEqual(queries, 0)
+        # an ETag of another recommendation never matches
+        resp = self.app.get('/recommendations/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+
+    def test_no_etags_from_an_unshared_cache_of_several_workers(self):
+        etag = self.app.get('/recommendations/1').headers['ETag']
+        server.SERVER_WORKERS = 3
+        try:
+            for url in ('/recommendations/1', '/recommendations?product-id=1'):
+                resp = self.app.get(url, headers={'If-None-Match': etag})
+                self.assertEqual(resp.status_code, HTTP_200_OK)
+                self.assertNotIn('ETag', resp.headers)
+        finally:
+            server.SERVER_WORKERS = 1
+
+    def test_admin_invalidate(self):
+        etag = self.app.get('/recommendations?product-id=1').headers['ETag']
+        server.engine.execute("UPDATE `recommendations` SET priority = 9 WHERE id = 1")
+        resp = self.app.post('/admin/cache/invalidate', content_type='application/json',
+                             data=json.dumps({'product-ids': [1, 1, 2]}))
+        self.assertEqual(json.loads(resp.data), {'invalidated': 2})
+        resp = self.app.get('/recommendations?product-id=1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertIn(9, [rec['priority'] for rec in json.loads(resp.data)])
+        for data in ('', '{}', '{"product-ids": 1}', '{"product-ids": ["a"]}'):
+            resp = self.app.post('/admin/cache/invalidate', content_type='application/json', data=data)
+            self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_mutations_change_etags(self):
+        new_recommendation = {'parent_product_id': 1, 'priority': 5, 'related_product_id': 9, 'type': 'x-sell'}
+        update = {'parent_product_id': 1, 'priority': 3, 'related_product_id': 2, 'type': 'x-sell'}
+        mutations = [lambda: self.app.post('/recommendations', data=json.dumps(new_recommendation),
+                                           content_type='application/json'),
+                     lambda: self.app.put('/recommendations/1', data=json.dumps(update),
+                                          content_type='application/json'),
+                     lambda: self.app.put('/recommendations/1/clicked', content_type='application/json'),
+                     lambda: self.app.delete('/recommendations/2')]
+        for mutate in mutations:
+            list_etag = self.app.get('/recommendations?product-id=1').headers['ETag']
+            item_etag = self.app.get('/recommendations/1').headers['ETag']
+            other_etag = self.app.get('/recommendations?product-id=2').headers['ETag']
+            mutate()
+            resp = self.app.get('/recommendations?product-id=1', headers={'If-None-Match': list_etag})
+            self.assertEqual(resp.status_code, HTTP_200_OK)
+            self.assertNotEqual(resp.headers['ETag'], list_etag)
+            resp = self.app.get('/recommendations/1', headers={'If-None-Match': item_etag})
+            self.assertEqual(resp.status_code, HTTP_200_OK)
+            resp = self.app.get('/recommendations?product-id=2', headers={'If-None-Match': other_etag})
+            self.assertEqual(resp.status_code, HTTP_304_NOT_MODIFIED)
+
+    def test_mutations_take_one_statement(self):
+        update = json.dumps({'parent_product_id': 2, 'priority': 3, 'related_product_id': 4, 'type': 'up-sell'})
+        put = lambda: self.assertEqual(self.app.put('/recommendations/3', data=update,
+                                                    content_type='application/json').status_code, HTTP_200_OK)
+        self.assertEqual(self.count_queries(put), 1)
+        # the update told the service the parent product of recommendation 3
+        click = lambda: self.assertEqual(self.app.put('/recommendations/3/clicked').status_code, HTTP_200_OK)
+        self.assertEqual(self.count_queries(click), 1)
+        delete = lambda: self.app.delete('/recommendations/3')
+        self.assertEqual(self.count_queries(delete), 1)
+        self.assertEqual(self.app.get('/recommendations/3').status_code, HTTP_404_NOT_FOUND)
+        # an id the service has not seen yet is looked up first
+        click = lambda: self.app.put('/recommendations/1/clicked')
+        self.assertEqual(self.count_queries(click), 2)
+        self.assertEqual(self.count_queries(click), 1)
+        self.assertEqual(json.loads(self.app.get('/recommendations/1').data)['priority'], 3)
+        missing = lambda: self.assertEqual(self.app.put('/recommendations/0/clicked').status_code,
+                                           HTTP_404_NOT_FOUND)
+        self.assertEqual(self.count_queries(missing), 1)
+
+    def test_least_recently_used_parents_are_forgotten(self):
+        max_item_parents = server.MAX_ITEM_PARENTS
+        server.MAX_ITEM_PARENTS = 2
+        try:
+            for id in (1, 2):
+                self.app.get('/recommendations/%d' % id)
+            self.app.get('/recommendations/1')
+            self.app.get('/recommendations/3')
+            self.assertEqual(server.item_parents.keys(), [1, 3])
+            click = lambda: self.app.put('/recommendations/1/clicked')
+            self.assertEqual(self.count_queries(click), 1)
+        finally:
+            server.MAX_ITEM_PARENTS = max_item_parents
+
+    def test_mutations_of_a_reused_id(self):
+        server.item_parents[1] = 7
+        resp = self.app.put('/recommendations/1/clicked')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(server.item_parents[1], 1)
+        self.assertEqual(json.loads(self.app.get('/recommendations/1').data)['priority'], 4)
+
+    def test_graph_read_mode(self):
+        os.environ['READ_MODE'] = 'graph'
+        os.environ['GRAPH_REFRESH_INTERVAL'] = '0'
+        os.environ['GRAPH_REFRESH_DELAY'] = '0'
+        try:
+            server.initialize_graph()
+            resp = self.app.get('/recommendations?product-id=1')
+            self.assertEqual([d['id'] for d in json.loads(resp.data)], [1, 2])
+            etag = resp.headers['ETag']
+            resp = self.app.get('/recommendations?product-id=1', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, HTTP_304_NOT_MODIFIED)
+            self.assertEqual([d['id'] for d in self.get_product_list(1, 'up-sell')], [2])
+            data = json.loads(self.app.get('/recommendations?product-ids=1,2&top=1').data)
+            self.assertEqual(dict((k, [d['id'] for d in v]) for k, v in data.items()), {'1': [1], '2': [3]})
+            self.assertEqual(json.loads(self.app.get('/admin/graph').data)['edges'], 3)
+            # a write wakes the loader, which swaps in a new snapshot
+            generation = server.graph_loader.graph.generation
+            self.app.delete('/recommendations/1')
+            deadline = time.time() + 5
+            while server.graph_loader.graph.generation == generation and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual([d['id'] for d in self.get_product_list(1)], [2])
+        finally:
+            del os.environ['READ_MODE']
+            del os.environ['GRAPH_REFRESH_INTERVAL']
+            del os.environ['GRAPH_REFRESH_DELAY']
+            server.initialize_graph()
+        self.assertEqual(self.app.get('/admin/graph').status_code, HTTP_404_NOT_FOUND)
+
+    def test_readiness(self):
+        resp = self.app.get('/ready')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['status'], 'ready')
+        server.drain()
+        try:
+            resp = self.app.get('/ready')
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(json.loads(resp.data)['status'], 'draining')
+            # requests are still served while draining
+            self.assertEqual(self.app.get('/recommendations/1').status_code, HTTP_200_OK)
+        finally:
+            server.draining = False
+
+    def test_metrics(self):
+        os.environ['METRICS'] = 'True'
+        server.initialize_metrics()
+        self.app.get('/')
+        self.app.get('/recommendations/1')
+        self.app.get('/recommendations?product-id=1')
+        self.app.get('/recommendations?product-id=1')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain'))
+        self.assertIn('http_requests_total{route="get_recommendations",method="GET",status="200"} 1', resp.data)
+        self.assertIn('http_request_duration_seconds_count{route="list_recommendations",method="GET"} 2',
+                      resp.data)
+        self.assertIn('http_request_db_queries_total{route="index",method="GET"} 0', resp.data)
+        self.assertNotIn('http_request_db_queries_total{route="get_recommendations",method="GET"} 0', resp.data)
+        self.assertIn('\ncache_hit_ratio ', resp.data)
+        # off by default
+        del os.environ['METRICS']
+        server.initialize_metrics()
+        self.assertEqual(self.app.get('/metrics').status_code, HTTP_404_NOT_FOUND)
+
+    def test_unhandled_errors_are_measured(self):
+        def fail(id):
+            raise RuntimeError('boom')
+        os.environ['METRICS'] = 'True'
+        server.initialize_metrics()
+        versioned_row = server.versioned_row
+        server.versioned_row = fail
+        try:
+            # the debug app re-raises the error after the teardown
+            self.assertRaises(RuntimeError, self.app.get, '/recommendations/1')
+            resp = self.app.get('/metrics')
+            self.assertIn('http_requests_total{route="get_recommendations",method="GET",status="500"} 1',
+                          resp.data)
+            self.assertIn('http_request_duration_seconds_count{route="get_recommendations",method="GET"} 1',
+                          resp.data)
+        finally:
+            server.versioned_row = versioned_row
+            del os.environ['METRICS']
+            server.initialize_metrics()
+
+    def test_bulk_create_recommendations(self):
+        recommendation_count = self.get_recommendation_count()
+        rows = [{'parent_product_id': 5, 'priority': 1, 'related_product_id': 6, 'type': 'x-sell'},
+                {'parent_product_id': 'a', 'priority': 1, 'related_product_id': 6, 'type': 'x-sell'},
+                {'parent_product_id': 5, 'priority': 2, 'related_product_id': 7, 'type': 'up-sell'}]
+        resp = self.app.post('/recommendations/bulk', data=json.dumps(rows), content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertEqual([d['status'] for d in data], [HTTP_201_CREATED, HTTP_400_BAD_REQUEST, HTTP_201_CREATED])
+        self.assertEqual(self.get_recommendation_count(), recommendation_count + 2)
+        resp = self.app.get('/recommendations/%d' % data[2]['id'])
+        self.assertEqual(json.loads(resp.data)['related_product_id'], 7)
+
+    def test_bulk_create_recommendations_ndjson(self):
+        body = '{"parent_product_id": 5, "priority": 1, "related_product_id": 6, "type": "x-sell"}\n' \
+               'not json\n' \
+               '\n' \
+               '{"parent_product_id": 5, "priority": 2, "related_product_id": 7, "type": "x-sell"}\n'
+        resp = self.app.post('/recommendations/bulk', data=body, content_type='application/x-ndjson')
+        data = json.loads(resp.data)
+        self.assertEqual([d['status'] for d in data], [HTTP_201_CREATED, HTTP_400_BAD_REQUEST, HTTP_201_CREATED])
+        self.assertEqual(len(self.get_product_list(5)), 2)
+
+    def test_bulk_create_recommendations_not_an_array(self):
+        resp = self.app.post('/recommendations/bulk', data='{"a": 1}', content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+
+    def test_bulk_update_recommendations(self):
+        self.get_product_list(1)
+        rows = [{'id': 1, 'parent_product_id': 1, 'priority': 2, 'related_product_id': 2, 'type': 'up-sell'},
+                {'id': 0, 'parent_product_id': 1, 'priority': 2, 'related_product_id': 2, 'type': 'up-sell'},
+                {'id': 'x', 'parent_product_id': 1, 'priority': 2, 'related_product_id': 2, 'type': 'up-sell'}]
+        resp = self.app.put('/recommendations/bulk', data=json.dumps(rows), content_type='application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([d['status'] for d in data], [HTTP_200_OK, HTTP_404_NOT_FOUND, HTTP_400_BAD_REQUEST])
+        updated = [d for d in self.get_product_list(1) if d['id'] == 1][0]
+        self.assertEqual((updated['type'], updated['priority']), ('up-sell', 2))
+
+    def test_bulk_delete_recommendations(self):
+        self.get_product_list(1)
+        resp = self.app.delete('/recommendations/bulk', data=json.dumps([1, {'id': 2}, 0, 'x']),
+                               content_type='application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([d['status'] for d in data],
+                         [HTTP_204_NO_CONTENT, HTTP_204_NO_CONTENT, HTTP_404_NOT_FOUND, HTTP_400_BAD_REQUEST])
+        self.assertEqual(self.get_product_list(1), [])
+
+    def test_swagger_spec(self):
+        resp = self.app.get('/v1/spec')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertIn('/recommendations/bulk', json.loads(resp.data)['paths'])
+
+    def test_swagger_spec_built_once(self):
+        spec = self.app.get('/v1/spec').data
+        built = server.swagger_spec
+        self.assertEqual(self.app.get('/v1/spec').data, spec)
+        self.assertIs(server.swagger_spec, built)
+        self.assertEqual(json.loads(self.app.get('/specs').data)['specs'][0]['url'], '/v1/spec')
+        self.assertEqual(self.app.get('/apidocs/index.html').status_code, HTTP_200_OK)
+
     def test_initialize_db(self):
         server.initialize_mysql()
-        self.assertTrue(server.conn != None)
+        self.assertTrue(server.engine != None)
+
+    def test_lazy_engine(self):
+        old_engine = server.engine
+        server.initialize_mysql(test=True, lazy=True)
+        try:
+            self.assertIsNone(server.engine)
+            # the first request that needs the database opens it
+            resp = self.app.get('/recommendations')
+            self.assertEqual(resp.status_code, HTTP_200_OK)
+            self.assertIsNotNone(server.engine)
+        finally:
+            old_engine.dispose()
+            self.setUp()
+
+    def start_replicas(self, *priorities):
+        """
+        Serves reads from SQLite replicas whose copy of recommendation 1
+        has the given priority, so a read shows where it was served
+        """
+        self.workdir = tempfile.mkdtemp()
+        engines = []
+        for number, priority in enumerate(priorities):
+            engine = server.storage.create_db_engine(
+                'sqlite:///' + os.path.join(self.workdir, 'replica%d.db' % number))
+            server.migrations.upgrade(engine)
+            engine.execute("INSERT INTO `recommendations` VALUES (1,1,2,'x-sell',%d)" % priority)
+            engines.append(engine)
+        server.replica_set = server.replicas.ReplicaSet(engines)
+        server.recent_writes = server.replicas.RecentWrites(window=60)
+
+    def stop_replicas(self):
+        server.replica_set.dispose()
+        server.replica_set = None
+        shutil.rmtree(self.workdir)
+
+    def get_priority(self, client=None):
+        resp = (client or self.app).get('/recommendations/1')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        return json.loads(resp.data)['priority']
+
+    def test_reads_from_replicas(self):
+        self.start_replicas(7, 8)
+        try:
+            self.assertEqual([self.get_priority() for _ in range(4)], [7, 8, 7, 8])
+            # the cache is only filled from the primary
+            self.assertEqual(self.get_product_list(1)[0]['priority'], 5)
+            resp = self.app.get('/admin/replicas')
+            self.assertEqual(json.loads(resp.data)['healthy'], 2)
+        finally:
+            self.stop_replicas()
+        self.assertEqual(self.get_priority(), 5)
+        self.assertEqual(self.app.get('/admin/replicas').status_code, HTTP_404_NOT_FOUND)
+
+    def test_read_your_writes(self):
+        self.start_replicas(7)
+        try:
+            self.assertEqual(self.get_priority(), 7)
+            resp = self.app.put('/recommendations/1/clicked', content_type='application/json')
+            self.assertIn(server.WROTE_COOKIE, resp.headers['Set-Cookie'])
+            # everyone reads the product written from the primary
+            other = server.app.test_client()
+            self.assertEqual(self.get_priority(other), 4)
+            self.assertEqual(json.loads(other.get('/recommendations?product-id=1').data)[0]['priority'], 4)
+            # after the window only the cookie of the client that wrote is left
+            server.recent_writes = server.replicas.RecentWrites(window=0)
+            server.list_cache.clear()
+            self.assertEqual(self.get_priority(), 4)
+            self.assertEqual(self.get_priority(other), 7)
+        finally:
+            self.stop_replicas()
+
+    def test_no_tags_or_cache_fills_from_replicas(self):
+        self.start_replicas(7)
+        try:
+            resp = self.app.get('/recommendations/1')
+            self.assertEqual(json.loads(resp.data)['priority'], 7)
+            self.assertNotIn('ETag', resp.headers)
+            # a lagging replica would cache its stale list under a fresh tag
+            server.recent_writes = server.replicas.RecentWrites(window=0)
+            self.app.put('/recommendations/1/clicked')
+            other = server.app.test_client()
+            for client in (other, other, self.app):
+                resp = client.get('/recommendations?product-id=1')
+                self.assertEqual(json.loads(resp.data)[0]['priority'], 4)
+                self.assertIn('ETag', resp.headers)
+            resp = other.post('/recommendations/lookup', content_type='application/json',
+                              data=json.dumps({'product-ids': [1]}))
+            self.assertEqual(json.loads(resp.data)['1'][0]['priority'], 4)
+        finally:
+            self.stop_replicas()
+
+    def test_replica_reads_are_measured(self):
+        self.start_replicas(7)
+        os.environ['METRICS'] = 'True'
+        server.initialize_metrics()
+        try:
+            self.assertEqual(self.get_priority(), 7)
+            resp = self.app.get('/metrics')
+            # the route only read the replica
+            line = 'http_request_db_queries_total{route="get_recommendations",method="GET"} '
+            self.assertIn(line, resp.data)
+            self.assertNotIn(line + '0\n', resp.data)
+        finally:
+            self.stop_replicas()
+            del os.environ['METRICS']
+            server.initialize_metrics()
+
+    def test_unreachable_replicas_fall_back_to_primary(self):
+        self.start_replicas(7)
+        down = server.storage.create_db_engine('sqlite:///' + os.path.join(self.workdir, 'down', 'x.db'))
+        server.replica_set = server.replicas.ReplicaSet([down])
+        logging.disable(logging.WARNING)
+        try:
+            self.assertEqual(self.get_priority(), 5)
+            self.assertEqual(json.loads(self.app.get('/admin/replicas').data)['ejections'], 1)
+        finally:
+            logging.disable(logging.NOTSET)
+            self.stop_replicas()
+
+    def test_resolve_host(self):
+        self.assertEqual(server.storage.resolve_host('localhost', 'fallback'), 'localhost')
+        self.assertEqual(server.storage.resolve_host('no-such-host.invalid', 'fallback'), 'fallback')
+
+    def test_connections_returned_to_pool(self):
+        self.app.get('/recommendations')
+        self.app.get('/recommendations/0')
+        self.app.put('/recommendations/3/clicked', content_type='application/json')
+        self.assertEqual(server.engine.pool.checkedout(), 0)
+
+    def test_pool_options_from_environment(self):
+        os.environ['DB_POOL_SIZE'] = '7'
+        os.environ['DB_POOL_PRE_PING'] = 'False'
+        try:
+            options = server.storage.pool_options()
+        finally:
+            del os.environ['DB_POOL_SIZE']
+            del os.environ['DB_POOL_PRE_PING']
+        self.assertEqual(options['pool_size'], 7)
+        self.assertFalse(options['pre_ping'])
 
     def test_is_valid_errors_valueerror(self):
         new_recommendation = {'parent_product_id': 'a', 'priority': '3', 'related_product_id':'3', 'type': 'up-sell'}
@@ -288,6 +993,317 @@ class TestRecommendationServer(unittest.TestCase):
         data = json.loads(resp.data)
         return len(data)
 
+    def count_queries(self, request):
+        """ Counts the statements on the recommendations table a request runs """
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if 'recommendations' in statement:
+                statements.append(statement)
+        event.listen(server.engine, 'before_cursor_execute', record)
+        try:
+            request()
+        finally:
+            event.remove(server.engine, 'before_cursor_execute', record)
+        return len(statements)
+
+    def start_batched_clicks(self):
+        os.environ['CLICK_MODE'] = 'batched'
+        os.environ['CLICK_FLUSH_INTERVAL'] = '3600'
+        server.initialize_clicks()
+
+    def stop_batched_clicks(self):
+        del os.environ['CLICK_MODE']
+        del os.environ['CLICK_FLUSH_INTERVAL']
+        server.initialize_clicks()
+
+    def get_product_list(self, product_id, rec_type=None):
+        url = '/recommendations?product-id=%d' % product_id
+        if rec_type:
+            url += '&type=' + rec_type
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        return json.loads(resp.data)
+
+
+class TestShardedServer(unittest.TestCase):
+    """ The service with its recommendations on two SQLite shards """
+
+    @classmethod
+    def setUpClass(self):
+        self.workdir = tempfile.mkdtemp()
+        os.environ['TEST_SHARD_URIS'] = ','.join('sqlite:///' + os.path.join(self.workdir, 'shard%d.db' % shard)
+                                                 for shard in range(2))
+        server.initialize_mysql(test=True)
+
+    @classmethod
+    def tearDownClass(self):
+        del os.environ['TEST_SHARD_URIS']
+        server.initialize_mysql(test=True)
+        shutil.rmtree(self.workdir)
+
+    def setUp(self):
+        self.app = server.app.test_client()
+        server.list_cache.clear()
+        server.item_parents.clear()
+        for engine in server.shard_set.engines:
+            engine.execute("DELETE FROM `recommendations`")
+        self.ids = [self.create(product, related) for product in range(1, 9) for related in (100, 200)]
+
+    def create(self, product, related, type='x-sell'):
+        resp = self.app.post('/recommendations', content_type='application/json',
+                             data=json.dumps({'parent_product_id': product, 'related_product_id': related,
+                                              'type': type, 'priority': 5}))
+        self.assertEqual(resp.status_code, HTTP_201_CREATED)
+        return json.loads(resp.data)['id']
+
+    def test_ids_name_the_shard(self):
+        for shard, engine in enumerate(server.shard_set.engines):
+            for id, product in engine.execute("SELECT id, parent_product_id FROM `recommendations`"):
+                self.assertEqual(server.shards.bucket_of_id(id), server.shards.bucket_of_product(product))
+                self.assertEqual(server.shard_set.shard(server.shards.bucket_of_id(id)), shard)
+        counts = [engine.execute("SELECT count(*) FROM `recommendations`").scalar()
+                  for engine in server.shard_set.engines]
+        self.assertEqual(sum(counts), 16)
+        self.assertTrue(min(counts) > 0)
+
+    def test_list_all_merges_shards(self):
+        data = json.loads(self.app.get('/recommendations').data)
+        self.assertEqual([row['id'] for row in data], sorted(self.ids))
+        data = json.loads(self.app.get('/recommendations?type=x-sell').data)
+        self.assertEqual(len(data), 16)
+        resp = self.app.get('/recommendations?export=ndjson')
+        self.assertEqual([json.loads(line)['id'] for line in resp.data.splitlines()], sorted(self.ids))
+
+    def test_first_request_of_a_lazy_server_opens_the_shards(self):
+        server.initialize_mysql(test=True, lazy=True)
+        # as in a new process, the shards are configured with the engine
+        server.shard_set.dispose()
+        server.shard_set = None
+        resp = self.app.get('/admin/shards')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['buckets'], [128, 128])
+
+    def test_pages_across_shards(self):
+        seen = []
+        url = '/recommendations?limit=5'
+        while url:
+            resp = self.app.get(url)
+            seen.extend(row['id'] for row in json.loads(resp.data))
+            cursor = resp.headers.get('X-Next-Cursor')
+            url = cursor and '/recommendations?limit=5&cursor=' + cursor
+        self.assertEqual(seen, sorted(self.ids))
+
+    def test_product_and_id_routes(self):
+        data = json.loads(self.app.get('/recommendations?product-id=3').data)
+        self.assertEqual([row['related_product_id'] for row in data], [100, 200])
+        id = data[0]['id']
+        self.assertEqual(json.loads(self.app.get('/recommendations/%d' % id).data)['parent_product_id'], 3)
+        resp = self.app.put('/recommendations/%d' % id, content_type='application/json',
+                            data=json.dumps({'parent_product_id': 3, 'related_product_id': 100,
+                                             'type': 'up-sell', 'priority': 2}))
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.app.put('/recommendations/%d/clicked' % id, content_type='application/json')
+        self.assertEqual(json.loads(self.app.get('/recommendations/%d' % id).data)['priority'], 1)
+        resp = self.app.post('/recommendations/lookup', content_type='application/json',
+                             data=json.dumps({'product-ids': [3, 4, 5]}))
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(sorted(len(rows) for rows in json.loads(resp.data).values()), [2, 2, 2])
+        self.assertEqual(self.app.delete('/recommendations/%d' % id).status_code, HTTP_204_NO_CONTENT)
+        self.assertEqual(self.app.get('/recommendations/%d' % id).status_code, HTTP_404_NOT_FOUND)
+        self.assertEqual(self.app.get('/recommendations/999').status_code, HTTP_404_NOT_FOUND)
+
+    def test_conflict_on_a_shard(self):
+        resp = self.app.post('/recommendations', content_type='application/json',
+                             data=json.dumps({'parent_product_id': 1, 'related_product_id': 100,
+                                              'type': 'x-sell', 'priority': 5}))
+        self.assertEqual(resp.status_code, HTTP_409_CONFLICT)
+
+    def test_writes_wait_while_a_product_moves(self):
+        bucket = server.shards.bucket_of_product(1)
+        server.shards.set_buckets(server.engine, [bucket], server.shard_set.owners[bucket], server.shards.MOVING)
+        server.shard_set.refresh()
+        try:
+            resp = self.app.post('/recommendations', content_type='application/json',
+                                 data=json.dumps({'parent_product_id': 1, 'related_product_id': 300,
+                                                  'type': 'x-sell', 'priority': 5}))
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+            # reads go on
+            self.assertEqual(len(json.loads(self.app.get('/recommendations?product-id=1').data)), 2)
+            self.assertEqual(json.loads(self.app.get('/admin/shards').data)['moving'], [bucket])
+        finally:
+            server.shards.set_buckets(server.engine, [bucket], server.shard_set.owners[bucket],
+                                      server.shards.ACTIVE)
+            server.shard_set.refresh()
+
+    def test_bulk_not_implemented(self):
+        resp = self.app.delete('/recommendations/bulk', data=json.dumps([1]), content_type='application/json')
+        self.assertEqual(resp.status_code, 501)
+
+
+class TestChangeLogServer(unittest.TestCase):
+    """ The service with its mutations appended to a change log """
+
+    @classmethod
+    def setUpClass(self):
+        self.workdir = tempfile.mkdtemp()
+        os.environ['TEST_CHANGE_LOG_DIR'] = self.workdir
+        server.initialize_mysql(test=True)
+
+    @classmethod
+    def tearDownClass(self):
+        del os.environ['TEST_CHANGE_LOG_DIR']
+        server.initialize_mysql(test=True)
+        shutil.rmtree(self.workdir)
+
+    def setUp(self):
+        self.app = server.app.test_client()
+        server.list_cache.clear()
+        server.item_parents.clear()
+        server.engine.execute("DELETE FROM `recommendations`")
+        server.engine.execute("INSERT INTO `recommendations` VALUES (1,1,2,'x-sell',5),(2,1,3,'up-sell',5)")
+        # the position to follow from, as after reading every recommendation
+        resp = self.app.get('/recommendations/changes')
+        self.assertEqual(json.loads(resp.data), [])
+        self.since = int(resp.headers['X-Last-Seq'])
+
+    def get_changes(self, query=''):
+        resp = self.app.get('/recommendations/changes?since=%d%s' % (self.since, query))
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        return json.loads(resp.data), int(resp.headers['X-Last-Seq'])
+
+    def test_every_mutation_is_logged_in_order(self):
+        resp = self.app.post('/recommendations', content_type='application/json',
+                             data=json.dumps({'parent_product_id': 3, 'related_product_id': 4,
+                                              'type': 'x-sell', 'priority': 2}))
+        id = json.loads(resp.data)['id']
+        self.app.put('/recommendations/%d' % id, content_type='application/json',
+                     data=json.dumps({'parent_product_id': 3, 'related_product_id': 4,
+                                      'type': 'x-sell', 'priority': 7}))
+        self.app.put('/recommendations/1/clicked')
+        self.app.delete('/recommendations/2')
+        # nothing was deleted
+        self.app.delete('/recommendations/2')
+        data, last_seq = self.get_changes()
+        self.assertEqual([(change['op'], change['id']) for change in data],
+                         [('create', id), ('update', id), ('clicked', 1), ('delete', 2)])
+        self.assertEqual([change['seq'] for change in data], range(self.since + 1, self.since + 5))
+        self.assertEqual(last_seq, self.since + 4)
+        self.assertEqual(data[1]['recommendation'], {'id': id, 'parent_product_id': 3, 'related_product_id': 4,
+                                                     'type': 'x-sell', 'priority': 7})
+        self.assertEqual(data[3]['parent_product_id'], 1)
+        self.since = last_seq
+        self.assertEqual(self.get_changes(), ([], last_seq))
+
+    def test_batched_clicks_are_logged_once_written(self):
+        os.environ['CLICK_MODE'] = 'batched'
+        os.environ['CLICK_FLUSH_INTERVAL'] = '3600'
+        server.initialize_clicks()
+        try:
+            for id in (2, 1, 2):
+                self.app.put('/recommendations/%d/clicked' % id)
+            self.assertEqual(self.get_changes()[0], [])
+            server.click_batcher.flush()
+            data, last_seq = self.get_changes()
+            self.assertEqual([(change['op'], change['id']) for change in data],
+                             [('clicked', 1), ('clicked', 2), ('clicked', 2)])
+        finally:
+            del os.environ['CLICK_MODE']
+            del os.environ['CLICK_FLUSH_INTERVAL']
+            server.initialize_clicks()
+
+    def test_limit(self):
+        for _ in range(3):
+            self.app.put('/recommendations/1/clicked')
+        data, last_seq = self.get_changes('&limit=2')
+        self.assertEqual(len(data), 2)
+        self.since = last_seq
+        self.assertEqual(len(self.get_changes()[0]), 1)
+        self.assertEqual(json.loads(self.app.get('/admin/changes').data)['last_seq'], last_seq + 1)
+
+    def test_bulk_writes_are_logged(self):
+        self.app.post('/recommendations/bulk', content_type='application/json',
+                      data=json.dumps([{'parent_product_id': 5, 'related_product_id': 6, 'type': 'x-sell', 'priority': 1},
+                                       {'parent_product_id': 1, 'related_product_id': 2, 'type': 'x-sell', 'priority': 1}]))
+        self.app.put('/recommendations/bulk', content_type='application/json',
+                     data=json.dumps([{'id': 1, 'parent_product_id': 1, 'related_product_id': 2, 'type': 'x-sell', 'priority': 9},
+                                      {'id': 99, 'parent_product_id': 1, 'related_product_id': 2, 'type': 'x-sell', 'priority': 9}]))
+        self.app.delete('/recommendations/bulk', content_type='application/json', data=json.dumps([2, 99]))
+        data, last_seq = self.get_changes()
+        # the conflicting create and the missing id are not
+        self.assertEqual([(change['op'], change['parent_product_id']) for change in data],
+                         [('create', 5), ('update', 1), ('delete', 1)])
+        self.assertEqual(data[1]['recommendation']['priority'], 9)
+
+    def test_writes_left_pending_by_a_dead_process_are_recovered(self):
+        server.log_changes(server.changes.CREATE, [(2, 1, 3, 'up-sell', 5)])
+        self.since += 1
+        # a worker wrote 1 and 2 and died before logging them
+        server.engine.execute("UPDATE `recommendations` SET priority = 8 WHERE id = 1")
+        server.engine.execute("DELETE FROM `recommendations` WHERE id = 2")
+        with open(os.path.join(self.workdir, server.changes.JOURNAL_PREFIX + 'dead'), 'w') as journal:
+            journal.write('+1 1,2\n')
+        logging.disable(logging.WARNING)
+        try:
+            server.recover_changes()
+        finally:
+            logging.disable(logging.NOTSET)
+        data, last_seq = self.get_changes()
+        self.assertEqual([(change['op'], change['id']) for change in data], [('update', 1), ('delete', 2)])
+        self.assertEqual(data[0]['recommendation']['priority'], 8)
+
+    def test_logged_writes_clear_their_marks(self):
+        self.app.put('/recommendations/1/clicked')
+        self.app.post('/recommendations', content_type='application/json',
+                      data=json.dumps({'parent_product_id': 3, 'related_product_id': 4,
+                                       'type': 'x-sell', 'priority': 2}))
+        journals = [name for name in os.listdir(self.workdir) if name.startswith(server.changes.JOURNAL_PREFIX)]
+        self.assertEqual(len(journals), 1)
+        self.assertEqual(os.path.getsize(os.path.join(self.workdir, journals[0])), 0)
+        self.assertEqual(len(self.get_changes()[0]), 2)
+
+    def test_bulk_writes_hold_only_their_ids(self):
+        held = Event()
+        def hold():
+            with server.change_log.serialized([1000]):
+                held.set()
+                time.sleep(2)
+        thread = Thread(target=hold)
+        thread.start()
+        held.wait()
+        start = time.time()
+        resp = self.app.delete('/recommendations/bulk', content_type='application/x-ndjson', data='2\n')
+        self.assertTrue(time.time() - start < 1)
+        thread.join()
+        self.assertEqual(json.loads(resp.data)[0]['status'], HTTP_204_NO_CONTENT)
+        self.assertEqual([change['op'] for change in self.get_changes()[0]], ['delete'])
+
+    def test_long_poll(self):
+        start = time.time()
+        self.assertEqual(self.get_changes('&wait=0.2'), ([], self.since))
+        self.assertTrue(time.time() - start >= 0.2)
+        thread = Thread(target=lambda: (time.sleep(0.1), server.log_changes(server.changes.CLICKED, [(1, 1)])))
+        thread.start()
+        data, last_seq = self.get_changes('&wait=10')
+        thread.join()
+        self.assertEqual([change['op'] for change in data], ['clicked'])
+
+    def test_stream(self):
+        self.app.put('/recommendations/1/clicked')
+        resp = self.app.get('/recommendations/changes?since=%d&stream=true&wait=0.1' % self.since)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = [line for line in resp.data.splitlines() if line]
+        self.assertEqual([json.loads(line)['op'] for line in lines], ['clicked'])
+
+    def test_invalid_and_gone(self):
+        resp = self.app.get('/recommendations/changes?since=-1')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/recommendations/changes?since=0&limit=x')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        # a seq the log never had
+        resp = self.app.get('/recommendations/changes?since=%d' % (self.since + 100))
+        self.assertEqual(resp.status_code, 410)
+
 ######################################################################
 #   M A I N
 ######################################################################
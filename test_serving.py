@@ -0,0 +1,177 @@
+# run with:
+# python -m unittest discover
+
+import os
+import sys
+import json
+import shutil
+import socket
+import httplib
+import tempfile
+import unittest
+import subprocess
+import time
+
+try:
+    import gunicorn
+except ImportError:
+    gunicorn = None
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class ServingTests(object):
+    """
+    The same requests against the service under a real server, run once
+    per gunicorn worker class by the test cases below
+    """
+    worker_class = None
+    workers = 1
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        cls.port = sock.getsockname()[1]
+        sock.close()
+        env = dict(os.environ,
+                   DATABASE_URI='sqlite:///' + os.path.join(cls.workdir, 'serving.db'),
+                   PORT=str(cls.port), WORKER_CLASS=cls.worker_class, WEB_CONCURRENCY=str(cls.workers))
+        cls.server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn.app.wsgiapp', '-c', 'gunicorn.conf.py',
+             '--bind', '127.0.0.1:%d' % cls.port, 'server:create_app()'],
+            cwd=ROOT, env=env, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        deadline = time.time() + 30
+        while True:
+            try:
+                if cls.request('GET', '/ready')[0] == 200:
+                    break
+            except socket.error:
+                pass
+            if time.time() > deadline or cls.server.poll() is not None:
+                cls.tearDownClass()
+                raise RuntimeError('gunicorn did not start')
+            time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server.poll() is None:
+            cls.server.terminate()
+            cls.server.wait()
+        shutil.rmtree(cls.workdir)
+
+    @classmethod
+    def request(cls, method, path, data=None, headers=None):
+        status, body, headers = cls.request_with_headers(method, path, data, headers)
+        return status, body
+
+    @classmethod
+    def request_with_headers(cls, method, path, data=None, headers=None):
+        conn = httplib.HTTPConnection('127.0.0.1', cls.port, timeout=10)
+        try:
+            conn.request(method, path, json.dumps(data) if data is not None else None,
+                         dict({'Content-Type': 'application/json'}, **(headers or {})))
+            resp = conn.getresponse()
+            body = resp.read()
+            return resp.status, json.loads(body) if body else None, dict(resp.getheaders())
+        finally:
+            conn.close()
+
+    def create(self, parent_product_id, related_product_id, rec_type='x-sell', priority=5):
+        status, data = self.request('POST', '/recommendations', {
+            'parent_product_id': parent_product_id, 'related_product_id': related_product_id,
+            'type': rec_type, 'priority': priority})
+        self.assertEqual(status, 201)
+        return data
+
+    def test_index(self):
+        status, data = self.request('GET', '/')
+        self.assertEqual(status, 200)
+        self.assertEqual(data['name'], 'Recommendations REST API Service')
+
+    def test_recommendation_lifecycle(self):
+        rec = self.create(100, 101, priority=3)
+        self.assertEqual(sorted(rec.keys()), ['id', 'parent_product_id', 'priority',
+                                              'related_product_id', 'type'])
+        self.assertEqual(self.request('GET', '/recommendations/%d' % rec['id']), (200, rec))
+        self.assertEqual(self.request('GET', '/recommendations?product-id=100'), (200, [rec]))
+        rec['priority'] = 2
+        payload = dict((key, value) for key, value in rec.items() if key != 'id')
+        self.assertEqual(self.request('PUT', '/recommendations/%d' % rec['id'], payload), (200, rec))
+        self.assertEqual(self.request('PUT', '/recommendations/%d/clicked' % rec['id'])[0], 200)
+        self.assertEqual(self.request('GET', '/recommendations/%d' % rec['id'])[1]['priority'], 1)
+        self.assertEqual(self.request('DELETE', '/recommendations/%d' % rec['id'])[0], 204)
+        self.assertEqual(self.request('GET', '/recommendations/%d' % rec['id'])[0], 404)
+
+    def test_lookup_of_several_products(self):
+        first = self.create(200, 201)
+        second = self.create(202, 203, 'up-sell')
+        expected = {'200': [first], '202': [second], '204': []}
+        self.assertEqual(self.request('GET', '/recommendations?product-ids=200,202,204'), (200, expected))
+        self.assertEqual(self.request('POST', '/recommendations/lookup',
+                                      {'product-ids': [200, 202, 204]}), (200, expected))
+
+    def test_concurrent_requests(self):
+        rec = self.create(300, 301)
+        conns = [httplib.HTTPConnection('127.0.0.1', self.port, timeout=10) for _ in range(20)]
+        for conn in conns:
+            conn.request('GET', '/recommendations?product-id=300')
+        for conn in conns:
+            resp = conn.getresponse()
+            self.assertEqual((resp.status, json.loads(resp.read())), (200, [rec]))
+            conn.close()
+
+    def test_conflict(self):
+        self.create(400, 401)
+        status, data = self.request('POST', '/recommendations', {
+            'parent_product_id': 400, 'related_product_id': 401, 'type': 'x-sell', 'priority': 1})
+        self.assertEqual(status, 409)
+
+
+@unittest.skipIf(gunicorn is None, 'serving tests need gunicorn')
+class TestThreadedServer(ServingTests, unittest.TestCase):
+    worker_class = 'gthread'
+
+
+@unittest.skipIf(gunicorn is None or gevent is None, 'serving tests need gunicorn and gevent')
+class TestGeventServer(ServingTests, unittest.TestCase):
+    worker_class = 'gevent'
+
+
+@unittest.skipIf(gunicorn is None, 'serving tests need gunicorn')
+class TestSeveralWorkers(ServingTests, unittest.TestCase):
+    worker_class = 'gthread'
+    workers = 3
+
+    def test_no_stale_not_modified_from_another_worker(self):
+        rec = self.create(500, 501)
+        urls = ['/recommendations/%d' % rec['id'], '/recommendations?product-id=500']
+        # each worker keeps versions of its own in the in-process cache,
+        # a tag one of them issued could be answered 304 by another
+        # after a write it did not see
+        for _ in range(10):
+            for url in urls:
+                status, data, headers = self.request_with_headers('GET', url)
+                self.assertEqual(status, 200)
+                self.assertNotIn('etag', headers)
+        rec['priority'] = 1
+        payload = dict((key, value) for key, value in rec.items() if key != 'id')
+        self.assertEqual(self.request('PUT', '/recommendations/%d' % rec['id'], payload), (200, rec))
+        for _ in range(10):
+            self.assertEqual(self.request('GET', urls[0]), (200, rec))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
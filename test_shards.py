@@ -0,0 +1,196 @@
+# run with:
+# python -m unittest discover
+
+import os
+import shutil
+import tempfile
+import unittest
+import storage
+import queries
+import migrations
+import shards
+
+rec = storage.recommendations
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.workdir = tempfile.mkdtemp()
+        self.directory = self.create_engine('directory')
+        self.engines = [self.create_engine('shard%d' % shard) for shard in range(3)]
+        shards.init_directory(self.directory, 2)
+        self.shard_set = shards.ShardSet(self.directory, self.engines, clock=self.clock)
+        queries.prepare(self.directory)
+
+    def tearDown(self):
+        self.shard_set.dispose()
+        self.directory.dispose()
+        shutil.rmtree(self.workdir)
+
+    def create_engine(self, name):
+        engine = storage.create_db_engine('sqlite:///' + os.path.join(self.workdir, name + '.db'))
+        migrations.upgrade(engine)
+        return engine
+
+    def load(self, products=40):
+        rows = [{'parent_product_id': product, 'related_product_id': related,
+                 'type': 'x-sell', 'priority': related}
+                for product in range(1, products + 1) for related in (1001, 1002)]
+        return shards.load(self.shard_set, rows)
+
+    def rows(self, engine):
+        return engine.execute(rec.select().order_by(rec.c.id)).fetchall()
+
+    def all_rows(self):
+        rows, resume = self.shard_set.gather('sorted_all', {})
+        return rows
+
+    def test_bucket_of_product_spreads_products(self):
+        buckets = [shards.bucket_of_product(product) for product in range(1, 10001)]
+        self.assertTrue(all(0 <= bucket < shards.BUCKETS for bucket in buckets))
+        counts = [buckets.count(bucket) for bucket in range(shards.BUCKETS)]
+        self.assertTrue(min(counts) > 0.5 * 10000 / shards.BUCKETS)
+        self.assertTrue(max(counts) < 1.5 * 10000 / shards.BUCKETS)
+
+    def test_ids_encode_the_bucket(self):
+        ids = self.shard_set.next_ids(7, 3)
+        self.assertEqual(ids, [shards.make_id(sequence, 7) for sequence in (1, 2, 3)])
+        self.assertEqual(set(shards.bucket_of_id(id) for id in ids), set([7]))
+        self.assertEqual(self.shard_set.next_ids(7), [shards.make_id(4, 7)])
+
+    def test_init_directory_once(self):
+        self.assertFalse(shards.init_directory(self.directory, 3))
+        self.assertEqual(self.shard_set.stats(), {'buckets': [128, 128, 0], 'moving': []})
+
+    def test_load_places_products_on_their_shard(self):
+        self.assertEqual(self.load(), 80)
+        for shard, engine in enumerate(self.engines):
+            for row in self.rows(engine):
+                bucket = shards.bucket_of_product(row['parent_product_id'])
+                self.assertEqual(shards.bucket_of_id(row['id']), bucket)
+                self.assertEqual(self.shard_set.shard(bucket), shard)
+
+    def test_gather_merges_in_id_order(self):
+        self.load()
+        ids = [row['id'] for row in self.all_rows()]
+        self.assertEqual(len(ids), 80)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_gather_pages(self):
+        self.load()
+        expected = [row['id'] for row in self.all_rows()]
+        seen = []
+        after_id = 0
+        while after_id is not None:
+            rows, after_id = self.shard_set.gather('page_all', {'after_id': after_id, 'limit': 7}, 7)
+            self.assertTrue(len(rows) <= 7)
+            seen.extend(row['id'] for row in rows)
+        self.assertEqual(seen, expected)
+
+    def test_gather_cuts_at_the_limit_when_no_shard_fills_it(self):
+        self.load(10)
+        counts = [len(self.rows(engine)) for engine in self.engines]
+        limit = max(counts) + 1
+        self.assertTrue(sum(counts) > limit)
+        expected = [row['id'] for row in self.all_rows()]
+        rows, after_id = self.shard_set.gather('page_all', {'after_id': 0, 'limit': limit}, limit)
+        self.assertEqual([row['id'] for row in rows], expected[:limit])
+        self.assertEqual(after_id, expected[limit - 1])
+        rows, after_id = self.shard_set.gather('page_all', {'after_id': after_id, 'limit': limit}, limit)
+        self.assertEqual([row['id'] for row in rows], expected[limit:])
+        self.assertIsNone(after_id)
+
+    def test_writes_refused_while_moving(self):
+        self.directory.execute(storage.shard_buckets.update().where(storage.shard_buckets.c.bucket == 5)
+                               .values(state=shards.MOVING))
+        # seen once the directory is reread
+        self.assertEqual(self.shard_set.shard(5, write=True), 1)
+        self.clock.now = shards.REFRESH_INTERVAL
+        self.assertEqual(self.shard_set.shard(5), 1)
+        self.assertRaises(shards.ShardMovingError, self.shard_set.shard, 5, True)
+
+    def test_plan_moves_as_few_buckets_as_possible(self):
+        moves = shards.plan(self.shard_set.owners, 3)
+        self.assertEqual(len(moves), 85)
+        self.assertEqual(set(target for bucket, target in moves), set([2]))
+        owners = list(self.shard_set.owners)
+        for bucket, target in moves:
+            owners[bucket] = target
+        self.assertEqual(sorted(owners.count(shard) for shard in range(3)), [85, 85, 86])
+        self.assertEqual(shards.plan(owners, 3), [])
+        # shrinking moves the buckets of the shards left out
+        self.assertEqual(len(shards.plan(owners, 1)), shards.BUCKETS - owners.count(0))
+
+    def test_rebalance_keeps_every_row(self):
+        self.load()
+        before = [tuple(row) for row in self.all_rows()]
+        waits = []
+
+        def sleep(seconds):
+            # in the middle of a move the rows are still read once
+            waits.append(seconds)
+            self.shard_set.refresh()
+            self.assertEqual([tuple(row) for row in self.all_rows()], before)
+        moved = shards.rebalance(self.shard_set, settle=5, batch=50, sleep=sleep)
+        self.assertEqual(moved, 85)
+        self.assertEqual(waits, [5] * 4)
+        self.assertEqual(sorted(self.shard_set.stats()['buckets']), [85, 85, 86])
+        self.assertEqual([tuple(row) for row in self.all_rows()], before)
+        # the old copies are gone
+        self.assertEqual(sum(len(self.rows(engine)) for engine in self.engines), 80)
+        for shard, engine in enumerate(self.engines):
+            for row in self.rows(engine):
+                self.assertEqual(self.shard_set.shard(shards.bucket_of_id(row['id'])), shard)
+
+    def test_move_copies_writes_made_during_the_copy(self):
+        self.load()
+        bucket = shards.bucket_of_product(1)
+        source = self.shard_set.shard(bucket)
+        target = 2
+        sleeps = []
+
+        def sleep(seconds):
+            if not sleeps:
+                # a write that reached the old shard before the freeze
+                self.engines[source].execute(rec.update().where(rec.c.parent_product_id == 1)
+                                             .values(priority=1))
+            sleeps.append(seconds)
+        shards.move_buckets(self.shard_set, [bucket], target, settle=0, sleep=sleep)
+        self.assertEqual(self.shard_set.shard(bucket), target)
+        rows = self.engines[target].execute(rec.select().where(rec.c.parent_product_id == 1)).fetchall()
+        self.assertEqual([row['priority'] for row in rows], [1, 1])
+
+    def test_interrupted_move_is_finished_by_moving_again(self):
+        self.load()
+        bucket = shards.bucket_of_product(1)
+
+        def interrupt(seconds):
+            raise KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, shards.move_buckets, self.shard_set, [bucket], 2,
+                          settle=0, sleep=interrupt)
+        self.shard_set.refresh()
+        self.assertIn(bucket, self.shard_set.moving)
+        # the copy on the target is not read
+        self.assertEqual(len(self.all_rows()), 80)
+        shards.move_buckets(self.shard_set, [bucket], 2, settle=0, sleep=lambda seconds: None)
+        self.assertEqual(self.shard_set.stats()['moving'], [])
+        self.assertEqual(len(self.all_rows()), 80)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()